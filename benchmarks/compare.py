@@ -0,0 +1,46 @@
+"""Compare two benchmark result files
+
+Usage:
+    python benchmarks/compare.py before.json after.json [--threshold 1.2]
+
+Prints the median time of every benchmark in both files and their ratio.
+Exits with status 1 if any ratio exceeds the threshold.
+"""
+from __future__ import print_function
+import argparse
+import json
+import sys
+
+def _load(fname):
+    with open(fname) as f:
+        report = json.load(f)
+    return dict(((r["name"], json.dumps(r["params"], sort_keys=True)), r)
+        for r in report["results"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=None,
+        help="fail if after / before exceeds this ratio")
+    args = parser.parse_args(argv)
+
+    before = _load(args.before)
+    after = _load(args.after)
+
+    regressions = 0
+    for key in sorted(set(before) | set(after)):
+        old = before.get(key, {}).get("median")
+        new = after.get(key, {}).get("median")
+        ratio = new / old if old and new is not None else None
+        if ratio is not None and args.threshold and ratio > args.threshold:
+            regressions += 1
+        print("%-28s %-40s %10s %10s %8s" % (key[0], key[1],
+            "%.4f" % old if old is not None else "-",
+            "%.4f" % new if new is not None else "-",
+            "%.2fx" % ratio if ratio is not None else "-"))
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,736 @@
+"""Offline benchmark suite of the night-flare hot paths
+
+Every benchmark runs against a local WMTS stand-in server serving
+deterministic synthetic tiles and a synthetic geocoder data set, so runs
+need no network and are reproducible. Results are written as JSON and can be
+compared between commits with compare.py.
+
+Usage:
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --filter geocoder --quick
+"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(_root, "packages"))
+
+import backfill
+import batch
+import columnar
+import conversion
+import dimensions
+import getimage
+import improcess
+import jobqueue
+import reverse_geocoder as rg
+import windowed
+import wmts_server
+
+# Top left tile of the California region used by Data_Analysis.ipynb
+CA_TILE = (6, 12, 10)
+
+_benchmarks = []
+
+def benchmark(name, **sizes):
+    """Register a benchmark function run once per combination of sizes
+
+    The function returns a setup function run before every timed run (or
+    None) and the function to time, optionally followed by a function
+    returning extra metrics, which is called once after timing.
+
+    Args:
+        name (str): Name of the benchmark
+        **sizes: Lists of values of every parameter. In quick mode the
+            second half of every list of numbers is skipped.
+    """
+    def dec(func):
+        _benchmarks.append((name, func, sizes))
+        return func
+    return dec
+
+def _combinations(sizes, quick):
+    combos = [{}]
+    for key in sorted(sizes):
+        values = sizes[key]
+        if quick and all(isinstance(v, (int, float)) for v in values):
+            values = values[:max(1, (len(values) + 1) // 2)]
+        combos = [dict(c, **{key: v}) for c in combos for v in values]
+    return combos
+
+class Context(object):
+
+    """State shared by the benchmarks
+
+    Attributes:
+        cache_dir (str): Temporary file cache directory of getimage
+        server (wmts_server.WMTSServer): The local tile server
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.cache_dir = None
+        getimage.set_base_url(server.url)
+        getimage.set_wms_url(server.wms_url)
+        self.reset_cache()
+
+    def reset_cache(self):
+        """Empty the memory and file caches of getimage
+        """
+        if self.cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.cache_dir = tempfile.mkdtemp(prefix="nightflare-bench-")
+        getimage.set_cache_dir(self.cache_dir)
+        windowed.set_cache_dir(os.path.join(self.cache_dir, "windowed"))
+
+    def close(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+def _synthetic_cities(n, seed=0):
+    """CSV stream of random places spread over the California region
+    """
+    rng = np.random.RandomState(seed)
+    lat0, lon0 = conversion.get_coordinates(*CA_TILE)
+    lat1, lon1 = conversion.get_coordinates(CA_TILE[0], CA_TILE[1] + 3,
+        CA_TILE[2] + 3)
+    lines = [",".join(rg.RG_COLUMNS)]
+    for i in range(n):
+        lines.append("%.5f,%.5f,City %d,California,County %d,US" % (
+            rng.uniform(lat1, lat0), rng.uniform(lon0, lon1), i, i % 58))
+    return io.StringIO(u"\n".join(lines) + u"\n")
+
+def _geocoder(mode):
+    """The geocoder, built from synthetic places on first use. Queries pass
+    their mode explicitly.
+    """
+    return rg.preload(mode=mode, verbose=False, stream=_synthetic_cities(20000))
+
+def _random_points(n, seed=0):
+    rng = np.random.RandomState(seed)
+    lat0, lon0 = conversion.get_coordinates(*CA_TILE)
+    lat1, lon1 = conversion.get_coordinates(CA_TILE[0], CA_TILE[1] + 3,
+        CA_TILE[2] + 3)
+    return list(zip(rng.uniform(lat1, lat0, n).tolist(),
+        rng.uniform(lon0, lon1, n).tolist()))
+
+@benchmark("get_image_date_range", num_days=[1, 8, 31], cache=["hot", "file", "cold"])
+def bench_fetch(ctx, num_days, cache):
+    if cache == "cold":
+        setup = ctx.reset_cache
+    elif cache == "file":
+        setup = getimage.clear_memory_cache
+    else:
+        setup = None
+
+    def run():
+        getimage.get_image_date_range(start_date="2017-10-01",
+            num_days=num_days, end_date=None)
+    return setup, run
+
+def _disk_usage(path):
+    files = [os.path.join(root, f) for root, _, names in os.walk(path) for f in names]
+    return sum(os.path.getsize(f) for f in files), len(files)
+
+@benchmark("file_cache", blank_rate=[0, 0.5])
+def bench_file_cache(ctx, blank_rate):
+    # Cold fetches of a month, with a share of blank tiles like ocean tiles
+    # or days without data, which are stored once
+    def setup():
+        ctx.reset_cache()
+        ctx.server.blank_rate = blank_rate
+        ctx.server.reset()
+
+    def target():
+        getimage.get_image_date_range(start_date="2017-10-01", num_days=31,
+            end_date=None)
+
+    def metrics():
+        disk_bytes, files = _disk_usage(ctx.cache_dir)
+        ctx.server.blank_rate = 0
+        ctx.server.reset()
+        return {"disk_bytes": disk_bytes, "files": files}
+    return setup, target, metrics
+
+@benchmark("cache_budget", budget=["none", "2M"])
+def bench_cache_budget(ctx, budget):
+    # Cold fetches of a month into a file cache kept under a budget, about a
+    # third of the month
+    def setup():
+        ctx.reset_cache()
+        getimage.set_cache_budget(None if budget == "none" else budget)
+
+    def target():
+        getimage.get_image_date_range(start_date="2017-10-01", num_days=31,
+            end_date=None, sea=None)
+
+    def metrics():
+        setup()
+        target()
+        disk_bytes, files = _disk_usage(ctx.cache_dir)
+        getimage.set_cache_budget(None)
+        return {"disk_bytes": disk_bytes, "files": files}
+    return setup, target, metrics
+
+@benchmark("revalidate", num_days=[31, 365])
+def bench_revalidate(ctx, num_days):
+    # Freshness check of cached tiles against the server, which transfers
+    # headers only unless a tile was reprocessed
+    getimage.set_revalidate(None)
+    sent = ctx.server.stats["bytes"]
+    getimage.get_image_date_range(start_date="2017-01-01", num_days=num_days,
+        end_date=None, sea=None)
+    full_bytes = ctx.server.stats["bytes"] - sent
+
+    def setup():
+        getimage.clear_memory_cache()
+        getimage.set_revalidate(0)
+
+    def target():
+        getimage.get_image_date_range(start_date="2017-01-01",
+            num_days=num_days, end_date=None, sea=None)
+
+    def metrics():
+        setup()
+        requests, sent = ctx.server.requests, ctx.server.stats["bytes"]
+        target()
+        check_bytes = ctx.server.stats["bytes"] - sent
+        checked = ctx.server.requests - requests
+        getimage.set_revalidate(None)
+        return {"tiles": checked, "full_bytes": full_bytes,
+            "check_bytes": check_bytes}
+    return setup, target, metrics
+
+@benchmark("fetch_region", mode=["tile", "region", "region_split"], num_days=[8, 31])
+def bench_fetch_region(ctx, mode, num_days):
+    # Cold fetch of the raw tiles and masks of the California region, tile by
+    # tile or with one GetMap request per day, with 20ms of network latency.
+    # In "region_split" the server refuses maps of more than 2x2 tiles.
+    tileMatrix, tileCol, tileRow = CA_TILE
+    tiles = [(tileCol + i, tileRow + j) for j in range(3) for i in range(3)]
+
+    def setup():
+        ctx.reset_cache()
+        # Forget the map size learned from the previous run
+        getimage.set_wms_url(ctx.server.wms_url)
+        ctx.server.latency = 0.02
+        ctx.server.max_map_size = 1024 if mode == "region_split" else None
+        getimage.set_fetch_mode("tile" if mode == "tile" else "region")
+
+    def target():
+        getimage.prefetch_region(tileMatrix, tileCol, tileRow, 3, 3,
+            start_date="2017-10-01", num_days=num_days, end_date=None)
+        for col, row in tiles:
+            getimage.get_mask(tileMatrix, col, row)
+            getimage.get_image_date_range(start_date="2017-10-01",
+                num_days=num_days, end_date=None, sea=None,
+                tileMatrix=tileMatrix, tileCol=col, tileRow=row)
+
+    def metrics():
+        setup()
+        requests = ctx.server.requests
+        target()
+        requests = ctx.server.requests - requests
+        getimage.set_fetch_mode("tile")
+        ctx.server.latency = 0
+        ctx.server.max_map_size = None
+        return {"requests": requests,
+            "requests_per_day": requests / float(num_days + 1)}
+    return setup, target, metrics
+
+@benchmark("backfill", jobs=[1, 8], num_days=[4, 16])
+def bench_backfill(ctx, jobs, num_days):
+    # Backfill of the California region at zoom levels 6 and 7 with 20ms of
+    # network latency, killed half way and resumed
+    state = {}
+
+    def setup():
+        ctx.reset_cache()
+        ctx.server.latency = 0.02
+        state["manifest"] = os.path.join(ctx.cache_dir, "backfill.json")
+        state["tiles"] = backfill.plan(state["manifest"], zooms=[6, 7],
+            start_date="2017-10-01", end_date="2017-10-%02d" % num_days)
+
+    def target():
+        backfill.run(state["manifest"], jobs=jobs, verbose=False)
+
+    def metrics():
+        setup()
+        requests = ctx.server.requests
+        backfill.run(state["manifest"], jobs=jobs, limit=state["tiles"] // 2,
+            verbose=False)
+        second = backfill.run(state["manifest"], jobs=jobs, verbose=False)
+        requests = ctx.server.requests - requests
+        # Rate limited to 100 requests per second
+        ctx.reset_cache()
+        start = time.time()
+        backfill.fetch([("VIIRS_SNPP_DayNightBand_ENCC", 6, 12, 10, "2017-10-%02d" % d)
+            for d in range(1, 26)], jobs=8, rate=100, verbose=False)
+        rate = 25 / (time.time() - start)
+        ctx.server.latency = 0
+        return {"tiles": state["tiles"], "requests": requests,
+            "resumed_tiles": second["fetched"], "limited_rate": rate}
+    return setup, target, metrics
+
+@benchmark("get_processed_image", method=["clip", "band_reject"], num_days=[8, 31])
+def bench_improcess(ctx, method, num_days):
+    func = {
+        "clip": improcess.get_processed_image_clip,
+        "band_reject": improcess.get_processed_image_band_reject
+    }[method]
+    return None, lambda: func(start_date="2017-10-01", num_days=num_days)
+
+@benchmark("precision", method=["clip", "band_reject"], precision=["float32", "uint8"])
+def bench_precision(ctx, method, precision):
+    func = {
+        "clip": improcess.get_processed_image_clip,
+        "band_reject": improcess.get_processed_image_band_reject
+    }[method]
+    return None, lambda: func(start_date="2017-10-01", num_days=31,
+        precision=precision)
+
+@benchmark("get_california_image", method=["clip", "band_reject"])
+def bench_california(ctx, method):
+    return None, lambda: improcess.get_california_image(*CA_TILE,
+        start_date="2017-10-01", improcess_select=method)
+
+@benchmark("windowed.process_region", method=["clip", "band_reject"], block=[256, 512])
+def bench_windowed(ctx, method, block):
+    def target():
+        return windowed.process_region(*CA_TILE, num_cols=3, num_rows=2,
+            num_days=8, method=method, block=block, force=True)
+
+    def metrics():
+        # Peak memory of numpy buffers, which grows with the block size and
+        # not with the region size
+        tracemalloc.start()
+        image = target()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {"peak_bytes": peak, "region_bytes": image.nbytes}
+    return None, target, metrics
+
+@benchmark("ops.Pipeline", method=["clip", "band_reject"], block=[256, 3072])
+def bench_pipeline(ctx, method, block):
+    # A 3072x3072 mosaic in memory, in cache sized blocks or as one block
+    policy = improcess.get_policy("float64")
+    image = np.random.RandomState(0).gamma(2.0, 30.0, (3072, 3072))
+    pipeline = improcess.pipeline(method, policy)
+
+    def metrics():
+        tracemalloc.start()
+        pipeline.run(image, block=block)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {"peak_bytes": peak}
+    return None, lambda: pipeline.run(image, block=block), metrics
+
+@benchmark("jobqueue.work", backend=["sqlite", "file"], workers=[1, 2, 4])
+def bench_jobqueue(ctx, backend, workers):
+    # Workers are forked, so they inherit the caches, server url and
+    # geocoder set up here
+    _geocoder(1)
+    fork = multiprocessing.get_context("fork")
+    state = {}
+
+    def setup():
+        root = tempfile.mkdtemp(dir=ctx.cache_dir)
+        batch.set_cache_dir(os.path.join(root, "batch"))
+        queue = jobqueue.open_queue(os.path.join(root,
+            "jobs.db" if backend == "sqlite" else "jobs"))
+        state["queue"] = queue
+        state["jobs"] = jobqueue.enqueue(queue, region="CA", start_month="2017-10",
+            end_month="2017-10", num_days=8, output_dir=root)
+
+    def target():
+        procs = [fork.Process(target=jobqueue.work, args=(state["queue"],),
+                kwargs={"poll": 0.1, "verbose": False})
+            for _ in range(workers)]
+        for p in procs: p.start()
+        for p in procs: p.join()
+
+    def metrics():
+        counts = state["queue"].counts()
+        return {"jobs": state["jobs"], "jobs_done": counts["done"]}
+    return setup, target, metrics
+
+def _pixel_blocks(num_pixels, block=100000):
+    """Blocks of random processed values and counties of pixels
+    """
+    counties = np.array(["County %d" % i for i in range(58)])
+    for start in range(0, num_pixels, block):
+        rng = np.random.RandomState(start)
+        yield (rng.randint(0, 256, block).astype(np.uint8),
+            counties[rng.randint(0, len(counties), block)])
+
+def _high_fractions_pandas(num_pixels):
+    """0.9 quantile and fraction of pixels above it of every county, the way
+    Data_Analysis computes them
+    """
+    import pandas as pd
+    values, zones = zip(*_pixel_blocks(num_pixels))
+    df = pd.DataFrame({"Light Pollution": np.concatenate(values),
+        "County": np.concatenate(zones)})
+    thresh = df["Light Pollution"].quantile(0.9)
+    df["High"] = df["Light Pollution"].apply(lambda x: (x > thresh) * 1)
+    return thresh, df.groupby("County")["High"].sum() / df.groupby("County")["High"].count()
+
+def _high_fractions_histogram(num_pixels):
+    h = conversion.ZoneHistogram()
+    for values, zones in _pixel_blocks(num_pixels):
+        h.add(values, zones)
+    thresh = h.quantile(0.9)
+    return thresh, h.fraction_above(thresh)
+
+@benchmark("conversion.ZoneHistogram", method=["pandas", "histogram"],
+    num_pixels=[1000000, 4000000])
+def bench_histogram(ctx, method, num_pixels):
+    # One DataFrame of all pixels against blocks counted one at a time
+    target = (_high_fractions_pandas if method == "pandas"
+        else _high_fractions_histogram)
+
+    def metrics():
+        tracemalloc.start()
+        target(num_pixels)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {"peak_bytes": peak}
+    return None, lambda: target(num_pixels), metrics
+
+def _pixel_frame(month, num_pixels):
+    """Geodecoded pixels of a month, like geodecode_region returns
+    """
+    import pandas as pd
+    rng = np.random.RandomState(int(month.replace("-", "")))
+    places = rng.randint(0, 1000, num_pixels)
+    return pd.DataFrame({
+        "Light Pollution": rng.uniform(0, 255, num_pixels),
+        "Region": np.array(["Place %d" % i for i in range(1000)])[places],
+        "County": np.array(["County %d" % i for i in range(58)])[places % 58],
+        "State": "California",
+        "Country": "US",
+        "Latitude": rng.uniform(32, 42, num_pixels),
+        "Longtitude": rng.uniform(-125, -114, num_pixels)})
+
+@benchmark("columnar.read", output_format=["csv", "parquet"], num_months=[12, 36])
+def bench_columnar(ctx, output_format, num_months):
+    # Mean light pollution of every county over all months, from one csv
+    # file per month or from the partitioned dataset reading two columns
+    import pandas as pd
+    root = tempfile.mkdtemp(dir=ctx.cache_dir)
+    months = batch.month_range("2015-01", "2030-01")[:num_months]
+    fnames = []
+    for month in months:
+        df = _pixel_frame(month, 100000)
+        if output_format == "csv":
+            fname = os.path.join(root, "%s_pixels.csv" % month)
+            df.to_csv(fname)
+        else:
+            fname = columnar.write(df, root, month, "CA")
+        fnames.append(fname)
+    columns = ["County", "Light Pollution"]
+
+    def target():
+        if output_format == "csv":
+            df = pd.concat([pd.read_csv(f, index_col=0) for f in fnames])
+        else:
+            df = columnar.read(root, columns=columns)
+        return df.groupby("County", observed=True)["Light Pollution"].mean()
+
+    def metrics():
+        if output_format == "csv":
+            read_bytes = sum(os.path.getsize(f) for f in fnames)
+        else:
+            read_bytes = columnar.bytes_to_read(root, columns)
+        return {"bytes_read": read_bytes,
+            "bytes_on_disk": sum(os.path.getsize(f) for f in fnames)}
+    return None, target, metrics
+
+def _zonal_frame(num_places):
+    """Sum of light pollution of places, like windowed.zonal_stats returns,
+    with the cities of the data directory among many other places
+    """
+    import pandas as pd
+    dims = dimensions.load()
+    rng = np.random.RandomState(num_places)
+    cities = dims.names["city"]
+    names = np.array(cities + ["Place %d" % i
+        for i in range(max(0, num_places - len(cities)))], dtype=object)[:num_places]
+    counties = np.array(dims.names["county"] + ["Other County"], dtype=object)
+    return pd.DataFrame({"Region": names,
+        "County": counties[rng.randint(0, len(counties), num_places)],
+        "State": "California",
+        "Sum": rng.uniform(0, 1e5, num_places)})
+
+def _joins_pandas(zonal):
+    """Population, electricity and economic region joins the way
+    Data_Analysis makes them, parsing and munging the csv files every time
+    """
+    import pandas as pd
+    data = os.path.join(_root, "data")
+    county = zonal.groupby("County")["Sum"].sum().reset_index()
+
+    population = pd.read_csv(os.path.join(data, "county_population.csv"),
+        header=None, names=["County", "Population"])
+    population.drop(0, inplace=True)
+    population["County"] = population["County"].apply(lambda x: x.strip() + " County")
+    population["Population"] = population["Population"].apply(lambda x: int(x))
+    county_population = pd.merge(county, population, on="County")
+
+    electricity = pd.read_csv(os.path.join(data, "electricity_county.csv"),
+        encoding="utf-8-sig")
+    electricity["County"] = electricity["County"].apply(lambda x: x.title() + " County")
+    electricity = electricity.loc[electricity["Sector"] == "Total"]
+    county_electricity = pd.merge(electricity[["County", "2009"]], county, on="County")
+
+    econ = pd.read_csv(os.path.join(data, "economic_region_county.csv"),
+        encoding="utf-8-sig")
+    # Names are stripped, the notebook misses "Yuba " of the Sacramento region
+    pairs = [(c.strip() + " County", r) for r, cs in zip(econ["Econ Region"], econ["Counties"])
+        for c in cs.split(",")]
+    econ_county = pd.DataFrame(pairs, columns=["County", "Economic Region"])
+    by_region = pd.merge(county, econ_county, on="County").groupby(
+        "Economic Region")["Sum"].sum()
+
+    cities = pd.read_csv(os.path.join(data, "city_population.csv"),
+        encoding="latin-1")
+    cities = cities.rename(columns={"Population (2010)": "Population", "Name": "Region"})
+    city = zonal.groupby("Region")["Sum"].sum().reset_index()
+    city_population = pd.merge(city, cities[["Region", "Population"]], on="Region")
+    return (county_population["Population"].sum(),
+        county_electricity["2009"].sum(), by_region, city_population["Population"].sum())
+
+def _joins_registry(zonal):
+    """The same joins by key with the registry of dimensions
+    """
+    dims = dimensions.load()
+    county = zonal.groupby("County")["Sum"].sum()
+    keys = dims.keys("county", county.index)
+    found = keys >= 0
+    population = dims.gather("county", "Population", keys[found])
+    electricity = dims.gather("county", "Electricity 2009", keys[found])
+    by_region = dims.rollup("county", "Economic Region", keys, county.values)
+    city_keys = dims.keys("city", zonal["Region"])
+    city_population = dims.gather("city", "Population", city_keys[city_keys >= 0])
+    return population.sum(), electricity.sum(), by_region, city_population.sum()
+
+@benchmark("dimensions.join", method=["pandas", "registry"], num_places=[1000, 100000])
+def bench_dimensions(ctx, method, num_places):
+    # County and city joins of zonal results of many places
+    zonal = _zonal_frame(num_places)
+    target = _joins_pandas if method == "pandas" else _joins_registry
+
+    def metrics():
+        if method == "pandas":
+            return {}
+        start = time.time()
+        dimensions.Dimensions.load(dimensions.cache_file())
+        cache_seconds = time.time() - start
+        start = time.time()
+        dimensions.Dimensions.from_csv()
+        parse_seconds = time.time() - start
+        return {"cache_load_seconds": cache_seconds, "parse_seconds": parse_seconds}
+    return None, lambda: target(zonal), metrics
+
+@benchmark("geodecode_region", size=[64, 128, 256])
+def bench_geodecode(ctx, size):
+    _geocoder(2)
+    region = np.random.RandomState(0).uniform(0, 255, (size, size))
+    mask = np.ones((size, size), np.uint8)
+    return None, lambda: conversion.geodecode_region(*CA_TILE, region=region,
+        mask=mask, state="California")
+
+def _private_bytes():
+    """Memory written by the current process since it was forked, on Linux
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Private_Dirty:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IOError):
+        pass
+    return None
+
+def _forked_search(conn, points):
+    before = _private_bytes()
+    start = time.time()
+    rg.search(points, mode=1, verbose=False)
+    after = _private_bytes()
+    conn.send((time.time() - start,
+        after - before if after is not None and before is not None else None))
+    conn.close()
+
+@benchmark("reverse_geocoder.preload", workers=[1, 2, 4])
+def bench_preload(ctx, workers):
+    # Workers forked after preload query without loading the geocoder
+    _geocoder(1)
+    fork = multiprocessing.get_context("fork")
+    points = _random_points(1000)
+    results = []
+
+    def target():
+        del results[:]
+        pipes = [fork.Pipe(False) for _ in range(workers)]
+        procs = [fork.Process(target=_forked_search, args=(w, points))
+            for _, w in pipes]
+        for p in procs: p.start()
+        results.extend(r.recv() for r, _ in pipes)
+        for p in procs: p.join()
+
+    def metrics():
+        target()
+        index_bytes = _geocoder(1).locations.nbytes
+        private = [b for _, b in results if b is not None]
+        return {"index_bytes": index_bytes,
+            "first_query_seconds": max(s for s, _ in results),
+            "worker_private_bytes": max(private) if private else None}
+    return None, target, metrics
+
+@benchmark("reverse_geocoder.search", mode=[1, 2], num_points=[1000, 10000, 100000])
+def bench_geocoder(ctx, mode, num_points):
+    _geocoder(mode)
+    points = _random_points(num_points)
+    return None, lambda: rg.search(points, mode=mode, verbose=False)
+
+@benchmark("cKDTree_MP.pquery", order=["none", "morton", "hilbert"],
+    num_points=[200000, 2000000])
+def bench_pquery(ctx, order, num_points):
+    # Random order queries of a dense tree, where sorting the queries along a
+    # curve keeps the visited branches of the tree in cache
+    from reverse_geocoder import cKDTree_MP as KDTree_MP
+    rng = np.random.RandomState(0)
+    tree = KDTree_MP.cKDTree_MP(rng.uniform(0, 1, (num_points, 2)))
+    points = rng.uniform(0, 1, (num_points, 2))
+    curve = None if order == "none" else order
+    return None, lambda: tree.pquery(points, order=curve)
+
+# Dependencies which must only be imported by the functions needing them
+HEAVY_MODULES = ("IPython", "PIL", "dateutil", "imageio", "ipywidgets",
+    "matplotlib", "pandas", "pyarrow", "reverse_geocoder", "scipy")
+
+_import_script = """
+import json, sys, time
+start = time.time()
+import %s
+print(json.dumps({"seconds": time.time() - start,
+    "heavy": sorted(m for m in %r if m in sys.modules)}))
+"""
+
+@benchmark("import", module=["backfill", "batch", "columnar", "composite", "conversion", "datacube",
+    "dimensions", "getimage", "improcess", "instrument", "jobqueue", "nightflare",
+    "ops", "precision", "pyramid", "trend", "visualization", "windowed", "wmts_server"])
+def bench_import(ctx, module):
+    # A fresh interpreter per import, so nothing is imported yet
+    def target():
+        out = subprocess.check_output([sys.executable, "-c",
+            _import_script % (module, HEAVY_MODULES)],
+            cwd=os.path.join(_root, "packages"))
+        return json.loads(out.decode("utf-8").strip().split("\n")[-1])
+
+    def metrics():
+        result = target()
+        return {"import_seconds": result["seconds"],
+            "heavy_modules": result["heavy"]}
+    return None, target, metrics
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=_root).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(repeat=3, quick=False, name_filter=None, verbose=True):
+    """Run the registered benchmarks
+
+    Every benchmark runs once untimed to warm up, then repeat times.
+
+    Args:
+        repeat (int, optional): Number of timed runs of every benchmark
+        quick (bool, optional): Only run the smaller sizes
+        name_filter (str, optional): Only run benchmarks whose name contains
+            this string
+        verbose (bool, optional): Print every result
+
+    Returns:
+        dict: Metadata and results, ready to be dumped as JSON
+    """
+    results = []
+    with wmts_server.WMTSServer() as server:
+        ctx = Context(server)
+        try:
+            for name, func, sizes in _benchmarks:
+                if name_filter and name_filter not in name:
+                    continue
+                for params in _combinations(sizes, quick):
+                    funcs = func(ctx, **params)
+                    setup, target = funcs[:2]
+                    if setup: setup()
+                    target()
+
+                    times = []
+                    for _ in range(repeat):
+                        if setup: setup()
+                        start = time.time()
+                        target()
+                        times.append(time.time() - start)
+
+                    result = {
+                        "name": name,
+                        "params": params,
+                        "times": times,
+                        "min": min(times),
+                        "median": float(np.median(times))
+                    }
+                    if len(funcs) > 2:
+                        result.update(funcs[2]())
+                    results.append(result)
+                    if verbose:
+                        print("%-28s %-40s %10.4fs" % (name,
+                            json.dumps(params, sort_keys=True), result["median"]))
+        finally:
+            ctx.close()
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "quick": quick
+        },
+        "results": results
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true",
+        help="only run the smaller sizes")
+    parser.add_argument("--filter", dest="name_filter",
+        help="only run benchmarks whose name contains this string")
+    args = parser.parse_args(argv)
+
+    report = run(repeat=args.repeat, quick=args.quick,
+        name_filter=args.name_filter)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""Backfill and cache warming of the tile archive
+
+A backfill fetches every tile of a region, a range of zoom levels and a date
+range into the file cache of getimage ahead of time, so historical runs and
+notebooks read tiles from disk instead of downloading them cell by cell.
+
+plan() writes a manifest of the tiles which are not cached yet. run() fetches
+them with a bounded number of threads and at most a given number of requests
+per second, and appends every tile it is done with to a checkpoint file next
+to the manifest, so an interrupted backfill resumes where it stopped. Tiles
+which failed are tried again by the next run.
+
+warm() fetches the tiles of the last days, which is meant to be run from a
+scheduler ahead of the daily jobs, so interactive use never waits on the
+network.
+
+Usage:
+    python -m nightflare backfill --manifest ca.json --region CA --from 2017-01-01 --to 2018-01-31 --zooms 6-7
+    python -m nightflare backfill --region CA --warm 1
+"""
+from __future__ import print_function
+import datetime
+import json
+import os
+import threading
+import time
+import batch
+import getimage
+import instrument
+
+_image_layer = "VIIRS_SNPP_DayNightBand_ENCC"
+_mask_layer = "OSM_Land_Mask"
+
+class RateLimiter(object):
+
+    """Token bucket limiting the rate of requests of several threads
+
+    Attributes:
+        burst (int): Number of requests which may start at once
+        rate (float): Requests per second
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may start
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst,
+                    self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def region_tiles(tileMatrix, tileCol, tileRow, num_cols, num_rows, zoom):
+    """Tiles covering a region at another zoom level
+
+    Every zoom level halves the tiles of the one above, so the region keeps
+    its extent, rounded out to whole tiles at lower zoom levels.
+
+    Args:
+        tileMatrix (int): Zoom in level of the region
+        tileCol (int): Column of the top left tile
+        tileRow (int): Row of the top left tile
+        num_cols (int): Number of tile columns
+        num_rows (int): Number of tile rows
+        zoom (int): The other zoom level
+
+    Returns:
+        tuple: Column and row of the top left tile, number of columns and
+            number of rows at the zoom level
+    """
+    if zoom >= tileMatrix:
+        f = 2 ** (zoom - tileMatrix)
+        return tileCol * f, tileRow * f, num_cols * f, num_rows * f
+    f = 2 ** (tileMatrix - zoom)
+    col, row = tileCol // f, tileRow // f
+    return (col, row, -(-(tileCol + num_cols) // f) - col,
+        -(-(tileRow + num_rows) // f) - row)
+
+def _tiles(region, zooms, dates, masks):
+    r = batch.REGIONS[region]
+    tiles = []
+    for zoom in zooms:
+        col, row, num_cols, num_rows = region_tiles(r["tileMatrix"],
+            r["tileCol"], r["tileRow"], r["num_cols"], r["num_rows"], zoom)
+        cells = [(c, rw) for rw in range(row, row + num_rows)
+            for c in range(col, col + num_cols)]
+        if masks:
+            tiles.extend((_mask_layer, zoom, c, rw, None) for c, rw in cells)
+        tiles.extend((_image_layer, zoom, c, rw, date)
+            for date in dates for c, rw in cells)
+    return tiles
+
+def _missing(tiles):
+    return [t for t in tiles if not getimage.is_cached(*t)]
+
+def _checkpoint_path(manifest):
+    return manifest + ".done"
+
+def plan(manifest, region="CA", zooms=None, start_date="2017-01-01",
+        end_date="2017-01-31", masks=True):
+    """Write the manifest of the tiles of a backfill which are not cached
+
+    Args:
+        manifest (str): File name of the manifest
+        region (str, optional): Name of the region in batch.REGIONS
+        zooms (list, optional): Zoom levels. Defaults to the zoom level of
+            the region.
+        start_date (str, optional): First date, in iso format
+        end_date (str, optional): Last date, in iso format, inclusive
+        masks (bool, optional): Also fetch the land masks
+
+    Returns:
+        int: Number of tiles to fetch
+    """
+    if region not in batch.REGIONS:
+        raise ValueError("Unknown region %s" % region)
+    zooms = list(zooms or [batch.REGIONS[region]["tileMatrix"]])
+    dates = getimage.date_range(start_date, end_date=end_date)
+    with instrument.span("backfill_plan"):
+        tiles = _missing(_tiles(region, zooms, dates, masks))
+
+    params = {"region": region, "zooms": zooms, "start_date": start_date,
+        "end_date": end_date, "masks": masks}
+    manifest = os.path.abspath(manifest)
+    batch.atomic_write(manifest, lambda fname: _dump(fname,
+        {"params": params, "tiles": tiles}))
+    # A new manifest starts without progress
+    if os.path.exists(_checkpoint_path(manifest)):
+        os.remove(_checkpoint_path(manifest))
+    return len(tiles)
+
+def _dump(fname, obj):
+    with open(fname, "w") as f:
+        json.dump(obj, f)
+
+def load(manifest):
+    """Read a manifest and its progress
+
+    Args:
+        manifest (str): File name of the manifest
+
+    Returns:
+        tuple: The parameters of the backfill, the list of its tiles and the
+            set of tiles done, each a (layer, zoom, column, row, date) tuple
+    """
+    with open(manifest) as f:
+        content = json.load(f)
+    done = set()
+    try:
+        with open(_checkpoint_path(manifest)) as f:
+            for line in f:
+                try:
+                    done.add(tuple(json.loads(line)))
+                except ValueError:
+                    # Last line of a run which was killed while writing it
+                    pass
+    except (OSError, IOError):
+        pass
+    return content["params"], [tuple(t) for t in content["tiles"]], done
+
+def fetch(tiles, jobs=8, rate=None, done=None, limit=None, verbose=True):
+    """Fetch tiles into the file cache
+
+    Args:
+        tiles (list): (layer, zoom, column, row, date) of every tile
+        jobs (int, optional): Number of tiles fetched at the same time
+        rate (float, optional): Most requests started per second, no limit
+            by default
+        done (callable, optional): Called with every tile fetched or found
+            cached, from the fetching threads
+        limit (int, optional): Stop after this many tiles
+        verbose (bool, optional): Print progress now and then
+
+    Returns:
+        dict: Number of tiles "fetched", "cached" (found cached meanwhile)
+            and "failed", and the "errors" of the failed tiles
+    """
+    tiles = list(tiles)[:limit]
+    limiter = RateLimiter(rate) if rate else None
+    lock = threading.Lock()
+    pending = iter(tiles)
+    result = {"fetched": 0, "cached": 0, "failed": 0, "errors": []}
+
+    def work():
+        while True:
+            with lock:
+                tile = next(pending, None)
+            if tile is None:
+                return
+            if getimage.is_cached(*tile):
+                status = "cached"
+            else:
+                if limiter:
+                    limiter.acquire()
+                try:
+                    getimage.fetch_tile(*tile)
+                    status = "fetched"
+                except Exception as e:
+                    # Tiles may not be published yet or the server may be
+                    # down, the next run tries them again
+                    status = "failed"
+                    with lock:
+                        result["errors"].append((tile, repr(e)))
+            instrument.count("backfill_tiles", status=status)
+            with lock:
+                result[status] += 1
+                if status != "failed" and done:
+                    done(tile)
+                count = result["fetched"] + result["cached"] + result["failed"]
+                if verbose and count % 1000 == 0:
+                    print("%d/%d tiles, %d failed" % (count, len(tiles), result["failed"]))
+
+    threads = [threading.Thread(target=work) for _ in range(max(1, min(jobs, len(tiles))))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return result
+
+def run(manifest, jobs=8, rate=None, limit=None, verbose=True):
+    """Fetch the tiles of a manifest which are not done yet
+
+    Every tile fetched is appended to the checkpoint file of the manifest as
+    soon as it is in the cache, so killing the run loses no work.
+
+    Args:
+        manifest (str): File name of the manifest, see plan
+        jobs (int, optional): Number of tiles fetched at the same time
+        rate (float, optional): Most requests started per second
+        limit (int, optional): Stop after this many tiles, e.g. to spread a
+            backfill over several scheduled runs
+        verbose (bool, optional): Print progress
+
+    Returns:
+        dict: See fetch, with the number of tiles "left" after the run
+    """
+    _, tiles, done = load(manifest)
+    todo = [t for t in tiles if t not in done]
+    with open(_checkpoint_path(manifest), "a") as checkpoint:
+        def record(tile):
+            checkpoint.write(json.dumps(list(tile)) + "\n")
+            checkpoint.flush()
+        with instrument.span("backfill_run"):
+            result = fetch(todo, jobs, rate, record, limit, verbose)
+    result["left"] = len(todo) - result["fetched"] - result["cached"]
+    if verbose:
+        print("%d tiles fetched, %d already cached, %d failed, %d left." % (
+            result["fetched"], result["cached"], result["failed"], result["left"]))
+    return result
+
+def warm(region="CA", zooms=None, days=1, lag=1, today=None, masks=True,
+        jobs=8, rate=None, verbose=True):
+    """Fetch the tiles of the last days which are not cached
+
+    Meant to run from a scheduler ahead of the daily jobs. Tiles which are
+    not published yet fail and are fetched by the next run.
+
+    Args:
+        region (str, optional): Name of the region in batch.REGIONS
+        zooms (list, optional): Zoom levels. Defaults to the zoom level of
+            the region.
+        days (int, optional): Number of days
+        lag (int, optional): Days between the last day and today, 1 ends
+            with yesterday
+        today (datetime.date, optional): Today, in UTC by default
+        masks (bool, optional): Also fetch the land masks
+        jobs (int, optional): Number of tiles fetched at the same time
+        rate (float, optional): Most requests started per second
+        verbose (bool, optional): Print progress
+
+    Returns:
+        dict: See fetch
+
+    Raises:
+        ValueError: Unknown region, or days is less than 1
+    """
+    if region not in batch.REGIONS:
+        raise ValueError("Unknown region %s" % region)
+    if days < 1:
+        raise ValueError("days must be at least 1, not %d" % days)
+    today = today or datetime.datetime.utcnow().date()
+    end = today - datetime.timedelta(days=lag)
+    dates = [(end - datetime.timedelta(days=i)).isoformat()
+        for i in reversed(range(days))]
+    zooms = list(zooms or [batch.REGIONS[region]["tileMatrix"]])
+    with instrument.span("backfill_warm"):
+        tiles = _missing(_tiles(region, zooms, dates, masks))
+        result = fetch(tiles, jobs, rate, verbose=verbose)
+    if verbose:
+        print("%d tiles of %s to %s fetched, %d failed." % (
+            result["fetched"], dates[0], dates[-1], result["failed"]))
+    return result
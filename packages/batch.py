@@ -0,0 +1,570 @@
+"""Batch pipeline computing monthly regional statistics
+
+A month of a region is computed as a small graph of tasks: fetching the raw
+tiles of each tile, compositing each tile, mosaicking the composites and
+aggregating them by city, and appending the mosaic to the datacube of the
+region. Tasks whose outputs already exist are left out of the graph, so an
+interrupted run resumes where it stopped and a repeated run only computes
+what is missing.
+"""
+from __future__ import print_function
+import datetime
+import json
+import os
+import threading
+import traceback
+import numpy as np
+import columnar
+import conversion
+import datacube
+import getimage
+import improcess
+
+# Shared tile store of the batch pipeline and of queue workers. Workers on
+# several machines need it on a shared file system.
+_batch_cache_path = os.environ.get("NIGHTFLARE_BATCH_CACHE", os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "batch.cache"))
+
+def set_cache_dir(path):
+    """Set the directory of the shared tile store, batch.cache next to this
+    module by default. It can also be set with the NIGHTFLARE_BATCH_CACHE
+    environment variable.
+
+    Args:
+        path (str): Cache directory, created on the first write
+    """
+    global _batch_cache_path
+    _batch_cache_path = path
+
+# Default directory of the monthly statistics
+DATA_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "data")
+
+REGIONS = {
+    "CA": {
+        "tileMatrix": 6,
+        "tileCol": 12,
+        "tileRow": 10,
+        "num_cols": 3,
+        "num_rows": 3,
+        "cities": ['Los Angeles', 'San Diego', 'San Jose', 'San Francisco',
+            'Fresno', 'Sacramento', 'Long Beach', 'Oakland', 'Bakersfield',
+            'Anaheim', 'La Jolla', 'Irvine', 'San Bernardino', 'Riverside',
+            'Santa Barbara']
+    }
+}
+
+# Processed image of a tile of every image processing method
+METHODS = {
+    "clip": improcess.get_processed_image_clip,
+    "band_reject": improcess.get_processed_image_band_reject
+}
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def atomic_write(fname, write):
+    """Call write with a temporary file name, then move it to fname
+
+    Args:
+        fname (str): Final file name
+        write (callable): Function writing to the file name it is given
+    """
+    _makedirs(os.path.dirname(fname))
+    base, ext = os.path.splitext(fname)
+    tmp_fname = "%s.%d.%d.tmp%s" % (base, os.getpid(),
+        threading.current_thread().ident, ext)
+    write(tmp_fname)
+    os.rename(tmp_fname, fname)
+
+def month_range(start_month, end_month):
+    """List the first day of every month between two months
+
+    Args:
+        start_month (str): First month, "YYYY-MM"
+        end_month (str): Last month, "YYYY-MM", inclusive
+
+    Returns:
+        list: Dates in iso format
+    """
+    year, month = [int(x) for x in start_month.split("-")[:2]]
+    end_year, end_month = [int(x) for x in end_month.split("-")[:2]]
+
+    dates = []
+    while (year, month) <= (end_year, end_month):
+        dates.append(datetime.date(year, month, 1).isoformat())
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return dates
+
+class Task(object):
+
+    """A unit of work in a task graph
+
+    Attributes:
+        deps (list): Tasks that must finish before this one starts
+        func (callable): Function doing the work, called without arguments
+        name (str): Unique name of the task
+    """
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+
+class Graph(object):
+
+    """Task graph executed by a pool of threads
+
+    Independent tasks run concurrently. A task starts once all of its
+    dependencies have finished. When a task fails, the tasks depending on it
+    are skipped and the rest of the graph still runs.
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, name, func, deps=()):
+        """Add a task to the graph
+
+        Args:
+            name (str): Unique name of the task
+            func (callable): Function doing the work
+            deps (list, optional): Tasks that must finish first
+
+        Returns:
+            Task: The new task
+        """
+        task = Task(name, func, deps)
+        self.tasks.append(task)
+        return task
+
+    def run(self, jobs=4, verbose=True):
+        """Run all tasks of the graph
+
+        Args:
+            jobs (int, optional): Number of tasks running at the same time
+            verbose (bool, optional): Print a line when a task finishes
+
+        Raises:
+            RuntimeError: At least one task failed, or some tasks can never
+                start because they depend on a task missing from the graph
+                or on themselves through a cycle
+        """
+        cond = threading.Condition()
+        pending = list(self.tasks)
+        running = set()
+        done = set()
+        failed = set()
+
+        def ready(task):
+            return all(dep in done for dep in task.deps)
+
+        def blocked(task):
+            return any(dep in failed for dep in task.deps)
+
+        def worker():
+            while True:
+                with cond:
+                    while True:
+                        changed = True
+                        while changed:
+                            changed = False
+                            for task in list(pending):
+                                if blocked(task):
+                                    pending.remove(task)
+                                    failed.add(task)
+                                    changed = True
+
+                        task = next((t for t in pending if ready(t)), None)
+                        if task is not None:
+                            pending.remove(task)
+                            running.add(task)
+                            break
+                        if not running:
+                            cond.notify_all()
+                            return
+                        cond.wait()
+
+                try:
+                    task.func()
+                except Exception:
+                    traceback.print_exc()
+                    with cond:
+                        running.discard(task)
+                        failed.add(task)
+                        cond.notify_all()
+                    if verbose:
+                        print("%s Failed." % task.name)
+                else:
+                    with cond:
+                        running.discard(task)
+                        done.add(task)
+                        cond.notify_all()
+                    if verbose:
+                        print("%s Finished." % task.name)
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, jobs))]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        if failed:
+            raise RuntimeError("%d tasks failed: %s" % (len(failed),
+                ", ".join(sorted(task.name for task in failed))))
+        if pending:
+            raise RuntimeError("%d tasks can never start: %s" % (len(pending),
+                ", ".join(sorted(task.name for task in pending))))
+
+def composite_path(region, method, start_date, num_days, tileMatrix, tileCol, tileRow):
+    """Path of a cached tile composite
+
+    Returns:
+        str: File name of the composite
+    """
+    key = "%s_%s_%s_%s_%s_%s" % (
+        method, start_date, num_days, tileMatrix, tileCol, tileRow)
+    return os.path.join(_batch_cache_path, region, "%s.npy" % key)
+
+def cube_path(region, method, num_days):
+    """Path of the datacube of the monthly mosaics of a region
+
+    Returns:
+        str: Directory of the cube
+    """
+    return os.path.join(_batch_cache_path, region,
+        "%s_%s.cube" % (method, num_days))
+
+def open_cube(region="CA", method="clip", num_days=31):
+    """Open the datacube of the monthly mosaics of a region
+
+    Args:
+        region (str, optional): Name of the region in REGIONS
+        method (str, optional): Image processing method, "clip" or
+            "band_reject"
+        num_days (int, optional): Number of days of each composite
+
+    Returns:
+        datacube.DataCube: The cube, labelled by the first day of each month
+    """
+    r = REGIONS[region]
+    return datacube.DataCube.open_or_create(cube_path(region, method, num_days),
+        height=r["num_rows"] * 512, width=r["num_cols"] * 512)
+
+OUTPUT_FORMATS = ["csv", "parquet"]
+
+def output_path(start_date, output_dir=None, region="CA", output_format="csv"):
+    """Path of the monthly statistics of major cities
+
+    Csv files are named after the month. Parquet files are partitions of the
+    major_cities dataset of columnar, by month and region.
+
+    Returns:
+        str: File name of the csv or Parquet file
+    """
+    output_dir = output_dir or DATA_PATH
+    if output_format == "parquet":
+        return columnar.partition_file(os.path.join(output_dir, "major_cities"),
+            start_date, region)
+    return os.path.join(output_dir, "%s_major_cities.csv" % start_date)
+
+def _params_path(fname):
+    return fname + ".params.json"
+
+def output_params(method, num_days):
+    """Parameters monthly statistics are computed with, which their file
+    names do not tell
+
+    Returns:
+        dict: The parameters
+    """
+    return {"method": method, "num_days": num_days}
+
+def is_up_to_date(fname, method, num_days):
+    """Whether monthly statistics exist and were computed with the given
+    parameters, according to the parameter file written next to them
+
+    Args:
+        fname (str): File name of the statistics, see output_path
+        method (str): Image processing method
+        num_days (int): Number of days of each composite
+
+    Returns:
+        bool: The file exists and its parameters match
+    """
+    try:
+        with open(_params_path(fname)) as f:
+            params = json.load(f)
+    except (OSError, IOError, ValueError):
+        return False
+    return os.path.isfile(fname) and params == output_params(method, num_days)
+
+def _write_output(fname, df, method, num_days):
+    """Write monthly statistics in the format of their file name, then their
+    parameter file
+    """
+    # A run killed while writing must not leave the parameters of the
+    # previous statistics next to new ones
+    if os.path.exists(_params_path(fname)):
+        os.remove(_params_path(fname))
+    if fname.endswith(".parquet"):
+        columnar.write_file(fname, df)
+    else:
+        atomic_write(fname, df.to_csv)
+    atomic_write(_params_path(fname), lambda tmp_fname: _dump_json(
+        tmp_fname, output_params(method, num_days)))
+
+def _dump_json(fname, obj):
+    with open(fname, "w") as f:
+        json.dump(obj, f)
+
+def fetch_tile(tileMatrix, tileCol, tileRow, start_date, num_days):
+    """Fetch the land mask and the raw images of a tile into the getimage
+    cache
+
+    Args:
+        tileMatrix (int): Zoom in level
+        tileCol (int): Column
+        tileRow (int): Row
+        start_date (str): Start date of the composite
+        num_days (int): Number of days of the composite
+    """
+    getimage.get_mask(tileMatrix=tileMatrix, tileCol=tileCol, tileRow=tileRow)
+    getimage.get_image_date_range(
+        start_date=start_date,
+        num_days=num_days,
+        tileMatrix=tileMatrix,
+        tileCol=tileCol,
+        tileRow=tileRow)
+
+def composite_tile(fname, method, tileMatrix, tileCol, tileRow, start_date, num_days):
+    """Process the composite of a tile and save it, see composite_path
+
+    Args:
+        fname (str): File name of the composite
+        method (str): Image processing method, "clip" or "band_reject"
+        tileMatrix (int): Zoom in level
+        tileCol (int): Column
+        tileRow (int): Row
+        start_date (str): Start date of the composite
+        num_days (int): Number of days of the composite
+    """
+    image = METHODS[method](
+        start_date=start_date,
+        num_days=num_days,
+        tileMatrix=tileMatrix,
+        tileCol=tileCol,
+        tileRow=tileRow)
+    atomic_write(fname, lambda tmp_fname: np.save(tmp_fname, image))
+
+def mosaic(region, method, start_date, num_days):
+    """Assemble the cached composites of a region
+
+    Args:
+        region (str): Name of the region in REGIONS
+        method (str): Image processing method, "clip" or "band_reject"
+        start_date (str): Start date of the composites
+        num_days (int): Number of days of the composites
+
+    Returns:
+        im (np.ndarray): The processed light pollution map of the region.
+        mask (np.ndarray): The mask for the land (ocean = 0, land = 1).
+    """
+    r = REGIONS[region]
+    im = []
+    mask = []
+    for j in range(r["num_rows"]):
+        im_row = []
+        mask_row = []
+        for i in range(r["num_cols"]):
+            tile = (r["tileMatrix"], r["tileCol"] + i, r["tileRow"] + j)
+            im_row.append(np.load(composite_path(
+                region, method, start_date, num_days, *tile)))
+            mask_row.append(getimage.get_mask(*tile))
+        im.append(np.concatenate(im_row, axis=1))
+        mask.append(np.concatenate(mask_row, axis=1))
+    return np.concatenate(im, axis=0), np.concatenate(mask, axis=0)
+
+def aggregate(fname, region, method, start_date, num_days):
+    """Monthly statistics of major cities from the mosaic of the cached
+    composites of a region, written with their parameter file
+
+    Args:
+        fname (str): File name of the statistics, see output_path
+        region (str): Name of the region in REGIONS
+        method (str): Image processing method
+        start_date (str): Start date of the composites
+        num_days (int): Number of days of the composites
+    """
+    r = REGIONS[region]
+    im, mask = mosaic(region, method, start_date, num_days)
+    df = conversion.geodecode_region(r["tileMatrix"], r["tileCol"], r["tileRow"],
+        im, mask, city=r["cities"])
+    df_mean = df.groupby(['Region'])['Light Pollution'].mean().reset_index()
+    df_mean['Time'] = start_date[:7]
+    _write_output(fname, df_mean, method, num_days)
+
+def zonal_path(region, method, start_date, num_days, tileMatrix, tileCol, tileRow):
+    """Path of the partial statistics of major cities within a tile
+
+    Returns:
+        str: File name of the csv file
+    """
+    key = "%s_%s_%s_%s_%s_%s" % (
+        method, start_date, num_days, tileMatrix, tileCol, tileRow)
+    return os.path.join(_batch_cache_path, region, "%s.zonal.csv" % key)
+
+def zonal_tile(fname, region, method, start_date, num_days, tileMatrix, tileCol, tileRow):
+    """Sum and number of pixels of every major city within a cached tile
+    composite, to be merged with the other tiles by merge_zonal
+
+    Args:
+        fname (str): File name of the partial statistics, see zonal_path
+        region (str): Name of the region in REGIONS
+        method (str): Image processing method
+        start_date (str): Start date of the composite
+        num_days (int): Number of days of the composite
+        tileMatrix (int): Zoom in level
+        tileCol (int): Column
+        tileRow (int): Row
+    """
+    image = np.load(composite_path(region, method, start_date, num_days,
+        tileMatrix, tileCol, tileRow))
+    mask = getimage.get_mask(tileMatrix, tileCol, tileRow)
+    df = conversion.geodecode_region(tileMatrix, tileCol, tileRow, image, mask,
+        city=REGIONS[region]["cities"])
+    partial = df.groupby(['Region'])['Light Pollution'].agg(['sum', 'count'])
+    atomic_write(fname, partial.to_csv)
+
+def merge_zonal(fname, region, method, start_date, num_days):
+    """Monthly statistics of major cities from the partial statistics of all
+    tiles of a region, like aggregate
+
+    Args:
+        fname (str): File name of the statistics, see output_path
+        region (str): Name of the region in REGIONS
+        method (str): Image processing method
+        start_date (str): Start date of the composites
+        num_days (int): Number of days of the composites
+    """
+    import pandas as pd
+    r = REGIONS[region]
+    total = None
+    for j in range(r["num_rows"]):
+        for i in range(r["num_cols"]):
+            tile = (r["tileMatrix"], r["tileCol"] + i, r["tileRow"] + j)
+            partial = pd.read_csv(zonal_path(
+                region, method, start_date, num_days, *tile), index_col=0)
+            total = partial if total is None else total.add(partial, fill_value=0)
+    df_mean = (total['sum'] / total['count']).rename('Light Pollution')
+    df_mean = df_mean.rename_axis('Region').reset_index()
+    df_mean['Time'] = start_date[:7]
+    _write_output(fname, df_mean, method, num_days)
+
+def _store(cube, region, method, start_date, num_days):
+    im, _ = mosaic(region, method, start_date, num_days)
+    cube.append(im, start_date)
+
+def build_graph(
+        region="CA",
+        start_month="2017-01",
+        end_month="2018-01",
+        method="clip",
+        num_days=31,
+        output_dir=None,
+        output_format="csv",
+        force=False):
+    """Build the task graph of the monthly statistics of a region
+
+    Months whose csv file exists with the same method and number of days
+    and whose mosaic is in the datacube are left out, as are composites
+    which are already cached, so the graph only contains the work still to
+    be done. Mosaics are appended to the datacube one month after the other.
+
+    Args:
+        region (str, optional): Name of the region in REGIONS
+        start_month (str, optional): First month, "YYYY-MM"
+        end_month (str, optional): Last month, "YYYY-MM", inclusive
+        method (str, optional): Image processing method, "clip" or
+            "band_reject"
+        num_days (int, optional): Number of days of each composite
+        output_dir (str, optional): Directory of the csv files. Defaults to
+            the data directory of the repository.
+        output_format (str, optional): "csv" for one csv file per month, or
+            "parquet" for a columnar dataset partitioned by month and region
+        force (bool, optional): Recompute outputs which already exist
+
+    Returns:
+        Graph: The task graph
+    """
+    if region not in REGIONS:
+        raise ValueError("Unknown region %s" % region)
+    if method not in METHODS:
+        raise ValueError("Unknown method %s" % method)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format %s" % output_format)
+
+    r = REGIONS[region]
+    cube = open_cube(region, method, num_days)
+    graph = Graph()
+    store = None
+    for start_date in month_range(start_month, end_month):
+        fname = output_path(start_date, output_dir, region, output_format)
+        need_csv = force or not is_up_to_date(fname, method, num_days)
+        need_cube = force or start_date not in cube.times
+        if not (need_csv or need_cube):
+            continue
+
+        prefetch = []
+        composites = []
+        for j in range(r["num_rows"]):
+            for i in range(r["num_cols"]):
+                tile = (r["tileMatrix"], r["tileCol"] + i, r["tileRow"] + j)
+                tile_fname = composite_path(
+                    region, method, start_date, num_days, *tile)
+                if not force and os.path.isfile(tile_fname):
+                    continue
+
+                # In "region" mode the raw tiles of the whole region are
+                # fetched first, one request per day
+                if not prefetch and getimage.get_fetch_mode() == "region":
+                    prefetch.append(graph.add("prefetch %s %s" % (region, start_date),
+                        lambda start_date=start_date: getimage.prefetch_region(
+                            r["tileMatrix"], r["tileCol"], r["tileRow"],
+                            r["num_cols"], r["num_rows"], start_date=start_date,
+                            num_days=num_days, end_date=None)))
+
+                name = "%s %s %s_%s_%s" % ((region, start_date) + tile)
+                fetch = graph.add("fetch " + name,
+                    lambda tile=tile, start_date=start_date:
+                        fetch_tile(*tile, start_date=start_date, num_days=num_days),
+                    deps=prefetch)
+                composites.append(graph.add("composite " + name,
+                    lambda tile=tile, start_date=start_date, tile_fname=tile_fname:
+                        composite_tile(tile_fname, method, *tile,
+                            start_date=start_date, num_days=num_days),
+                    deps=[fetch]))
+
+        if need_csv:
+            graph.add("aggregate %s %s" % (region, start_date),
+                lambda fname=fname, start_date=start_date:
+                    aggregate(fname, region, method, start_date, num_days),
+                deps=composites)
+        if need_cube:
+            store = graph.add("store %s %s" % (region, start_date),
+                lambda start_date=start_date:
+                    _store(cube, region, method, start_date, num_days),
+                deps=composites + ([store] if store else []))
+    return graph
+
+def run(jobs=4, verbose=True, **kwargs):
+    """Compute the monthly statistics of a region
+
+    Args:
+        jobs (int, optional): Number of tasks running at the same time
+        verbose (bool, optional): Print a line when a task finishes
+        **kwargs: Extra parameters passed to build_graph
+    """
+    build_graph(**kwargs).run(jobs=jobs, verbose=verbose)
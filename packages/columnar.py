@@ -0,0 +1,234 @@
+"""Columnar Parquet datasets partitioned by month and region
+
+A dataset is a directory with one sub-directory per month and region, named
+like Hive partitions:
+
+    major_cities/month=2017-01/region=CA/part-0.parquet
+
+Place names repeat on every row, so the Region, County, State and Country
+columns are stored dictionary encoded and read back as pandas categoricals.
+Readers only open the partitions of the months and regions asked for, and
+only read the byte ranges of the columns asked for, so a multi-year trend of
+one column reads a fraction of the dataset. pyarrow is only imported when a
+dataset is written or read.
+
+Usage:
+    columnar.write(df, "data/pixels", "2017-01", "CA")
+    df = columnar.read("data/pixels", columns=["County", "Light Pollution"],
+        start_month="2017-01", end_month="2018-12")
+"""
+import os
+import threading
+import instrument
+
+# Columns of place names, stored dictionary encoded
+DICTIONARY_COLUMNS = ["Region", "County", "State", "Country"]
+
+# Columns read from the partition directory names
+PARTITION_COLUMNS = ["month", "region"]
+
+_extension = ".parquet"
+
+def partition_path(root, month, region):
+    """Directory of the partition of a month and region
+
+    Args:
+        root (str): Directory of the dataset
+        month (str): Month, "YYYY-MM". Dates are cut to their month.
+        region (str): Name of the region, e.g. "CA"
+
+    Returns:
+        str: The directory
+    """
+    return os.path.join(root, "month=%s" % month[:7], "region=%s" % region)
+
+def partition_file(root, month, region, part="part-0"):
+    """File of a partition
+
+    Args:
+        root (str): Directory of the dataset
+        month (str): Month, "YYYY-MM"
+        region (str): Name of the region
+        part (str, optional): Name of the file within the partition, for
+            partitions written in several parts
+
+    Returns:
+        str: The file name
+    """
+    return os.path.join(partition_path(root, month, region), part + _extension)
+
+def _to_table(df):
+    import pandas as pd
+    import pyarrow as pa
+    df = df.copy()
+    for name in df.columns:
+        if name in DICTIONARY_COLUMNS and not isinstance(
+                df[name].dtype, pd.CategoricalDtype):
+            df[name] = df[name].astype("category")
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def write_file(fname, df, compression="zstd"):
+    """Write a dataframe to a Parquet file, atomically
+
+    Args:
+        fname (str): File name
+        df (pd.DataFrame): The dataframe. Its index is not written.
+        compression (str, optional): Parquet compression codec
+    """
+    import pyarrow.parquet as pq
+    table = _to_table(df)
+    path = os.path.dirname(fname)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    tmp_fname = "%s.%d.%d.tmp" % (fname, os.getpid(),
+        threading.current_thread().ident)
+    try:
+        pq.write_table(table, tmp_fname, compression=compression)
+        os.rename(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+    instrument.count("columnar_rows_written", table.num_rows)
+
+def write(df, root, month, region, part="part-0", compression="zstd"):
+    """Write a dataframe as the partition of a month and region
+
+    Args:
+        df (pd.DataFrame): The dataframe, e.g. returned by
+            conversion.geodecode_region
+        root (str): Directory of the dataset
+        month (str): Month, "YYYY-MM"
+        region (str): Name of the region
+        part (str, optional): Name of the file within the partition. Writing
+            the same part again replaces it.
+        compression (str, optional): Parquet compression codec
+
+    Returns:
+        str: The file written
+    """
+    fname = partition_file(root, month, region, part)
+    write_file(fname, df, compression)
+    return fname
+
+def _partition_values(name, entry):
+    prefix = name + "="
+    return entry[len(prefix):] if entry.startswith(prefix) else None
+
+def files(root, start_month=None, end_month=None, regions=None):
+    """Files of the partitions of a range of months and of some regions
+
+    Partitions are pruned by their directory names, other directories are
+    not listed.
+
+    Args:
+        root (str): Directory of the dataset
+        start_month (str, optional): First month, "YYYY-MM"
+        end_month (str, optional): Last month, "YYYY-MM", inclusive
+        regions (list, optional): Names of the regions. None gives all.
+
+    Returns:
+        list: (month, region, file name) of every file, in month order
+    """
+    if not os.path.isdir(root):
+        return []
+    if isinstance(regions, str):
+        regions = [regions]
+    result = []
+    for month_entry in sorted(os.listdir(root)):
+        month = _partition_values("month", month_entry)
+        if month is None:
+            continue
+        if start_month and month < start_month[:7]:
+            continue
+        if end_month and month > end_month[:7]:
+            continue
+        month_path = os.path.join(root, month_entry)
+        for region_entry in sorted(os.listdir(month_path)):
+            region = _partition_values("region", region_entry)
+            if region is None or (regions is not None and region not in regions):
+                continue
+            region_path = os.path.join(month_path, region_entry)
+            for fname in sorted(os.listdir(region_path)):
+                if fname.endswith(_extension):
+                    result.append((month, region, os.path.join(region_path, fname)))
+    return result
+
+def read(root, columns=None, start_month=None, end_month=None, regions=None):
+    """Read a range of months and some regions of a dataset
+
+    Args:
+        root (str): Directory of the dataset
+        columns (list, optional): Columns to read, which may include the
+            partition columns "month" and "region". None reads all columns.
+        start_month (str, optional): First month, "YYYY-MM"
+        end_month (str, optional): Last month, "YYYY-MM", inclusive
+        regions (list, optional): Names of the regions. None gives all.
+
+    Returns:
+        pd.DataFrame: Rows of the partitions in month order. Place name
+            columns are categoricals.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    data_columns = None
+    if columns is not None:
+        data_columns = [c for c in columns if c not in PARTITION_COLUMNS]
+
+    tables = []
+    for month, region, fname in files(root, start_month, end_month, regions):
+        table = pq.read_table(fname, columns=data_columns)
+        for name, value in zip(PARTITION_COLUMNS, (month, region)):
+            if columns is None or name in columns:
+                table = table.append_column(name, pa.DictionaryArray.from_arrays(
+                    pa.array([0] * table.num_rows, pa.int32()), pa.array([value])))
+        tables.append(table)
+        instrument.count("columnar_files_read")
+    if not tables:
+        return pd.DataFrame(columns=columns or [])
+    # Dictionaries differ between files and are unified when concatenated
+    table = pa.concat_tables(tables, promote_options="permissive").unify_dictionaries()
+    df = table.to_pandas()
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+def bytes_to_read(root, columns=None, start_month=None, end_month=None, regions=None):
+    """Number of compressed bytes read by read() with the same arguments
+
+    Returns:
+        int: Size of the column chunks read
+    """
+    import pyarrow.parquet as pq
+    total = 0
+    for _, _, fname in files(root, start_month, end_month, regions):
+        metadata = pq.ParquetFile(fname).metadata
+        for i in range(metadata.num_row_groups):
+            group = metadata.row_group(i)
+            for j in range(group.num_columns):
+                chunk = group.column(j)
+                name = chunk.path_in_schema.split(".")[0]
+                if columns is None or name in columns:
+                    total += chunk.total_compressed_size
+    return total
+
+def import_csv(fname, root, region, part="part-0"):
+    """Copy a monthly csv file of the batch pipeline into a dataset
+
+    Args:
+        fname (str): The csv file, e.g. data/2017-01-01_major_cities.csv
+        root (str): Directory of the dataset
+        region (str): Name of the region of the file
+        part (str, optional): Name of the file within the partition
+
+    Returns:
+        str: The file written
+    """
+    import pandas as pd
+    df = pd.read_csv(fname, index_col=0)
+    month = str(df["Time"].iloc[0]) if "Time" in df and len(df) else \
+        os.path.basename(fname)[:7]
+    return write(df, root, month, region, part)
@@ -0,0 +1,140 @@
+"""Temporal composites of daily images with missing day handling
+
+A pixel of a day is valid unless it is masked (numpy.ma input or an explicit
+validity mask) or equal to the missing value. Every statistic is computed
+over the valid days of each pixel only, so cloudy or missing days do not drag
+a composite down. Images are processed a block of rows at a time; robust
+statistics sort the few days of each pixel instead of calling
+np.nanpercentile, so they cost little more than the mean.
+
+Constant days, like the broadcast tiles the getimage cache returns for
+empty tiles, are never stacked: days equal to the missing value everywhere
+are dropped up front, and a composite of constant days only is computed
+for a single pixel.
+"""
+import numpy as np
+from precision import get_policy
+
+STATISTICS = ("mean", "median", "trimmed_mean", "percentile")
+
+def _constant_value(image):
+    """Value of an image broadcast from a single value, or None
+    """
+    if np.ma.isMaskedArray(image) or not isinstance(image, np.ndarray):
+        return None
+    if image.size and not any(image.strides):
+        return image.flat[0]
+    return None
+
+def _valid_block(images, valid, rows, missing):
+    stack = np.stack([np.ma.getdata(im)[rows] for im in images])
+    ok = np.ones(stack.shape, bool)
+    for k, im in enumerate(images):
+        if np.ma.isMaskedArray(im):
+            ok[k] &= ~np.ma.getmaskarray(im)[rows]
+        if valid is not None:
+            ok[k] &= np.asarray(valid[k], bool)[rows]
+    if missing is not None:
+        ok &= stack != missing
+    return stack, ok
+
+def _order_statistics(stack, ok, count, statistic, q, trim):
+    # Invalid days sort last, so the valid days of a pixel are the first
+    # count entries of its sorted column.
+    values = np.where(ok, stack, np.inf)
+    values.sort(axis=0)
+    n = np.maximum(count, 1)
+
+    if statistic == "trimmed_mean":
+        cut = (trim * count).astype(np.intp)
+        values[~np.isfinite(values)] = 0
+        csum = np.concatenate((np.zeros((1,) + values.shape[1:]),
+            np.cumsum(values, axis=0)))
+        lo = cut[np.newaxis]
+        hi = (count - cut)[np.newaxis]
+        total = (np.take_along_axis(csum, hi, axis=0) -
+            np.take_along_axis(csum, lo, axis=0))[0]
+        return total / np.maximum(hi[0] - lo[0], 1)
+
+    # Pixels without valid days read inf here and are zeroed by the caller
+    position = (q / 100.0) * (n - 1)
+    lo = np.floor(position).astype(np.intp)
+    hi = np.minimum(lo + 1, n - 1)
+    frac = position - lo
+    v_lo = np.take_along_axis(values, lo[np.newaxis], axis=0)[0]
+    v_hi = np.take_along_axis(values, hi[np.newaxis], axis=0)[0]
+    with np.errstate(invalid="ignore"):
+        return v_lo + (v_hi - v_lo) * frac
+
+def composite(images, statistic="mean", valid=None, missing=None, q=50,
+        trim=0.1, block=64, dtype=None):
+    """Composite a list of daily images into one image
+
+    Args:
+        images (list): Daily images of the same shape. numpy.ma arrays have
+            their masked pixels treated as invalid.
+        statistic (str, optional): "mean", "median", "trimmed_mean" or
+            "percentile"
+        valid (list, optional): Boolean validity mask of every image
+        missing (float, optional): Pixel value marking a missing day, e.g. 0
+            for days GIBS has no data for. None keeps every value.
+        q (float, optional): Percentile for "percentile", between 0 and 100
+        trim (float, optional): Fraction of the valid days cut from each end
+            for "trimmed_mean"
+        block (int, optional): Number of rows processed at a time
+        dtype (np.dtype, optional): Data type of the composite. Defaults to
+            the accumulator type of the default precision policy.
+
+    Returns:
+        image (np.ndarray): The composite. Pixels without any valid day are 0.
+        count (np.ndarray): Number of valid days of every pixel
+
+    Raises:
+        ValueError: Unknown statistic
+    """
+    if statistic not in STATISTICS:
+        raise ValueError("Unknown statistic %s" % statistic)
+    if statistic == "median":
+        statistic, q = "percentile", 50
+
+    if dtype is None:
+        dtype = get_policy().accum
+
+    height, width = np.shape(images[0])
+
+    if valid is None:
+        constants = [_constant_value(im) for im in images]
+        if missing is not None:
+            # Days missing everywhere never count
+            images = [im for im, v in zip(images, constants)
+                if v is None or v != missing]
+            constants = [v for v in constants if v is None or v != missing]
+        if images and all(v is not None for v in constants):
+            pixel, n = composite([np.full((1, 1), v) for v in constants],
+                statistic, missing=missing, q=q, trim=trim, dtype=dtype)
+            return (np.full((height, width), pixel[0, 0], dtype),
+                np.full((height, width), n[0, 0], np.intp))
+
+    image = np.zeros((height, width), dtype)
+    count = np.zeros((height, width), np.intp)
+    if not images:
+        return image, count
+
+    for y in range(0, height, block):
+        rows = slice(y, min(y + block, height))
+        stack, ok = _valid_block(images, valid, rows, missing)
+        stack = stack.astype(dtype)
+        n = ok.sum(axis=0)
+        count[rows] = n
+
+        if statistic == "mean":
+            total = np.where(ok, stack, 0).sum(axis=0)
+            result = total / np.maximum(n, 1)
+        elif ok.all() and statistic == "percentile":
+            result = np.percentile(stack, q, axis=0)
+        else:
+            result = _order_statistics(stack, ok, n, statistic, q, trim)
+
+        result[n == 0] = 0
+        image[rows] = result
+    return image, count
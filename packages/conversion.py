@@ -1,5 +1,5 @@
 import numpy as np
-import pandas as pd
+import instrument
 
 def get_coordinates(tileMatrix, tileCol, tileRow):
     """
@@ -51,7 +51,7 @@ def get_tile_info(latitude, longtitude, tileMatrix):
     return tileRow, tileCol
 
 
-def geodecode_region(tileMatrix, tileCol, tileRow, region, mask, win_size=512, state=None, county=None, city=None):
+def geodecode_region(tileMatrix, tileCol, tileRow, region, mask, win_size=512, state=None, county=None, city=None, offset=(0, 0)):
     """
     To decode the region image into meaningful coordinates and the light pollution level.
 
@@ -65,23 +65,29 @@ def geodecode_region(tileMatrix, tileCol, tileRow, region, mask, win_size=512, s
         state (str, optional): To decode geo information for specific state.
         county (str, optional): To decode geo information for specific county.
         city (str, optional): To decode geo information for specific city.
+        offset (tuple, optional): Row and column in pixels of the region image within the tile.
 
     Returns:
         df (pd.DataFrame): The dataframe contains the geo information for the given region.
     """
+    import pandas as pd
     import reverse_geocoder as rg # Offline geocoder  
     lat, lon = get_coordinates(tileMatrix, tileCol, tileRow)
 
-    coordinates = []
-    for i in range(region.shape[0]):
-        for j in range(region.shape[1]):
-            if mask[i][j] != 0:
-                lat_tmp = lat - (180.0 / (0.625 * (2 ** tileMatrix))) / win_size * i
-                lon_tmp = lon + (360.0 / (1.25 * (2 ** tileMatrix))) / win_size * j
-                coordinates.append((lat_tmp, lon_tmp))
+    # Pixels on land, row by row
+    rows, cols = np.nonzero(np.asarray(mask) != 0)
+    latitudes = lat - (180.0 / (0.625 * (2 ** tileMatrix))) / win_size * (rows + offset[0])
+    longitudes = lon + (360.0 / (1.25 * (2 ** tileMatrix))) / win_size * (cols + offset[1])
+
+    instrument.count("conversion_pixels_geocoded", len(rows))
+    with instrument.span("conversion_geocode"):
+        geocoder = rg.RGeocoder(mode=2, verbose=True)
+        if len(rows):
+            indices = geocoder.query_indices(np.column_stack([latitudes, longitudes]))
+        else:
+            indices = np.zeros(0, np.int64)
+    locations = geocoder.locations
 
-    results = np.array(rg.search(coordinates))
-    #res_reshape = results.reshape(region.shape[0],region.shape[1])
     if state != None:
         select = 'admin1'
         select_item = state
@@ -94,25 +100,201 @@ def geodecode_region(tileMatrix, tileCol, tileRow, region, mask, win_size=512, s
     else:
         select = 'admin1'
         select_item = 'California'
-    
-    info = []
-    cnt = 0  
-    for i in range(region.shape[0]):
-        for j in range(region.shape[1]):
-            if mask[i][j] != 0:
-                if results[cnt][select] in select_item:
-                    info.append([region[i][j],                                      # Light Pollution Level
-                                 results[cnt]['name'],                              # Region
-                                 results[cnt]['admin2'],                            # County
-                                 results[cnt]['admin1'],                            # State
-                                 results[cnt]['cc'],                                # Country
-                                 (results[cnt]['lat'], results[cnt]['lon']),   # Region Coordinates 
-                                 coordinates[cnt][0],                                    # Pixel Latitude
-                                 coordinates[cnt][1]])                                   # Pixel Longtitude
-                    #if  res_reshape[i][j]['admin2'] == '':
-                    #    print(res_reshape[i][j]['lat'], res_reshape[i][j]['lon']), coordinates[cnt][0], coordinates[cnt][1]      
-                cnt += 1
+
+    # Locations are decoded once per distinct location, not once per pixel
+    unique, inverse = np.unique(indices, return_inverse=True)
+    keep = np.array([value in select_item for value in locations.take(select, unique)],
+        dtype=bool)[inverse.ravel()]
+    indices = indices[keep]
     col_names = ['Light Pollution', 'Region', 'County','State', 'Country', 'Region Coordinate', 'Latitude', 'Longtitude']
-    df = pd.DataFrame(info, columns = col_names)
-    #results = np.array([results[i]['name'] for i in range(len(coordinates))]).reshape(512,512)
+    if len(indices):
+        df = pd.DataFrame({
+            'Light Pollution': np.asarray(region)[rows[keep], cols[keep]],     # Light Pollution Level
+            'Region': locations.take('name', indices),                        # Region
+            'County': locations.take('admin2', indices),                      # County
+            'State': locations.take('admin1', indices),                       # State
+            'Country': locations.take('cc', indices),                         # Country
+            'Region Coordinate': list(zip(locations.take('lat', indices),     # Region Coordinates
+                                          locations.take('lon', indices))),
+            'Latitude': latitudes[keep],                                      # Pixel Latitude
+            'Longtitude': longitudes[keep]}, columns=col_names)               # Pixel Longtitude
+    else:
+        df = pd.DataFrame([], columns=col_names)
+    df['Light Pollution'] = df['Light Pollution'].astype(region.dtype) # Keep the precision of the region map
     return df
+
+
+class ZoneHistogram(object):
+
+    """Fixed-bin histograms of pixel values of every zone, e.g. every county
+
+    Processed values fall on a small bounded scale, so counting them in fixed
+    bins gives quantiles and threshold fractions without keeping the pixels.
+    Blocks and months are added one at a time and histograms of different
+    runs can be merged, while memory stays O(zones x bins).
+
+    Results are exact while every value falls on the lower edge of its bin,
+    e.g. uint8 images with the default unit bins, and `exact` tells whether
+    they are. Otherwise quantiles are within one bin width and threshold
+    fractions miss at most the values in the bin of the threshold.
+
+    Attributes:
+        counts (np.ndarray): Number of values of every zone (rows) and bin
+        edges (np.ndarray): Lower edges of the bins followed by the upper bound
+        exact (bool): All values added so far fell on the lower edge of a bin
+        sums (np.ndarray): Sum of the values of every zone, for exact means
+        zones (list): Names of the zones, in the order of the rows
+    """
+
+    def __init__(self, lo=0.0, hi=256.0, bins=256):
+        """
+        Args:
+            lo (float, optional): Lower bound of the values
+            hi (float, optional): Upper bound of the values. Values out of
+                [lo, hi) are counted in the first or last bin.
+            bins (int, optional): Number of bins
+        """
+        self.edges = np.linspace(lo, hi, bins + 1)
+        self.zones = []
+        self._index = {}
+        self.counts = np.zeros((0, bins), np.int64)
+        self.sums = np.zeros(0)
+        self.exact = True
+
+    @property
+    def bins(self):
+        return len(self.edges) - 1
+
+    def _zone_ids(self, names):
+        """Row of every zone name, adding rows for new zones
+        """
+        for name in names:
+            if name not in self._index:
+                self._index[name] = len(self.zones)
+                self.zones.append(name)
+        missing = len(self.zones) - len(self.counts)
+        if missing > 0:
+            self.counts = np.vstack([self.counts,
+                np.zeros((missing, self.bins), np.int64)])
+            self.sums = np.concatenate([self.sums, np.zeros(missing)])
+        return np.array([self._index[name] for name in names], np.int64)
+
+    def add(self, values, zones):
+        """Count values of pixels
+
+        Args:
+            values (np.ndarray): Values of the pixels
+            zones (np.ndarray or str): Zone of every pixel, or the zone of
+                all of them
+        """
+        values = np.asarray(values, np.float64).ravel()
+        if not len(values):
+            return
+        if isinstance(zones, str):
+            names, inverse = [zones], np.zeros(len(values), np.int64)
+        else:
+            names, inverse = np.unique(np.asarray(zones).ravel(), return_inverse=True)
+            names = names.tolist()
+        rows = self._zone_ids(names)[inverse.ravel()]
+
+        lo, hi = self.edges[0], self.edges[-1]
+        scaled = (values - lo) * (self.bins / (hi - lo))
+        b = np.clip(np.floor(scaled), 0, self.bins - 1).astype(np.int64)
+        if self.exact and not np.array_equal(scaled, b):
+            self.exact = False
+        nzones = len(self.zones)
+        self.counts += np.bincount(rows * self.bins + b,
+            minlength=nzones * self.bins).reshape(nzones, self.bins)
+        self.sums += np.bincount(rows, weights=values, minlength=nzones)
+        instrument.count("conversion_histogram_values", len(values))
+
+    def add_frame(self, df, by="County", value="Light Pollution"):
+        """Count the pixels of a dataframe returned by geodecode_region
+
+        Args:
+            df (pd.DataFrame): Geodecoded pixels
+            by (str, optional): Column of the zones
+            value (str, optional): Column of the values
+        """
+        self.add(df[value].values, df[by].values)
+
+    def merge(self, other):
+        """Add the counts of another histogram with the same bins
+
+        Args:
+            other (ZoneHistogram): The histogram to add
+
+        Raises:
+            ValueError: The bins differ
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Histograms have different bins")
+        rows = self._zone_ids(other.zones)
+        np.add.at(self.counts, rows, other.counts)
+        np.add.at(self.sums, rows, other.sums)
+        self.exact = self.exact and other.exact
+
+    def _histogram(self, zone):
+        if zone is None:
+            return self.counts.sum(axis=0), self.sums.sum()
+        i = self._index[zone]
+        return self.counts[i], self.sums[i]
+
+    def count(self, zone=None):
+        """Number of values of a zone, or of all zones when it is None
+        """
+        return int(self._histogram(zone)[0].sum())
+
+    def mean(self, zone=None):
+        """Mean value of a zone, or of all zones when it is None
+        """
+        counts, total = self._histogram(zone)
+        n = counts.sum()
+        return total / n if n else np.nan
+
+    def quantile(self, q, zone=None):
+        """Quantile of the values of a zone, or of all zones when it is None
+
+        Interpolates linearly between the values around the quantile like
+        pd.Series.quantile, taking the lower edge of its bin for every value.
+
+        Args:
+            q (float): Quantile, between 0 and 1
+            zone (str, optional): The zone
+
+        Returns:
+            float: The quantile, nan without values
+        """
+        counts, _ = self._histogram(zone)
+        n = counts.sum()
+        if not n:
+            return np.nan
+        h = (n - 1) * q
+        cum = np.cumsum(counts)
+        lower, upper = np.searchsorted(cum, [np.floor(h), np.ceil(h)], side="right")
+        v0, v1 = self.edges[lower], self.edges[upper]
+        return float(v0 + (h - np.floor(h)) * (v1 - v0))
+
+    def median(self, zone=None):
+        """Median value of a zone, or of all zones when it is None
+        """
+        return self.quantile(0.5, zone)
+
+    def fraction_above(self, threshold, zone=None):
+        """Fraction of the values of zones greater than a threshold
+
+        Args:
+            threshold (float): The threshold
+            zone (str, optional): Only this zone. None gives every zone.
+
+        Returns:
+            pd.Series: The fraction of every zone, or a float for one zone
+        """
+        above = self.edges[:-1] > threshold
+        if zone is not None:
+            counts, _ = self._histogram(zone)
+            return counts[above].sum() / float(counts.sum())
+        import pandas as pd
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fractions = self.counts[:, above].sum(axis=1) / self.counts.sum(axis=1).astype(float)
+        return pd.Series(fractions, index=pd.Index(self.zones), name=str(threshold))
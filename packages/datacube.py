@@ -0,0 +1,332 @@
+"""Chunked (time, y, x) store for processed images
+
+A cube is a directory holding a json file with its metadata and one
+compressed numpy file per chunk. Reading a slice only loads the chunks it
+intersects, so a time series of a pixel touches one chunk per time chunk and
+a single image touches one time chunk per spatial chunk. Chunks which were
+never written read as the fill value. A damaged chunk file raises IOError
+when read and is left untouched, so writes never replace it with fill.
+
+Time steps are kept in label order. Storing a step which sorts before the
+last one shifts the later steps: their chunks are written again under a new
+generation number, which the metadata switches to in one atomic write, so a
+crash leaves the cube as it was before.
+"""
+import bisect
+import json
+import os
+import threading
+import zipfile
+import numpy as np
+
+_meta_name = "cube.json"
+
+def _atomic_save(fname, save):
+    tmp_fname = "%s.%d.%d.tmp" % (fname, os.getpid(),
+        threading.current_thread().ident)
+    with open(tmp_fname, "wb") as f:
+        save(f)
+    os.rename(tmp_fname, fname)
+
+def _normalize(key, shape):
+    """Convert an index into one (start, stop, step, squeeze) per axis
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > len(shape):
+        raise IndexError("too many indices for a %d-d cube" % len(shape))
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    ranges = []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            if step < 0:
+                raise IndexError("negative steps are not supported")
+            ranges.append((start, max(start, stop), step, False))
+        else:
+            k = int(k)
+            if k < 0:
+                k += n
+            if not 0 <= k < n:
+                raise IndexError("index %d is out of bounds" % k)
+            ranges.append((k, k + 1, 1, True))
+    return ranges
+
+class DataCube(object):
+
+    """Chunked (time, y, x) array stored on disk
+
+    Attributes:
+        chunks (tuple): Chunk shape along time, y and x
+        chunks_read (int): Number of chunk files loaded so far
+        dtype (np.dtype): Data type of the values
+        fill_value (float): Value of pixels never written
+        height (int): Number of rows of every image
+        path (str): Directory of the cube
+        times (list): Label of every image, in time order
+        width (int): Number of columns of every image
+    """
+
+    def __init__(self, path):
+        """Open an existing cube
+
+        Args:
+            path (str): Directory of the cube
+        """
+        self.path = path
+        with open(os.path.join(path, _meta_name)) as f:
+            meta = json.load(f)
+
+        self.height = meta["height"]
+        self.width = meta["width"]
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.fill_value = meta["fill_value"]
+        self.times = meta["times"]
+        # Generation of the files of every time chunk which was rewritten
+        self._generations = dict((int(k), v)
+            for k, v in meta.get("generations", {}).items())
+
+        self.chunks_read = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, height, width, chunks=(12, 256, 256),
+            dtype="float32", fill_value=0):
+        """Create an empty cube
+
+        Args:
+            path (str): Directory of the cube
+            height (int): Number of rows of every image
+            width (int): Number of columns of every image
+            chunks (tuple, optional): Chunk shape along time, y and x
+            dtype (str, optional): Data type of the values
+            fill_value (float, optional): Value of pixels never written
+
+        Returns:
+            DataCube: The new cube
+        """
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+        meta = {
+            "height": height,
+            "width": width,
+            "chunks": list(chunks),
+            "dtype": np.dtype(dtype).str,
+            "fill_value": fill_value,
+            "times": []
+        }
+        _atomic_save(os.path.join(path, _meta_name),
+            lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        return cls(path)
+
+    @classmethod
+    def open_or_create(cls, path, height, width, **kwargs):
+        """Open a cube, creating it if it does not exist
+
+        Args:
+            path (str): Directory of the cube
+            height (int): Number of rows of every image
+            width (int): Number of columns of every image
+            **kwargs: Extra parameters passed to create
+
+        Returns:
+            DataCube: The cube
+
+        Raises:
+            ValueError: The existing cube has a different image size
+        """
+        if not os.path.isfile(os.path.join(path, _meta_name)):
+            return cls.create(path, height, width, **kwargs)
+
+        cube = cls(path)
+        if (cube.height, cube.width) != (height, width):
+            raise ValueError("cube %s holds %dx%d images, not %dx%d" % (
+                path, cube.height, cube.width, height, width))
+        return cube
+
+    @property
+    def shape(self):
+        return (len(self.times), self.height, self.width)
+
+    def _chunk_path(self, ti, yi, xi, generation=None):
+        if generation is None:
+            generation = self._generations.get(ti, 0)
+        if generation:
+            return os.path.join(self.path, "c.%d.%d.%d.g%d.npz" % (ti, yi, xi, generation))
+        return os.path.join(self.path, "c.%d.%d.%d.npz" % (ti, yi, xi))
+
+    def _read_chunk(self, ti, yi, xi):
+        fname = self._chunk_path(ti, yi, xi)
+        if not os.path.isfile(fname):
+            ct, cy, cx = self.chunks
+            return np.full((ct, cy, cx), self.fill_value, self.dtype)
+
+        try:
+            with np.load(fname) as f:
+                chunk = f["data"]
+        except (EOFError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            # Left in place, so the data in it is not overwritten with fill
+            raise IOError("chunk %s is damaged: %s" % (fname, e))
+        self.chunks_read += 1
+        return chunk
+
+    def _write_chunk(self, ti, yi, xi, chunk, generation=None):
+        _atomic_save(self._chunk_path(ti, yi, xi, generation),
+            lambda f: np.savez_compressed(f, data=chunk))
+
+    def _write_meta(self, times, generations):
+        meta_fname = os.path.join(self.path, _meta_name)
+        with open(meta_fname) as f:
+            meta = json.load(f)
+        meta["times"] = times
+        meta["generations"] = dict((str(k), v) for k, v in generations.items())
+        _atomic_save(meta_fname,
+            lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        self.times = times
+        self._generations = generations
+
+    def _spatial_chunks(self):
+        ct, cy, cx = self.chunks
+        for yi in range(-(-self.height // cy)):
+            for xi in range(-(-self.width // cx)):
+                yield yi, xi
+
+    def _insert(self, image, t, time):
+        """Store a new time step at index t, shifting the later ones
+        """
+        ct, cy, cx = self.chunks
+        times = self.times[:t] + [time] + self.times[t:]
+        first, last = t // ct, (len(times) - 1) // ct
+        old = dict((ti, self._generations.get(ti, 0)) for ti in range(first, last + 1))
+        generations = dict(self._generations)
+        for ti in old:
+            generations[ti] = old[ti] + 1
+
+        for yi, xi in self._spatial_chunks():
+            steps = np.concatenate([self._read_chunk(ti, yi, xi)
+                for ti in range(first, last + 1)])
+            block = image[yi * cy:(yi + 1) * cy, xi * cx:(xi + 1) * cx]
+            k = t - first * ct
+            steps[k + 1:] = steps[k:-1].copy()
+            steps[k] = self.fill_value
+            steps[k, :block.shape[0], :block.shape[1]] = block
+            for ti in old:
+                self._write_chunk(ti, yi, xi,
+                    steps[(ti - first) * ct:(ti - first + 1) * ct], generations[ti])
+
+        self._write_meta(times, generations)
+        # The files of the previous generations are not read any more
+        for ti, generation in old.items():
+            for yi, xi in self._spatial_chunks():
+                try:
+                    os.remove(self._chunk_path(ti, yi, xi, generation))
+                except OSError:
+                    pass
+
+    def append(self, image, time):
+        """Store the image of a time step
+
+        An image with a label already in the cube replaces the stored image,
+        so storing a time step twice is harmless. A new label which sorts
+        before the last one is inserted at its place in label order.
+
+        Args:
+            image (np.ndarray): height x width image
+            time (str): Label of the time step, e.g. "2017-01-01"
+
+        Raises:
+            IOError: A chunk the image goes into is damaged
+            ValueError: The image has the wrong shape
+        """
+        image = np.asarray(image)
+        if image.shape != (self.height, self.width):
+            raise ValueError("expected a %dx%d image, got %s" % (
+                self.height, self.width, image.shape))
+
+        with self._lock:
+            if time in self.times:
+                t = self.times.index(time)
+            elif self.times and time < self.times[-1]:
+                self._insert(image, bisect.bisect(self.times, time), time)
+                return
+            else:
+                t = len(self.times)
+
+            ct, cy, cx = self.chunks
+            ti = t // ct
+            for yi, xi in self._spatial_chunks():
+                block = image[yi * cy:(yi + 1) * cy, xi * cx:(xi + 1) * cx]
+                chunk = self._read_chunk(ti, yi, xi)
+                chunk[t % ct, :block.shape[0], :block.shape[1]] = block
+                self._write_chunk(ti, yi, xi, chunk)
+
+            if t == len(self.times):
+                self._write_meta(self.times + [time], self._generations)
+
+    def __getitem__(self, key):
+        """Read a slice of the cube
+
+        Indices are integers or slices along (time, y, x). Only the chunks
+        intersecting the slice are loaded.
+
+        Returns:
+            np.ndarray: The values, with integer indexed axes removed
+
+        Raises:
+            IOError: A chunk intersecting the slice is damaged
+        """
+        ranges = _normalize(key, self.shape)
+        (t0, t1, _, _), (y0, y1, _, _), (x0, x1, _, _) = ranges
+        ct, cy, cx = self.chunks
+
+        out = np.empty((t1 - t0, y1 - y0, x1 - x0), self.dtype)
+        for ti in range(t0 // ct, -(-t1 // ct)):
+            for yi in range(y0 // cy, -(-y1 // cy)):
+                for xi in range(x0 // cx, -(-x1 // cx)):
+                    chunk = self._read_chunk(ti, yi, xi)
+
+                    a0, a1 = max(t0, ti * ct), min(t1, (ti + 1) * ct)
+                    b0, b1 = max(y0, yi * cy), min(y1, (yi + 1) * cy)
+                    c0, c1 = max(x0, xi * cx), min(x1, (xi + 1) * cx)
+                    out[a0 - t0:a1 - t0, b0 - y0:b1 - y0, c0 - x0:c1 - x0] = \
+                        chunk[a0 - ti * ct:a1 - ti * ct,
+                              b0 - yi * cy:b1 - yi * cy,
+                              c0 - xi * cx:c1 - xi * cx]
+
+        out = out[tuple(slice(None, None, step) for _, _, step, _ in ranges)]
+        return out[tuple(0 if squeeze else slice(None)
+            for _, _, _, squeeze in ranges)]
+
+    def timeseries(self, y, x):
+        """Time series of a pixel or the mean time series of a region
+
+        Args:
+            y (int or slice): Row, or rows of the region
+            x (int or slice): Column, or columns of the region
+
+        Returns:
+            np.ndarray: One value per time step
+        """
+        values = self[:, y, x]
+        if values.ndim > 1:
+            values = values.reshape(values.shape[0], -1).mean(axis=1)
+        return values
+
+    def image(self, time):
+        """Image of a time step
+
+        Args:
+            time (str or int): Label or index of the time step
+
+        Returns:
+            np.ndarray: height x width image
+        """
+        if not isinstance(time, int):
+            time = self.times.index(time)
+        return self[time]
@@ -0,0 +1,478 @@
+"""Registry of the county and city datasets joined to zonal results
+
+Data_Analysis joins the population, electricity and economic region tables
+to light pollution per county or city by munging names (appending " County",
+title casing, splitting lists of counties) and merging dataframes, once per
+chart. Here the csv files are parsed once into tables of numpy arrays whose
+rows are integer keys: every county, city and economic region is a row, and
+references between them, e.g. the economic region of a county, are keys too.
+The tables are cached in a binary file next to the other caches and rebuilt
+when a csv file changes, so loading them parses nothing.
+
+Zone names are matched once per distinct zone, after which results join by
+key with gathers, so a join costs O(zones) instead of a parse and a merge.
+location_keys maps the locations of the geocoder to keys by their admin
+codes, so results of query_indices join without decoding a single name.
+
+Usage:
+    dims = dimensions.load()
+    df = dims.join(zonal_stats_df, on="County", columns=["Population"])
+    keys = dims.keys("county", histogram.zones)
+    by_region = dims.rollup("county", "Economic Region", keys, histogram.sums)
+"""
+import io
+import os
+import threading
+import unicodedata
+import numpy as np
+import instrument
+
+_data_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "data")
+
+_dimensions_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    "dimensions.cache")
+
+# Source files of the tables, in the data directory
+SOURCES = {
+    "county_population": "county_population.csv",
+    "city_population": "city_population.csv",
+    "electricity": "electricity_county.csv",
+    "economic_region": "economic_region_county.csv",
+}
+
+# Level of the keys of the columns referencing another level
+REFERENCES = {
+    ("county", "Economic Region"): "region",
+    ("city", "County"): "county",
+}
+
+# State of the datasets, the admin1 name of the geocoder
+STATE = "California"
+
+_version = 1
+_loaded = {}
+_lock = threading.Lock()
+
+def normalize(name, level="county"):
+    """Form of a place name shared by every source
+
+    Names are compared without case, accents, repeated spaces and, for
+    counties, the " County" suffix, so "ALAMEDA", "Alameda " and the
+    geocoder's "Alameda County" are the same county.
+
+    Args:
+        name (str): The name
+        level (str, optional): "county", "city" or "region"
+
+    Returns:
+        str: The normalized name
+    """
+    name = unicodedata.normalize("NFKD", u"%s" % name)
+    name = u"".join(c for c in name if not unicodedata.combining(c))
+    name = u" ".join(name.lower().split())
+    if level == "county" and name.endswith(" county"):
+        name = name[:-len(" county")]
+    return name
+
+def _stamp(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime]
+
+def _read_csv(fname):
+    import csv
+    # The files are saved by spreadsheets, with a byte order mark and
+    # latin-1 characters
+    with io.open(fname, "rb") as f:
+        raw = f.read()
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = raw.decode("latin-1")
+    rows = list(csv.reader(io.StringIO(text)))
+    return rows[0], rows[1:]
+
+def _number(value):
+    return float(value.replace(",", "").strip())
+
+class Dimensions(object):
+
+    """Tables of counties, cities and economic regions with integer keys
+
+    Attributes:
+        columns (dict): Arrays of every column of every level, keyed by level
+            and column name. Missing numbers are NaN and missing references
+            are -1.
+        names (dict): Display names of every level, the key of a row being
+            its position. Counties are named like the geocoder's admin2.
+    """
+
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+        self._index = dict((level, dict((normalize(n, level), k)
+            for k, n in enumerate(values))) for level, values in names.items())
+        # Keys of the names matched so far, as they were spelled
+        self._matched = dict((level, dict((n, k) for k, n in enumerate(values)))
+            for level, values in names.items())
+
+    def _key(self, level, name):
+        matched = self._matched[level]
+        key = matched.get(name)
+        if key is None:
+            key = matched[name] = self._index[level].get(normalize(name, level), -1)
+            instrument.count("dimensions_names_matched")
+        return key
+
+    @classmethod
+    def from_csv(cls, data_dir=None):
+        """Parse the source files
+
+        Args:
+            data_dir (str, optional): Directory of SOURCES, the data
+                directory of the repository by default
+
+        Returns:
+            Dimensions: The tables
+        """
+        data_dir = data_dir or _data_path
+        path = lambda source: os.path.join(data_dir, SOURCES[source])
+
+        _, rows = _read_csv(path("county_population"))
+        rows = [r for r in rows if r and r[0].strip()]
+        counties = [u" ".join(r[0].split()) + u" County" for r in rows]
+        index = dict((normalize(n), k) for k, n in enumerate(counties))
+        county_key = lambda name: index.get(normalize(name), -1)
+        population = np.array([_number(r[1]) for r in rows], np.int64)
+
+        header, rows = _read_csv(path("electricity"))
+        years = [h for h in header if h.strip().isdigit()]
+        electricity = dict((y, np.full(len(counties), np.nan)) for y in years)
+        for r in rows:
+            row = dict(zip(header, r))
+            k = county_key(row["County"])
+            if k >= 0 and row["Sector"].strip() == "Total":
+                for y in years:
+                    electricity[y][k] = _number(row[y])
+
+        _, rows = _read_csv(path("economic_region"))
+        regions = [u" ".join(r[0].split()) for r in rows if r]
+        county_region = np.full(len(counties), -1, np.int32)
+        for k, r in enumerate(rows):
+            for name in r[1].split(","):
+                if county_key(name) >= 0:
+                    county_region[county_key(name)] = k
+
+        header, rows = _read_csv(path("city_population"))
+        rows = [dict(zip(header, r)) for r in rows if r]
+        cities = [u" ".join(r["Name"].split()) for r in rows]
+        city_county = np.array([county_key(r["County"]) for r in rows], np.int32)
+        city_population = np.array([_number(r["Population (2010)"]) for r in rows],
+            np.int64)
+
+        county_columns = {"Population": population,
+            "Economic Region": county_region}
+        for y in years:
+            county_columns["Electricity %s" % y] = electricity[y]
+        # The year of the electricity consumption of Data_Analysis
+        if years:
+            county_columns["Electricity Consumption"] = electricity[years[-1]]
+        return cls(
+            {"county": counties, "city": cities, "region": regions},
+            {"county": county_columns,
+             "city": {"Population": city_population, "County": city_county},
+             "region": {}})
+
+    def save(self, fname, stamp=None):
+        """Write the tables to a binary file, atomically
+
+        Args:
+            fname (str): File name, ending with .npz
+            stamp (list, optional): Version of the source files
+        """
+        arrays = {"version": np.array(_version),
+            "stamp": np.array(stamp or [], np.float64)}
+        for level, values in self.names.items():
+            arrays["names/%s" % level] = np.array(values, dtype=np.str_)
+            for name, arr in self.columns[level].items():
+                arrays["columns/%s/%s" % (level, name)] = arr
+        path = os.path.dirname(fname)
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        tmp_fname = "%s.%d.%d.tmp.npz" % (fname[:-len(".npz")], os.getpid(),
+            threading.current_thread().ident)
+        try:
+            np.savez(tmp_fname, **arrays)
+            os.rename(tmp_fname, fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+
+    @classmethod
+    def load(cls, fname, stamp=None):
+        """Read tables written by save
+
+        Args:
+            fname (str): File name
+            stamp (list, optional): Version of the source files. The file is
+                ignored if it was written from another version.
+
+        Returns:
+            Dimensions: The tables, or None if the file is missing or stale
+        """
+        try:
+            with np.load(fname, allow_pickle=False) as f:
+                if int(f["version"]) != _version:
+                    return None
+                if stamp is not None and f["stamp"].tolist() != \
+                        np.array(stamp, np.float64).tolist():
+                    return None
+                names, columns = {}, {}
+                for key in f.files:
+                    parts = key.split("/")
+                    if parts[0] == "names":
+                        names[parts[1]] = f[key].tolist()
+                        columns.setdefault(parts[1], {})
+                    elif parts[0] == "columns":
+                        columns.setdefault(parts[1], {})[parts[2]] = f[key]
+        except (OSError, IOError, KeyError, ValueError):
+            return None
+        return cls(names, columns)
+
+    def __len__(self):
+        return len(self.names["county"])
+
+    def keys(self, level, names):
+        """Keys of place names
+
+        Every distinct name is matched once and remembered, then the keys
+        are gathered, so names repeated on many rows or months cost little.
+        Pandas categoricals are matched by their categories.
+
+        Args:
+            level (str): "county", "city" or "region"
+            names (array-like or str): The names
+
+        Returns:
+            np.ndarray: Key of every name, -1 for names not in the tables
+        """
+        if isinstance(names, str):
+            return np.array([self._key(level, names)], np.int32)
+        cat = getattr(names, "cat", None)
+        if cat is not None:
+            distinct, inverse = cat.categories, np.asarray(cat.codes)
+        elif hasattr(names, "categories") and hasattr(names, "codes"):
+            distinct, inverse = names.categories, np.asarray(names.codes)
+        elif hasattr(names, "factorize"):
+            # Hashing pandas objects is faster than sorting them
+            inverse, distinct = names.factorize()
+        else:
+            distinct, inverse = np.unique(np.asarray(names, dtype=object).astype(np.str_),
+                return_inverse=True)
+        distinct = distinct.tolist() if hasattr(distinct, "tolist") else list(distinct)
+        matched = self._matched[level]
+        lookup = [matched.get(n) for n in distinct]
+        for i, key in enumerate(lookup):
+            if key is None:
+                lookup[i] = self._key(level, distinct[i])
+        # Code -1 of categoricals is a missing name, and gathers the last key
+        lookup = np.array(lookup + [-1], np.int32)
+        return lookup[np.asarray(inverse).ravel()]
+
+    def gather(self, level, column, keys):
+        """Values of a column for keys
+
+        Args:
+            level (str): Level of the keys
+            column (str): Column of the level
+            keys (np.ndarray): Keys, -1 for missing places
+
+        Returns:
+            np.ndarray: Value of every key. Missing places are -1 in
+                references and NaN otherwise, integers then becoming floats
+                like in pd.merge.
+        """
+        arr = self.columns[level][column]
+        keys = np.asarray(keys)
+        values = arr[np.where(keys < 0, 0, keys)] if len(arr) else \
+            np.zeros(keys.shape, arr.dtype)
+        missing = keys < 0
+        if missing.any():
+            if (level, column) in REFERENCES:
+                values[missing] = -1
+            else:
+                values = values.astype(np.float64)
+                values[missing] = np.nan
+        return values
+
+    def decode(self, level, keys):
+        """Names of keys as a pandas categorical
+
+        Args:
+            level (str): Level of the keys
+            keys (np.ndarray): Keys, -1 for missing places
+
+        Returns:
+            pd.Categorical: The names, missing places being NaN
+        """
+        import pandas as pd
+        return pd.Categorical.from_codes(np.asarray(keys), self.names[level])
+
+    def join(self, df, on, level=None, columns=None, how="inner"):
+        """Join columns of the tables to a dataframe of zonal results
+
+        The replacement of pd.merge with the munged csv files: the zones of
+        the dataframe are matched by key, then the columns are gathered.
+        References to other levels, like "Economic Region", are added as
+        categoricals of their names.
+
+        Args:
+            df (pd.DataFrame): Zonal results, e.g. returned by
+                windowed.zonal_stats
+            on (str): Column of the zone names
+            level (str, optional): Level of the zones. Defaults to "county"
+                when on is "County" and "city" otherwise.
+            columns (list, optional): Columns of the level to add. All by
+                default.
+            how (str, optional): "inner" drops the zones not in the tables,
+                like pd.merge, "left" keeps them with missing values
+
+        Returns:
+            pd.DataFrame: The dataframe with the columns added
+        """
+        level = level or ("county" if on == "County" else "city")
+        keys = self.keys(level, df[on])
+        if how == "inner":
+            found = keys >= 0
+            df, keys = df[found], keys[found]
+        elif how != "left":
+            raise ValueError("Unknown join %s" % how)
+        df = df.copy()
+        for column in columns or sorted(self.columns[level]):
+            values = self.gather(level, column, keys)
+            if (level, column) in REFERENCES:
+                values = self.decode(REFERENCES[level, column], values)
+            df[column] = values
+        return df
+
+    def rollup(self, level, column, keys, values):
+        """Sums of values over the places a reference column points to, e.g.
+        light pollution of counties summed by economic region
+
+        Args:
+            level (str): Level of the keys
+            column (str): Reference column of the level, see REFERENCES
+            keys (np.ndarray): Key of every value
+            values (np.ndarray): The values
+
+        Returns:
+            pd.Series: Sum of every place of the referenced level with values
+        """
+        import pandas as pd
+        target = REFERENCES[level, column]
+        parents = self.gather(level, column, keys)
+        found = parents >= 0
+        sums = np.bincount(parents[found], np.asarray(values, np.float64)[found],
+            minlength=len(self.names[target]))
+        present = np.bincount(parents[found], minlength=len(self.names[target])) > 0
+        return pd.Series(sums[present], name=column,
+            index=pd.Index(np.array(self.names[target], dtype=object)[present],
+            name=column))
+
+    def location_keys(self, locations, level="county", state=STATE):
+        """Keys of the locations of the geocoder
+
+        The admin codes of the locations are matched once per distinct
+        value, so the key of the result of a geocoder query is a gather:
+        dims.location_keys(geocoder.locations)[geocoder.query_indices(...)].
+
+        Args:
+            locations (reverse_geocoder.Locations): The locations
+            level (str, optional): "county" matches admin2, "city" the name
+            state (str, optional): admin1 of the tables. Places of other
+                states get -1.
+
+        Returns:
+            np.ndarray: Key of every location, -1 for other places
+        """
+        column = "admin2" if level == "county" else "name"
+        codes, offsets, data = locations.columns[column]
+        data = np.asarray(data)
+        distinct = [data[offsets[c]:offsets[c + 1]].tobytes().decode("utf-8")
+            for c in range(len(offsets) - 1)]
+        keys = self.keys(level, distinct)[np.asarray(codes)]
+
+        admin1, offsets, data = locations.columns["admin1"]
+        data = np.asarray(data)
+        in_state = np.array([data[offsets[c]:offsets[c + 1]].tobytes().decode("utf-8")
+            == state for c in range(len(offsets) - 1)], bool)
+        keys[~in_state[np.asarray(admin1)]] = -1
+        return keys
+
+def _stamps(data_dir):
+    return [x for source in sorted(SOURCES)
+        for x in _stamp(os.path.join(data_dir, SOURCES[source]))]
+
+def set_cache_dir(path):
+    """Set the directory of the binary cache files of the tables
+
+    Tables loaded already are loaded again from the new directory.
+
+    Args:
+        path (str): Directory
+    """
+    global _dimensions_path
+    with _lock:
+        _dimensions_path = path
+        _loaded.clear()
+
+def cache_file(data_dir=None):
+    """Binary cache file of the tables of a data directory
+
+    Args:
+        data_dir (str, optional): Directory of SOURCES, the data directory of
+            the repository by default
+
+    Returns:
+        str: File name of the cache, which may not exist yet
+    """
+    import hashlib
+    data_dir = os.path.abspath(data_dir or _data_path)
+    digest = hashlib.md5(data_dir.encode("utf-8")).hexdigest()
+    return os.path.join(_dimensions_path, "dimensions-%s.npz" % digest[:12])
+
+def load(data_dir=None, rebuild=False):
+    """The tables of the source files, parsed once
+
+    The tables are kept in memory and in a binary cache file, which is
+    written again when a source file changes.
+
+    Args:
+        data_dir (str, optional): Directory of SOURCES, the data directory of
+            the repository by default
+        rebuild (bool, optional): Parse the source files even if cached
+
+    Returns:
+        Dimensions: The tables
+    """
+    data_dir = os.path.abspath(data_dir or _data_path)
+    stamp = _stamps(data_dir)
+    with _lock:
+        dims, loaded_stamp = _loaded.get(data_dir, (None, None))
+        if dims is not None and loaded_stamp == stamp and not rebuild:
+            return dims
+        fname = cache_file(data_dir)
+        dims = None if rebuild else Dimensions.load(fname, stamp)
+        if dims is None:
+            with instrument.span("dimensions_parse"):
+                dims = Dimensions.from_csv(data_dir)
+            try:
+                dims.save(fname, stamp)
+            except (OSError, IOError):
+                # A read-only checkout still gets the tables
+                pass
+        _loaded[data_dir] = (dims, stamp)
+        return dims
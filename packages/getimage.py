@@ -1,31 +1,369 @@
 """Retrieve images for VIIRS Nighttime overlay
 """
 import datetime
-import dateutil.parser
-import imageio
+import hashlib
 import json
 import os
+import socket
+import stat
 import threading
-import urllib
+import time
+import zipfile
 import numpy as np
+import instrument
+from precision import get_policy
 
-_base_url = "https://gibs-b.earthdata.nasa.gov/wmts/epsg4326/best/wmts.cgi?"
+try: # Python 3
+	from urllib.error import HTTPError, URLError
+	from urllib.parse import urlencode
+	from urllib.request import Request, urlopen
+except ImportError: # Python 2
+	from urllib import urlencode
+	from urllib2 import HTTPError, Request, URLError, urlopen
+
+_base_url = os.environ.get("NIGHTFLARE_WMTS_URL",
+	"https://gibs-b.earthdata.nasa.gov/wmts/epsg4326/best/wmts.cgi?")
+
+_wms_url = os.environ.get("NIGHTFLARE_WMS_URL",
+	"https://gibs-b.earthdata.nasa.gov/wms/epsg4326/best/wms.cgi?")
+
+# "tile" fetches every tile with WMTS GetTile, "region" fetches whole regions
+# with WMS GetMap first. See prefetch_region.
+_fetch_mode = os.environ.get("NIGHTFLARE_FETCH_MODE", "tile")
+
+# Largest width and height of a GetMap request, lowered when the server
+# refuses a request as too large
+_wms_default_max_size = 4096
+_wms_max_size = _wms_default_max_size
+
+_tile_size = 512
 
 _concurrent_download = 20
-_concurrent_semaphore = threading.Semaphore(_concurrent_download)
+_concurrent_download_max = 200
+_download_timeout = 60
+_download_retries = 4
 
 _mem_cache = {}
 _mem_cache_limit = 1000
 
-_file_cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-	"getimage.cache")
+_file_cache_path = os.environ.get("NIGHTFLARE_CACHE_DIR", os.path.join(
+	os.path.dirname(os.path.realpath(__file__)), "getimage.cache"))
 _file_cache_lock = threading.Lock()
 
-try:
-	os.mkdir(_file_cache_path)
-except OSError:
-	if not os.path.isdir(_file_cache_path):
-		raise
+def _parse_size(size):
+	"""Number of bytes of a size like 1048576, "512K", "100M" or "2G"
+	"""
+	if size is None or isinstance(size, (int, float)):
+		return size
+	size = size.strip().upper()
+	for i, unit in enumerate("KMGT"):
+		if size.endswith(unit):
+			return int(float(size[:-1]) * 1024 ** (i + 1))
+	return int(size)
+
+# Size in bytes the file cache is kept under, or None for no limit. See
+# set_cache_budget.
+_cache_budget = _parse_size(os.environ.get("NIGHTFLARE_CACHE_BUDGET"))
+# Eviction frees space down to this fraction of the budget, so it runs once
+# every few writes and not on every one
+_cache_low_water = 0.9
+# Bytes in the file cache, estimated from the writes since the last eviction
+_cache_usage = None
+_cache_usage_lock = threading.Lock()
+_evict_lock = threading.Lock()
+# Temporary files of writes older than this many seconds were left by a crash
+_stale_tmp_age = 3600
+
+# Decoded tiles of the file cache by content hash, shared by all tiles with
+# the same content
+_blob_cache = {}
+_blob_cache_limit = 256
+
+# Seconds after which a cached tile is checked again with the server, or None
+# to never check. See set_revalidate.
+_revalidate = os.environ.get("NIGHTFLARE_REVALIDATE")
+if _revalidate is not None:
+	_revalidate = float(_revalidate)
+
+def _makedirs_cache():
+	"""Create the file cache directory before its first write
+	"""
+	try:
+		os.makedirs(_file_cache_path)
+	except OSError:
+		if not os.path.isdir(_file_cache_path):
+			raise
+
+def set_cache_dir(path):
+	"""Set the directory of the file cache
+
+	The default is getimage.cache next to this module. It can also be set
+	with the NIGHTFLARE_CACHE_DIR environment variable.
+
+	Args:
+	    path (str): Cache directory, created on the first write
+	"""
+	global _file_cache_path, _cache_usage
+	_file_cache_path = path
+	with _cache_usage_lock:
+		_cache_usage = None
+	clear_memory_cache()
+
+def clear_memory_cache():
+	"""Empty the in-memory caches of tiles and masks, so the next reads come
+	from the file cache
+	"""
+	_mem_cache.clear()
+	_blob_cache.clear()
+	_mask_cache.clear()
+
+def set_cache_budget(max_bytes):
+	"""Keep the file cache under a size
+
+	Once writes take the cache over the budget, the tiles read least recently
+	are removed until it is 10% under the budget. The default can also be set
+	with the NIGHTFLARE_CACHE_BUDGET environment variable.
+
+	Args:
+	    max_bytes (int or str): Budget in bytes, or a size like "500M" or
+	        "2G". None removes the limit, the default.
+	"""
+	global _cache_budget, _cache_usage
+	_cache_budget = _parse_size(max_bytes)
+	with _cache_usage_lock:
+		_cache_usage = None
+
+def set_base_url(url):
+	"""Set the WMTS endpoint tiles are fetched from
+
+	The default endpoint is GIBS. It can also be set with the
+	NIGHTFLARE_WMTS_URL environment variable.
+
+	Args:
+	    url (str): Url of the endpoint, e.g. the url of a
+	        wmts_server.WMTSServer
+	"""
+	global _base_url
+	if not url.endswith(("?", "&")):
+		url += "&" if "?" in url else "?"
+	_base_url = url
+
+def set_wms_url(url):
+	"""Set the WMS endpoint regions are fetched from in "region" mode
+
+	The default endpoint is GIBS. It can also be set with the
+	NIGHTFLARE_WMS_URL environment variable.
+
+	The largest size of a GetMap request learned from the previous endpoint
+	is forgotten.
+
+	Args:
+	    url (str): Url of the endpoint, e.g. the wms_url of a
+	        wmts_server.WMTSServer
+	"""
+	global _wms_url, _wms_max_size
+	if not url.endswith(("?", "&")):
+		url += "&" if "?" in url else "?"
+	_wms_url = url
+	_wms_max_size = _wms_default_max_size
+
+def set_fetch_mode(mode):
+	"""Set how tiles of regions are fetched
+
+	In "tile" mode, the default, every tile of every day is fetched with its
+	own WMTS GetTile request. In "region" mode, prefetch_region fetches all
+	tiles of a region for a day with one WMS GetMap request, so processing
+	the region only reads cached tiles. The mode can also be set with the
+	NIGHTFLARE_FETCH_MODE environment variable.
+
+	Args:
+	    mode (str): "tile" or "region"
+
+	Raises:
+	    ValueError: Unknown mode
+	"""
+	global _fetch_mode
+	if mode not in ("tile", "region"):
+		raise ValueError("Unknown fetch mode %s" % mode)
+	_fetch_mode = mode
+
+def get_fetch_mode():
+	"""How tiles of regions are fetched, see set_fetch_mode
+
+	Returns:
+	    str: "tile" or "region"
+	"""
+	return _fetch_mode
+
+def set_revalidate(max_age=0):
+	"""Check cached tiles with the server before using them
+
+	Tiles of the file cache are stored with the ETag and Last-Modified
+	validators the server sent. Once a tile is older than max_age, reading it
+	sends a conditional request: if the server answers 304 Not Modified, only
+	headers are transferred and the cached tile is used, otherwise the tile
+	reprocessed by the server replaces the cached one. Tiles already held in
+	the memory cache are not checked. Tiles cached without validators by
+	earlier versions are downloaded again on their first check.
+
+	The default can also be set with the NIGHTFLARE_REVALIDATE environment
+	variable.
+
+	Args:
+	    max_age (float, optional): Seconds since a tile was downloaded or last
+	        checked after which it is checked again. 0 checks every tile read
+	        from the file cache. None never checks, the default.
+	"""
+	global _revalidate
+	_revalidate = max_age
+
+class AdaptiveLimiter(object):
+
+	"""Limit on concurrent downloads adapted by AIMD
+
+	The limit grows by one every limit successful downloads while all slots
+	are in use and their latency stays close to the lowest latency seen,
+	shrinks the same way when latency rises, and is halved when the server
+	answers 429 or 5xx or a download times out. Like TCP, it is halved at
+	most once per round trip, since the downloads running when the server
+	got overloaded all report it.
+
+	Attributes:
+	    baseline (float): Slowly rising estimate of the lowest latency
+	    in_flight (int): Number of downloads running
+	    latency (float): Smoothed latency of downloads, the window in which
+	        overloads are counted once
+	    limit (float): Current limit on concurrent downloads
+	    maximum (int): Upper bound of the limit
+	    minimum (int): Lower bound of the limit
+	    waiting (int): Number of downloads waiting for a slot
+	"""
+
+	def __init__(self, initial=_concurrent_download, minimum=1,
+			maximum=_concurrent_download_max, backoff=0.5, tolerance=2.0):
+		"""
+		Args:
+		    initial (int, optional): Initial limit
+		    minimum (int, optional): Lower bound of the limit
+		    maximum (int, optional): Upper bound of the limit
+		    backoff (float, optional): Factor applied to the limit on
+		        overload
+		    tolerance (float, optional): Ratio of latency to the baseline up
+		        to which latency counts as flat
+		"""
+		self._cond = threading.Condition()
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.backoff = backoff
+		self.tolerance = tolerance
+		self.baseline = None
+		self.latency = None
+		self.in_flight = 0
+		self.waiting = 0
+		self._decreased = None
+
+	def acquire(self):
+		"""Wait for a download slot
+		"""
+		with self._cond:
+			self.waiting += 1
+			while self.in_flight >= int(self.limit):
+				self._cond.wait()
+			self.waiting -= 1
+			self.in_flight += 1
+
+	def release(self, latency=None, overload=False):
+		"""Give a download slot back and adapt the limit
+
+		Args:
+		    latency (float, optional): Duration of a successful download
+		    overload (bool, optional): The server was overloaded
+		"""
+		with self._cond:
+			saturated = self.in_flight >= int(self.limit)
+			self.in_flight -= 1
+			if overload:
+				now = time.time()
+				window = self.latency if self.latency is not None else 1.0
+				if self._decreased is None or now - self._decreased >= window:
+					self.limit = max(self.minimum, self.limit * self.backoff)
+					self._decreased = now
+			elif latency is not None:
+				if self.baseline is None or latency < self.baseline:
+					self.baseline = latency
+				else:
+					self.baseline += 0.01 * (latency - self.baseline)
+				if self.latency is None:
+					self.latency = latency
+				else:
+					self.latency += 0.125 * (latency - self.latency)
+
+				if latency <= self.tolerance * self.baseline:
+					# A limit which is not reached says nothing of the server
+					if saturated:
+						self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+				else:
+					self.limit = max(self.minimum, self.limit - 1.0 / self.limit)
+			self._cond.notify_all()
+
+	@property
+	def status(self):
+		"""Current limit, downloads running and queue depth
+
+		Returns:
+		    dict: "limit", "in_flight" and "waiting"
+		"""
+		with self._cond:
+			return {
+				"limit": int(self.limit),
+				"in_flight": self.in_flight,
+				"waiting": self.waiting
+			}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(layer_name):
+	"""Download limiter of a layer
+
+	Every layer has its own limiter, so fetching land masks and VIIRS tiles
+	do not starve each other.
+
+	Args:
+	    layer_name (str): Layer name
+
+	Returns:
+	    AdaptiveLimiter: The limiter, created on first use
+	"""
+	with _limiters_lock:
+		limiter = _limiters.get(layer_name)
+		if limiter is None:
+			limiter = _limiters[layer_name] = AdaptiveLimiter()
+		return limiter
+
+def download_status():
+	"""Status of the download limiter of every layer
+
+	Returns:
+	    dict: AdaptiveLimiter.status by layer name
+	"""
+	with _limiters_lock:
+		limiters = dict(_limiters)
+	return dict((name, limiter.status) for name, limiter in limiters.items())
+
+def _is_overload(error):
+	if isinstance(error, HTTPError):
+		return error.code == 429 or error.code >= 500
+	if isinstance(error, URLError):
+		return isinstance(error.reason, socket.timeout)
+	return isinstance(error, socket.timeout)
+
+def _retry_delay(error, attempt):
+	try:
+		return float(error.headers["Retry-After"])
+	except (AttributeError, KeyError, TypeError, ValueError):
+		return min(30.0, 0.5 * 2 ** attempt)
 
 def _build_url(tileMatrix, tileCol, tileRow, **kwargs):
 	parameters = {
@@ -47,15 +385,91 @@ def _build_url(tileMatrix, tileCol, tileRow, **kwargs):
 
 	parameters.update(kwargs)
 
-	return _base_url + urllib.urlencode(parameters)
+	return _base_url + urlencode(parameters)
+
+def _validators(headers, validators=None):
+	"""Validators of a response, merged into the validators sent
+
+	Returns:
+	    dict: "etag" and "last_modified" when the server sent them
+	"""
+	validators = dict(validators or {})
+	for name, header in (("etag", "ETag"), ("last_modified", "Last-Modified")):
+		value = headers.get(header)
+		if value:
+			validators[name] = value
+	return validators
+
+def _fetch(url, layer_name, validators=None):
+	"""Download and decode a tile
+
+	Downloads answered with 429 or 5xx, or timing out, are retried after the
+	delay asked by the server or an exponential backoff.
+
+	Args:
+	    url (str): Url of the tile
+	    layer_name (str): Layer of the tile, used to label metrics
+	    validators (dict, optional): "etag" and "last_modified" of a cached
+	        copy of the tile, sent as a conditional request
+
+	Returns:
+	    image (np.ndarray): The tile, or None if the server answered that the
+	        cached copy is not modified
+	    validators (dict): Validators of the tile, see _validators
+	"""
+	headers = {}
+	if validators:
+		if validators.get("etag"):
+			headers["If-None-Match"] = validators["etag"]
+		if validators.get("last_modified"):
+			headers["If-Modified-Since"] = validators["last_modified"]
+	request = Request(url, headers=headers)
+
+	limiter = get_limiter(layer_name)
+	for attempt in range(_download_retries + 1):
+		with instrument.span("getimage_download_wait", layer=layer_name):
+			limiter.acquire()
+
+		start = time.time()
+		try:
+			with instrument.span("getimage_download", layer=layer_name):
+				response = urlopen(request, timeout=_download_timeout)
+				data = response.read()
+		except Exception as e:
+			if isinstance(e, HTTPError) and e.code == 304:
+				limiter.release(latency=time.time() - start)
+				instrument.count("getimage_not_modified", layer=layer_name)
+				return None, _validators(e.info(), validators)
+			overload = _is_overload(e)
+			limiter.release(overload=overload)
+			if not overload or attempt == _download_retries:
+				raise
+			instrument.count("getimage_download_retries", layer=layer_name)
+			time.sleep(_retry_delay(e, attempt))
+		else:
+			limiter.release(latency=time.time() - start)
+			break
+
+	instrument.count("getimage_bytes_fetched", len(data), layer=layer_name)
+
+	# Servers report errors such as a request too large as an XML document
+	if "xml" in (response.info().get("Content-Type") or ""):
+		raise ValueError("Service exception: %s" % data[:1000].decode("utf-8", "replace"))
+
+	import imageio
+	with instrument.span("getimage_decode", layer=layer_name):
+		return imageio.imread(data), _validators(response.info())
 
 def _mem_cache_dec(layer_name):
 	def _real_mem_cache_dec(func):
 		def f(tileMatrix, tileCol, tileRow, date=None):
 			key = "%s_%s_%s_%s_%s" % (layer_name, tileMatrix, tileCol, tileRow, date)
 			try:
-				return _mem_cache[key]
+				image = _mem_cache[key]
+				instrument.count("getimage_mem_cache_hits", layer=layer_name)
+				return image
 			except KeyError:
+				instrument.count("getimage_mem_cache_misses", layer=layer_name)
 				while len(_mem_cache) >= _mem_cache_limit:
 					_mem_cache.popitem()
 
@@ -65,25 +479,392 @@ def _mem_cache_dec(layer_name):
 		return f
 	return _real_mem_cache_dec
 
+def _constant(image):
+	"""Pixel value of a tile whose pixels are all equal
+
+	Args:
+	    image (np.ndarray): Tile
+
+	Returns:
+	    The value, a list with one value per band for multi-band tiles, or
+	    None if pixels differ
+	"""
+	first = image[0, 0]
+	if (image == first).all():
+		return np.asarray(first).tolist()
+	return None
+
+def _digest(image):
+	"""Content hash of a decoded tile"""
+	h = hashlib.sha1(("%s %s " % (image.dtype.str, image.shape)).encode("ascii"))
+	h.update(np.ascontiguousarray(image).tobytes())
+	return h.hexdigest()
+
+def _blob_path(digest, cache_dir=None):
+	return os.path.join(cache_dir or _file_cache_path, "blobs", "%s.png" % digest)
+
+def _atomic_write(fname, write):
+	"""Write a file of the cache under a temporary name and rename it, so
+	readers never see a partly written file
+
+	Returns:
+	    int: Size of the file
+	"""
+	tmp_fname = "%s.%d.%d.tmp%s" % (fname, os.getpid(),
+		threading.current_thread().ident, os.path.splitext(fname)[1])
+	try:
+		write(tmp_fname)
+		size = os.path.getsize(tmp_fname)
+		os.rename(tmp_fname, fname)
+	except Exception:
+		_remove(tmp_fname)
+		raise
+	return size
+
+def _remove(fname):
+	try:
+		os.remove(fname)
+	except OSError:
+		pass
+
+def _touch(fname, mtime=None):
+	"""Record an access to a file of the cache for the eviction order. The
+	modification time, which revalidation relies on, is kept.
+	"""
+	try:
+		if mtime is None:
+			mtime = os.stat(fname).st_mtime
+		os.utime(fname, (time.time(), mtime))
+	except OSError:
+		pass
+
+def _corrupt(key, *fnames):
+	"""Remove the files of a corrupt tile, e.g. left by a crash or a full
+	disk, so the tile is fetched again instead of failing on every read
+
+	Returns:
+	    IOError: The error to raise
+	"""
+	instrument.count("getimage_file_cache_corrupt")
+	for fname in fnames:
+		_remove(fname)
+	return IOError("Corrupt cache entry %s" % (key,))
+
+def _decode(key, fname, digest=None, fnames=()):
+	"""Decode a png file of the cache, checking its content hash
+
+	Args:
+	    key (str): Key of the tile
+	    fname (str): The png file
+	    digest (str, optional): Expected content hash, see _digest
+	    fnames (tuple, optional): Other files removed with a corrupt file
+
+	Returns:
+	    np.ndarray: The decoded file
+
+	Raises:
+	    IOError: The file is missing or corrupt
+	"""
+	import imageio
+	with open(fname, "rb") as f:
+		data = f.read()
+	try:
+		image = imageio.imread(data)
+		valid = digest is None or _digest(image) == digest
+	except Exception:
+		valid = False
+	if not valid:
+		raise _corrupt(key, fname, *fnames)
+	return image
+
+def _ref_path(key, cache_dir=None):
+	return os.path.join(cache_dir or _file_cache_path, "%s.ref" % key)
+
+def _read_ref(key, cache_dir=None):
+	"""Reference of a tile of the file cache, see read_cached_tile
+
+	Returns:
+	    dict: The reference, with the time the tile was "checked" last, the
+	        modification time of the reference. None if the tile is not
+	        stored by content.
+
+	Raises:
+	    IOError: The reference is corrupt
+	"""
+	fname = _ref_path(key, cache_dir)
+	try:
+		with open(fname) as f:
+			ref = json.load(f)
+			ref["checked"] = os.fstat(f.fileno()).st_mtime
+	except (OSError, IOError):
+		return None
+	except ValueError:
+		raise _corrupt(key, fname)
+	if not isinstance(ref, dict) or not ("sha1" in ref or "constant" in ref):
+		raise _corrupt(key, fname)
+	return ref
+
+def read_cached_tile(key, cache_dir=None, ref=None, copy=True):
+	"""Decoded tile of the file cache
+
+	Tiles are stored by content: <key>.ref names either a constant value,
+	which is kept as a read only broadcast array and never materialized,
+	or the content hash of a png file in blobs/, which is decoded once for
+	all tiles sharing it and checked against the hash. The reference also
+	keeps the validators of the tile, see set_revalidate. Tiles cached as
+	<key>.png by earlier versions are read as they are. Corrupt tiles are
+	removed, so they are fetched again.
+
+	Args:
+	    key (str): <layer>_<tileMatrix>_<tileCol>_<tileRow>_<date>
+	    cache_dir (str, optional): Cache directory. Defaults to the file cache
+	        of this module.
+	    ref (dict, optional): Reference of the tile already read
+	    copy (bool, optional): Return a writable copy. Otherwise the read only
+	        array shared by all the tiles of the same content is returned.
+
+	Returns:
+	    np.ndarray: The tile
+
+	Raises:
+	    IOError: The tile is not cached or is corrupt
+	"""
+	cache_dir = cache_dir or _file_cache_path
+	if ref is None:
+		ref = _read_ref(key, cache_dir)
+	if ref is None:
+		fname = os.path.join(cache_dir, "%s.png" % key)
+		image = _decode(key, fname)
+		_touch(fname)
+		return image
+
+	ref_fname = _ref_path(key, cache_dir)
+	if "constant" in ref:
+		try:
+			image = np.broadcast_to(np.array(ref["constant"], ref["dtype"]),
+				tuple(ref["shape"]))
+		except (KeyError, TypeError, ValueError):
+			raise _corrupt(key, ref_fname)
+	else:
+		fname = _blob_path(ref["sha1"], cache_dir)
+		image = _blob_cache.get(fname)
+		if image is None:
+			image = _share_blob(fname, _decode(key, fname, ref["sha1"], (ref_fname,)))
+	_touch(ref_fname, ref.get("checked"))
+	return np.array(image) if copy else image
+
+def _share_blob(fname, image):
+	"""Keep a decoded blob for all the tiles sharing it"""
+	image = np.asarray(image)
+	image.flags.writeable = False
+	while len(_blob_cache) >= _blob_cache_limit:
+		_blob_cache.popitem()
+	_blob_cache[fname] = image
+	return image
+
+def _write_ref(key, ref):
+	"""Write the reference of a tile
+
+	Returns:
+	    int: Size of the reference
+	"""
+	ref = dict((k, v) for k, v in ref.items() if k != "checked")
+	def write(tmp_fname):
+		with open(tmp_fname, "w") as f:
+			json.dump(ref, f)
+	return _atomic_write(_ref_path(key), write)
+
+def _write_cached_tile(key, image, layer_name, validators=None):
+	"""Store a tile in the file cache by content, see read_cached_tile
+
+	Returns:
+	    np.ndarray: The tile as read_cached_tile returns it without a copy
+	"""
+	import imageio
+	written = 0
+	value = _constant(image)
+	if value is not None:
+		instrument.count("getimage_file_cache_constant", layer=layer_name)
+		ref = {"constant": value, "dtype": image.dtype.str, "shape": list(image.shape)}
+		shared = np.broadcast_to(np.array(value, image.dtype), image.shape)
+	else:
+		digest = _digest(image)
+		ref = {"sha1": digest}
+		fname = _blob_path(digest)
+		if os.path.exists(fname):
+			instrument.count("getimage_file_cache_dedup", layer=layer_name)
+		else:
+			try:
+				os.mkdir(os.path.dirname(fname))
+			except OSError:
+				pass
+			written += _atomic_write(fname,
+				lambda tmp_fname: imageio.imwrite(tmp_fname, image))
+		shared = _blob_cache.get(fname)
+		if shared is None:
+			shared = _share_blob(fname, image)
+
+	ref.update(validators or {})
+	written += _write_ref(key, ref)
+	_account(written)
+	return shared
+
+def _account(nbytes):
+	"""Count bytes written to the file cache, evicting tiles once the cache
+	is over its budget
+	"""
+	global _cache_usage
+	if _cache_budget is None:
+		return
+	with _cache_usage_lock:
+		if _cache_usage is not None:
+			_cache_usage += nbytes
+		usage = _cache_usage
+	if usage is not None and usage <= _cache_budget:
+		return
+	# One thread evicts at a time, the others go on writing
+	if _evict_lock.acquire(False):
+		try:
+			_evict(int(_cache_budget * _cache_low_water))
+		finally:
+			_evict_lock.release()
+
+def evict(max_bytes=None):
+	"""Remove the tiles of the file cache read least recently until it fits
+	a budget
+
+	A content file in blobs/ goes with the last tile using it. Content files
+	no tile uses any more, e.g. replaced by revalidation, and temporary files
+	left by crashed writes are removed first.
+
+	Args:
+	    max_bytes (int or str, optional): Budget in bytes or a size like
+	        "500M". Defaults to the budget of set_cache_budget. Without a
+	        budget only unused files are removed.
+
+	Returns:
+	    int: Bytes left in the file cache
+	"""
+	if max_bytes is None:
+		max_bytes = _cache_budget
+	with _evict_lock:
+		return _evict(_parse_size(max_bytes))
+
+def _evict(max_bytes):
+	global _cache_usage
+	now = time.time()
+	blob_dir = os.path.join(_file_cache_path, "blobs")
+	entries = []
+	blobs = {}
+	total = 0
+	for directory in (_file_cache_path, blob_dir):
+		try:
+			names = os.listdir(directory)
+		except OSError:
+			continue
+		for name in names:
+			fname = os.path.join(directory, name)
+			try:
+				st = os.stat(fname)
+			except OSError:
+				continue
+			if not stat.S_ISREG(st.st_mode):
+				continue
+			if ".tmp" in name:
+				if now - st.st_mtime > _stale_tmp_age:
+					_remove(fname)
+				continue
+			total += st.st_size
+			if directory == blob_dir:
+				blobs[os.path.splitext(name)[0]] = (fname, st.st_size, st.st_mtime)
+			else:
+				entries.append((st.st_atime, fname, st.st_size))
+
+	# Number of tiles using every content file
+	digests = {}
+	users = {}
+	for _, fname, _ in entries:
+		if fname.endswith(".ref"):
+			try:
+				with open(fname) as f:
+					digest = json.load(f).get("sha1")
+			except (OSError, IOError, ValueError, AttributeError):
+				continue
+			if digest:
+				digests[fname] = digest
+				users[digest] = users.get(digest, 0) + 1
+
+	evicted = 0
+	for digest, (fname, size, mtime) in blobs.items():
+		# A content file just written may not have its reference yet
+		if not users.get(digest) and now - mtime > 60:
+			_remove(fname)
+			total -= size
+
+	entries.sort()
+	for _, fname, size in entries:
+		if max_bytes is None or total <= max_bytes:
+			break
+		_remove(fname)
+		total -= size
+		evicted += 1
+		digest = digests.get(fname)
+		if digest:
+			users[digest] -= 1
+			if not users[digest] and digest in blobs:
+				_remove(blobs[digest][0])
+				total -= blobs[digest][1]
+
+	if evicted:
+		instrument.count("getimage_file_cache_evictions", evicted)
+	with _cache_usage_lock:
+		_cache_usage = total
+	return total
+
+def _is_stale(ref):
+	"""Whether a cached tile is due for a check with the server"""
+	if _revalidate is None:
+		return False
+	return time.time() - (ref or {}).get("checked", 0) >= _revalidate
+
 def _file_cache_dec(layer_name):
 	def _real_file_cache_dec(func):
 		def f(tileMatrix, tileCol, tileRow, date=None):
 			key = "%s_%s_%s_%s_%s" % (layer_name, tileMatrix, tileCol, tileRow, date)
-			fname = os.path.join(_file_cache_path, "%s.png" % key)
 			try:
-				with _file_cache_lock:
-					return imageio.imread(fname)
+				with instrument.acquire(_file_cache_lock, "getimage_file_cache_lock_wait"):
+					with instrument.span("getimage_file_cache_read", layer=layer_name):
+						ref = _read_ref(key)
+						image = read_cached_tile(key, ref=ref, copy=False)
 			except (OSError, IOError):
-				image = func(tileMatrix, tileCol, tileRow, date)
-				with _file_cache_lock:
-					imageio.imwrite(fname, image)
-				return image
+				instrument.count("getimage_file_cache_misses", layer=layer_name)
+				validators = None
+			else:
+				instrument.count("getimage_file_cache_hits", layer=layer_name)
+				if not _is_stale(ref):
+					return image
+				validators = ref
+
+			# Conditional request if the tile is cached
+			fetched, validators = func(tileMatrix, tileCol, tileRow, date,
+				validators=validators)
+			with instrument.acquire(_file_cache_lock, "getimage_file_cache_lock_wait"):
+				if fetched is None:
+					# Only the time of the check changes, unless the server
+					# sent new validators
+					if validators == ref:
+						os.utime(_ref_path(key), None)
+					else:
+						_write_ref(key, validators)
+					return image
+				_makedirs_cache()
+				with instrument.span("getimage_file_cache_write", layer=layer_name):
+					return _write_cached_tile(key, fetched, layer_name, validators)
 		return f
 	return _real_file_cache_dec
 
-@_mem_cache_dec("VIIRS_SNPP_DayNightBand_ENCC")
 @_file_cache_dec("VIIRS_SNPP_DayNightBand_ENCC")
-def _get_image(tileMatrix, tileCol, tileRow, date):
+def _get_image_file(tileMatrix, tileCol, tileRow, date, validators=None):
 	"""Get a matrix for a given date. Result is cached.
 
 	Args:
@@ -91,6 +872,7 @@ def _get_image(tileMatrix, tileCol, tileRow, date):
 	    tileCol (int, optional): Column
 	    tileRow (int, optional): Row
 	    date (str, optional): Date string in iso format
+	    validators (dict, optional): Validators of the cached tile. See _fetch.
 
 	Returns:
 	    Image: A numpy matrix
@@ -102,10 +884,11 @@ def _get_image(tileMatrix, tileCol, tileRow, date):
 		date=date
 	)
 
-	with _concurrent_semaphore:
-		return imageio.imread(url)
+	return _fetch(url, "VIIRS_SNPP_DayNightBand_ENCC", validators)
+
+_get_image = _mem_cache_dec("VIIRS_SNPP_DayNightBand_ENCC")(_get_image_file)
 
-def get_image(tileMatrix=5, tileCol=6, tileRow=5, date="2017-10-31", sea="smooth"):
+def get_image(tileMatrix=5, tileCol=6, tileRow=5, date="2017-10-31", sea="smooth", precision=None, copy=True):
 	"""Get a matrix for a tile. Data for sea area can be masked out.
 
 	If sea is set to "smooth", a numpy.array is returned. Pixels for sea area
@@ -122,6 +905,11 @@ def get_image(tileMatrix=5, tileCol=6, tileRow=5, date="2017-10-31", sea="smooth
 	    tileRow (int, optional): Row
 	    date (str, optional): Date string in iso format
 	    sea (str, optional): Specify how sea pixels are handled. See above.
+	    precision (str, optional): Precision policy of "smooth" images. See
+	        the precision module.
+	    copy (bool, optional): Return original data as a writable copy.
+	        Otherwise the read only array shared with the caches is returned,
+	        which keeps tiles of a constant value unmaterialized.
 
 	Returns:
 	    TYPE: Description
@@ -141,16 +929,16 @@ def get_image(tileMatrix=5, tileCol=6, tileRow=5, date="2017-10-31", sea="smooth
 		)
 
 	if sea == "smooth":
-		return np.multiply(image.astype(np.float), land_mask) / 255.0
+		accum = get_policy(precision).accum
+		return np.multiply(image, land_mask, dtype=accum) / accum.type(255)
 	elif sea == "masked":
 		sea_mask = np.invert(land_mask)
 		return np.ma.masked_where(land_mask < 128, image)
 	else:
-		return image
+		return np.array(image) if copy else image
 
-@_mem_cache_dec("OSM_Land_Mask")
 @_file_cache_dec("OSM_Land_Mask")
-def _get_mask(tileMatrix=5, tileCol=6, tileRow=5, date=None):
+def _get_mask(tileMatrix=5, tileCol=6, tileRow=5, date=None, validators=None):
 	url = _build_url(
 		tileMatrix=tileMatrix,
 		tileCol=tileCol,
@@ -160,8 +948,169 @@ def _get_mask(tileMatrix=5, tileCol=6, tileRow=5, date=None):
 		tilematrixset="250m"
 	)
 
-	with _concurrent_semaphore:
-		return imageio.imread(url)
+	return _fetch(url, "OSM_Land_Mask", validators)
+
+class PackedMask(object):
+
+	"""Compact land mask of a tile
+
+	Land and sea pixels are stored as one bit each. The few anti-aliased coast
+	line pixels are stored separately as flat indices and values.
+
+	Attributes:
+	    coast_index (np.array): Flat indices of the coast line pixels
+	    coast_value (np.array): uint8 values of the coast line pixels
+	    land (np.array): Bit-packed land pixels
+	    shape (tuple): Height and width of the mask
+	"""
+
+	def __init__(self, land, coast_index, coast_value, shape):
+		self.land = land
+		self.coast_index = coast_index
+		self.coast_value = coast_value
+		self.shape = tuple(shape)
+
+	@classmethod
+	def from_array(cls, mask):
+		"""Pack a uint8 mask
+
+		Args:
+		    mask (np.array): uint8 array. 255 means land, 0 means sea.
+
+		Returns:
+		    PackedMask: The packed mask
+		"""
+		mask = np.asarray(mask, np.uint8)
+		flat = mask.ravel()
+		coast_index = np.flatnonzero((flat > 0) & (flat < 255)).astype(np.uint32)
+		return cls(
+			np.packbits(flat == 255),
+			coast_index,
+			flat[coast_index],
+			mask.shape)
+
+	@classmethod
+	def from_children(cls, children):
+		"""Mask of a tile made of the masks of its four tiles at the next zoom
+
+		Args:
+		    children (list): 2x2 nested list of PackedMask, rows first
+
+		Returns:
+		    PackedMask: The packed mask, with the shape of one child
+		"""
+		mask = np.block([[child.unpack() for child in row] for row in children])
+		h, w = mask.shape
+		mask = mask.reshape(h // 2, 2, w // 2, 2).mean(axis=(1, 3))
+		return cls.from_array(np.round(mask).astype(np.uint8))
+
+	def unpack(self):
+		"""Expand the mask
+
+		Returns:
+		    np.array: uint8 array. 255 means land, 0 means sea.
+		"""
+		size = self.shape[0] * self.shape[1]
+		flat = np.unpackbits(self.land)[:size] * np.uint8(255)
+		flat[self.coast_index] = self.coast_value
+		return flat.reshape(self.shape)
+
+	@property
+	def nbytes(self):
+		return self.land.nbytes + self.coast_index.nbytes + self.coast_value.nbytes
+
+	def save(self, fname):
+		def write(tmp_fname):
+			with open(tmp_fname, "wb") as f:
+				np.savez(f, land=self.land, coast_index=self.coast_index,
+					coast_value=self.coast_value, shape=np.array(self.shape))
+		return _atomic_write(fname, write)
+
+	@classmethod
+	def load(cls, fname):
+		with np.load(fname) as f:
+			return cls(f["land"], f["coast_index"], f["coast_value"], f["shape"])
+
+_mask_cache = {}
+_mask_locks = {}
+_mask_locks_lock = threading.Lock()
+
+def _packed_mask_path(tileMatrix, tileCol, tileRow):
+	return os.path.join(_file_cache_path,
+		"packed_mask_%s_%s_%s.npz" % (tileMatrix, tileCol, tileRow))
+
+def _cached_packed_mask(tileMatrix, tileCol, tileRow):
+	key = (tileMatrix, tileCol, tileRow)
+	try:
+		return _mask_cache[key]
+	except KeyError:
+		pass
+	fname = _packed_mask_path(*key)
+	if not os.path.exists(fname):
+		return None
+	try:
+		packed = PackedMask.load(fname)
+	except (OSError, IOError, KeyError, ValueError, zipfile.BadZipfile):
+		_corrupt("OSM_Land_Mask_%s_%s_%s" % key, fname)
+		return None
+	_touch(fname)
+
+	while len(_mask_cache) >= _mem_cache_limit:
+		_mask_cache.popitem()
+	_mask_cache[key] = packed
+	return packed
+
+def get_packed_mask(tileMatrix=5, tileCol=6, tileRow=5, derive=True):
+	"""Get the packed land mask of a tile. Result is cached.
+
+	If derive is set and the masks of the four tiles covering this tile at
+	the next zoom in level are cached, the mask is derived from them instead
+	of being fetched.
+
+	Args:
+	    tileMatrix (int, optional): Zoom in level
+	    tileCol (int, optional): Column
+	    tileRow (int, optional): Row
+	    derive (bool, optional): Derive the mask from cached finer masks
+
+	Returns:
+	    PackedMask: The packed mask
+	"""
+	key = (tileMatrix, tileCol, tileRow)
+	packed = _cached_packed_mask(*key)
+	if packed is not None:
+		return packed
+
+	with _mask_locks_lock:
+		lock = _mask_locks.setdefault(key, threading.Lock())
+
+	# Only one thread fetches a mask; the others wait and read the cache
+	with lock:
+		packed = _cached_packed_mask(*key)
+		if packed is not None:
+			return packed
+
+		children = None
+		if derive:
+			children = [[_cached_packed_mask(tileMatrix + 1, 2 * tileCol + i,
+					2 * tileRow + j) for i in range(2)] for j in range(2)]
+			if any(child is None for row in children for child in row):
+				children = None
+
+		if children:
+			packed = PackedMask.from_children(children)
+		else:
+			image_mask = _get_mask(
+				tileMatrix=tileMatrix,
+				tileCol=tileCol,
+				tileRow=tileRow
+			)
+			packed = PackedMask.from_array(image_mask.take(-1, axis=2))
+
+		_makedirs_cache()
+		_account(packed.save(_packed_mask_path(*key)))
+		_mask_cache[key] = packed
+	return packed
 
 def get_mask(tileMatrix=5, tileCol=6, tileRow=5):
 	"""Get land mask for a tile
@@ -175,14 +1124,89 @@ def get_mask(tileMatrix=5, tileCol=6, tileRow=5):
 	    np.array: 512x512 uint8 array. 255 means land, 0 means sea. Coast line
 	              is anti-aliased, so it can be anything between 1~254
 	"""
-	image_mask = _get_mask(
+	return get_packed_mask(
+		tileMatrix=tileMatrix,
+		tileCol=tileCol,
+		tileRow=tileRow
+	).unpack()
+
+def apply_mask(image, tileMatrix=5, tileCol=6, tileRow=5, precision=None):
+	"""Set sea pixels of an image of a tile to 0, anti-aliasing coast lines
+
+	Applying the mask to a composite gives the same result as applying it to
+	every day, at the cost of a single pass.
+
+	Args:
+	    image (np.array): Image of the tile, e.g. a composite
+	    tileMatrix (int, optional): Zoom in level
+	    tileCol (int, optional): Column
+	    tileRow (int, optional): Row
+	    precision (str, optional): Precision policy of the result. See the
+	        precision module.
+
+	Returns:
+	    np.array: The masked image
+	"""
+	land_mask = get_mask(
 		tileMatrix=tileMatrix,
 		tileCol=tileCol,
 		tileRow=tileRow
 	)
+	accum = get_policy(precision).accum
+	return np.multiply(image, land_mask, dtype=accum) / accum.type(255)
+
+def precompute_masks(tileMatrix=6, tileCol=12, tileRow=10, num_cols=3,
+		num_rows=3, min_zoom=1):
+	"""Fetch the masks of a region and derive the masks of coarser zooms
+
+	Args:
+	    tileMatrix (int, optional): Zoom in level of the region
+	    tileCol (int, optional): Column of the top left tile
+	    tileRow (int, optional): Row of the top left tile
+	    num_cols (int, optional): Width of the region in tiles
+	    num_rows (int, optional): Height of the region in tiles
+	    min_zoom (int, optional): Coarsest zoom in level to derive
+	"""
+	col0, row0 = tileCol, tileRow
+	col1, row1 = tileCol + num_cols - 1, tileRow + num_rows - 1
+	for zoom in range(tileMatrix, min_zoom - 1, -1):
+		shift = tileMatrix - zoom
+		for row in range(row0 >> shift, (row1 >> shift) + 1):
+			for col in range(col0 >> shift, (col1 >> shift) + 1):
+				get_packed_mask(zoom, col, row)
+
+def date_range(start_date, num_days=None, end_date=None):
+	"""Dates of a date range in iso format, like get_image_date_range
+
+	Args:
+	    start_date (str): First date
+	    num_days (int, optional): Number of days after the first date. Takes
+	        precedence over end_date.
+	    end_date (str, optional): Last date, inclusive
+
+	Returns:
+	    list: The dates
+
+	Raises:
+	    ValueError: Neither num_days nor end_date is given
+	"""
+	import dateutil.parser
+	start_date = dateutil.parser.parse(start_date).date()
+	if end_date:
+		end_date = dateutil.parser.parse(end_date).date()
+
+	if num_days:
+		end_date = start_date + datetime.timedelta(days=num_days)
+
+	if not end_date:
+		raise ValueError("num_days and end_date can not be both None")
 
-	array_mask = image_mask.take(-1, axis=2)
-	return array_mask
+	dates = []
+	date = start_date
+	while date <= end_date:
+		dates.append(date.isoformat())
+		date += datetime.timedelta(days=1)
+	return dates
 
 class _GetImageThread(threading.Thread):
 	def __init__(self, **kwargs):
@@ -221,25 +1245,213 @@ def get_image_date_range(
 	Raises:
 	    ValueError: Neither of num_days and end_date is set.
 	"""
-	start_date = dateutil.parser.parse(start_date).date()
-	if end_date:
-		end_date = dateutil.parser.parse(end_date).date()
+	threads = []
+	for date in date_range(start_date, num_days, end_date):
+		thread = _GetImageThread(date=date, **kwargs)
 
-	if num_days:
-		end_date = start_date + datetime.timedelta(days=num_days)
+		thread.start()
+		threads.append(thread)
 
-	if not end_date:
-		raise ValueError("num_days and end_date can not be both None")
+	return [thread.result for thread in threads]
 
+def _build_map_url(layer_name, tileMatrix, tileCol, tileRow, num_cols, num_rows, date=None):
+	tile_degrees = 288.0 / 2 ** tileMatrix
+	north = 90.0 - tileRow * tile_degrees
+	west = -180.0 + tileCol * tile_degrees
+	parameters = {
+		"Service": "WMS",
+		"Request": "GetMap",
+		"Version": "1.3.0",
+		"Layers": layer_name,
+		"Styles": "",
+		"CRS": "EPSG:4326",
+		# WMS 1.3.0 puts the latitude first in EPSG:4326
+		"BBox": "%r,%r,%r,%r" % (north - num_rows * tile_degrees, west,
+			north, west + num_cols * tile_degrees),
+		"Width": num_cols * _tile_size,
+		"Height": num_rows * _tile_size,
+		"Format": "image/png"
+	}
+	if date:
+		parameters["TIME"] = date
+	return _wms_url + urlencode(parameters)
 
-	threads = []
-	date = start_date
-	while date <= end_date:
-		thread = _GetImageThread(date=date.isoformat(), **kwargs)
+def _region_chunks(tileCol, tileRow, num_cols, num_rows, step):
+	"""Split a region into chunks of at most step x step tiles
 
-		thread.start()
-		threads.append(thread)
+	Yields:
+	    tuple: Column, row, number of columns and number of rows of every
+	        chunk
+	"""
+	for row in range(tileRow, tileRow + num_rows, step):
+		for col in range(tileCol, tileCol + num_cols, step):
+			yield (col, row, min(step, tileCol + num_cols - col),
+				min(step, tileRow + num_rows - row))
 
-		date += datetime.timedelta(days=1)
+def _is_cached(key):
+	return (key in _mem_cache or os.path.exists(_ref_path(key))
+		or os.path.exists(os.path.join(_file_cache_path, "%s.png" % key)))
 
-	return [thread.result for thread in threads]
+def is_cached(layer_name, tileMatrix, tileCol, tileRow, date=None):
+	"""Whether a tile is in the memory or file cache
+
+	Land masks also count as cached when their packed mask is.
+
+	Args:
+	    layer_name (str): "VIIRS_SNPP_DayNightBand_ENCC" or "OSM_Land_Mask"
+	    tileMatrix (int): Zoom in level
+	    tileCol (int): Column
+	    tileRow (int): Row
+	    date (str, optional): Date string in iso format, None for masks
+
+	Returns:
+	    bool: True if the tile is cached
+	"""
+	if layer_name == "OSM_Land_Mask" and os.path.exists(
+			_packed_mask_path(tileMatrix, tileCol, tileRow)):
+		return True
+	return _is_cached("%s_%s_%s_%s_%s" % (layer_name, tileMatrix, tileCol, tileRow, date))
+
+def fetch_tile(layer_name, tileMatrix, tileCol, tileRow, date=None):
+	"""Fetch a tile into the file cache without keeping it in memory, e.g.
+	to fill the cache ahead of time. Cached tiles are not fetched again
+	unless they are due for revalidation, see set_revalidate.
+
+	Args:
+	    layer_name (str): "VIIRS_SNPP_DayNightBand_ENCC" or "OSM_Land_Mask"
+	    tileMatrix (int): Zoom in level
+	    tileCol (int): Column
+	    tileRow (int): Row
+	    date (str, optional): Date string in iso format, None for masks
+
+	Raises:
+	    ValueError: Unknown layer
+	"""
+	fetchers = {
+		"VIIRS_SNPP_DayNightBand_ENCC": _get_image_file,
+		"OSM_Land_Mask": _get_mask
+	}
+	if layer_name not in fetchers:
+		raise ValueError("Unknown layer %s" % layer_name)
+	fetchers[layer_name](tileMatrix, tileCol, tileRow, date)
+
+def _fetch_region(layer_name, tileMatrix, tileCol, tileRow, num_cols, num_rows, date=None):
+	"""Fetch the tiles of a region with one GetMap request and store them in
+	the file cache. Requests the server refuses as too large are split in
+	four, and later requests are kept under the size which worked.
+
+	Returns:
+	    int: Number of GetMap requests
+	"""
+	global _wms_max_size
+	url = _build_map_url(layer_name, tileMatrix, tileCol, tileRow,
+		num_cols, num_rows, date)
+	try:
+		with instrument.span("getimage_region", layer=layer_name):
+			image, _ = _fetch(url, layer_name)
+		if image.shape[:2] != (num_rows * _tile_size, num_cols * _tile_size):
+			raise ValueError("Map of %dx%d tiles has shape %s" % (
+				num_cols, num_rows, image.shape))
+	except (HTTPError, ValueError) as e:
+		refused = not isinstance(e, HTTPError) or e.code in (400, 413)
+		step = (max(num_cols, num_rows) + 1) // 2
+		if not refused or max(num_cols, num_rows) == 1:
+			raise
+		instrument.count("getimage_region_splits", layer=layer_name)
+		_wms_max_size = min(_wms_max_size, step * _tile_size)
+		return 1 + sum(_fetch_region(layer_name, tileMatrix, *chunk, date=date)
+			for chunk in _region_chunks(tileCol, tileRow, num_cols, num_rows, step))
+
+	_makedirs_cache()
+	for j in range(num_rows):
+		for i in range(num_cols):
+			key = "%s_%s_%s_%s_%s" % (layer_name, tileMatrix, tileCol + i,
+				tileRow + j, date)
+			tile = np.ascontiguousarray(image[j * _tile_size:(j + 1) * _tile_size,
+				i * _tile_size:(i + 1) * _tile_size])
+			with instrument.acquire(_file_cache_lock, "getimage_file_cache_lock_wait"):
+				if not _is_cached(key):
+					_write_cached_tile(key, tile, layer_name)
+	return 1
+
+def _run_threads(funcs):
+	"""Call functions in threads of their own
+
+	Returns:
+	    list: Results of the functions
+
+	Raises:
+	    Exception: The first exception raised by a function
+	"""
+	results = [None] * len(funcs)
+	errors = []
+
+	def run(i, func):
+		try:
+			results[i] = func()
+		except Exception as e:
+			errors.append(e)
+
+	threads = [threading.Thread(target=run, args=(i, func))
+		for i, func in enumerate(funcs)]
+	for thread in threads: thread.start()
+	for thread in threads: thread.join()
+	if errors:
+		raise errors[0]
+	return results
+
+def prefetch_region(
+		tileMatrix=6,
+		tileCol=12,
+		tileRow=10,
+		num_cols=3,
+		num_rows=3,
+		start_date="2017-10-01",
+		num_days=None,
+		end_date="2017-10-10",
+		masks=True):
+	"""Fetch the tiles of a region for a date range, one WMS GetMap request
+	per day. Does nothing in "tile" mode, see set_fetch_mode.
+
+	The map of every day is sliced into tiles, which are stored in the file
+	cache where get_image and get_mask find them, so processing the region
+	makes no further requests. Days whose tiles are all cached are skipped.
+	Regions larger than the size limit of the server take several requests.
+
+	Args:
+	    tileMatrix (int, optional): Zoom in level
+	    tileCol (int, optional): Column of the top left tile
+	    tileRow (int, optional): Row of the top left tile
+	    num_cols (int, optional): Number of tile columns
+	    num_rows (int, optional): Number of tile rows
+	    start_date (str, optional): start date
+	    num_days (int, optional): number of days
+	    end_date (str, optional): end date
+	    masks (bool, optional): Also fetch the land masks of the region
+
+	Returns:
+	    int: Number of GetMap requests
+	"""
+	if _fetch_mode != "region":
+		return 0
+
+	def missing(layer_name, date, col, row, cols, rows):
+		return not all(is_cached(layer_name, tileMatrix, c, r, date)
+			for r in range(row, row + rows) for c in range(col, col + cols))
+
+	def fetch(layer_name, date):
+		# Chunks follow the size limit learned by the requests before
+		step = max(1, _wms_max_size // _tile_size)
+		return sum(_fetch_region(layer_name, tileMatrix, *chunk, date=date)
+			for chunk in _region_chunks(tileCol, tileRow, num_cols, num_rows, step)
+			if missing(layer_name, date, *chunk))
+
+	jobs = [("VIIRS_SNPP_DayNightBand_ENCC", date)
+		for date in date_range(start_date, num_days, end_date)]
+	if masks:
+		jobs.insert(0, ("OSM_Land_Mask", None))
+
+	# The first request finds out whether the server takes maps of this size
+	requests = fetch(*jobs[0])
+	return requests + sum(_run_threads([lambda job=job: fetch(*job)
+		for job in jobs[1:]]))
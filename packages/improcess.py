@@ -1,73 +1,217 @@
-from numpy import *
-from PIL import Image
-import matplotlib.pyplot as plt
-import imageio
-from scipy import signal
 import getimage
 import conversion
+import composite
+import instrument
 import numpy as np
+import ops
+from precision import get_policy
 
 
-def get_processed_image_clip(start_date="2017-10-01", num_days=31, end_date=None,**kwargs):
+# Height and width of the blocks processed at once, small enough for the
+# buffers of a block to stay in cache
+_block = 256
+
+def _local_stats(im, mysize, policy):
     '''
-    Intake a date range of photo records and then generate the enhanced resulted single image
+    Local mean and variance over mysize x mysize windows, with zeros outside
+    the image like scipy.signal.wiener. The moments stay float64 until the
+    variance is taken, since E[x^2] - E[x]^2 cancels most float32 digits
+    around bright lights.
+
+    output: (np.array, np.array)
+    '''
+    from scipy import ndimage
+    l_mean = ndimage.uniform_filter(im, mysize, output=np.float64, mode="constant")
+    l_var = ndimage.uniform_filter(np.square(im, dtype=np.float64), mysize,
+        output=np.float64, mode="constant")
+    l_var -= l_mean * l_mean
+    return l_mean.astype(policy.accum, copy=False), l_var.astype(policy.accum, copy=False)
+
+def _wiener(im, mysize, policy, noise=None):
+    '''
+    Wiener filter keeping the accumulator type of the precision policy.
+    float64 uses scipy.signal.wiener. Other policies compute the same local
+    mean and variance with uniform filters, which keep float32 throughout.
+    The noise power defaults to the mean local variance of the image.
+
+    output: np.array
+    '''
+    if policy.accum == np.float64:
+        from scipy import signal
+        # Flat windows divide by a zero variance, and scipy replaces the
+        # result with the local mean there
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return signal.wiener(im, mysize, noise)
+
+    im = im.astype(policy.accum, copy=False)
+    l_mean, l_var = _local_stats(im, mysize, policy)
+    if noise is None:
+        noise = float(l_var.mean(dtype=np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = (im - l_mean) * (1 - noise / l_var) + l_mean
+    return np.where(l_var < noise, l_mean, res)
+
+def _clip(out, avg=60):
+    '''
+    Halve the brightness of pixels in the band of typical suburban light.
+
+    output: np.array
+    '''
+    out[(out >= 0.9*avg) & (out <= 1.7*avg)] *= 0.5
+    return out
+
+def _band_reject(out, avg=60.0, bandwidth=40, reject_ratio=0.4):
+    '''
+    Attenuate pixels around avg with a band reject response, in place:
+    x * (sqrt((avg^2 - x^2)^2 / ((2*bandwidth)^2 * x^2 + (avg^2 - x^2)^2)) * reject_ratio + 1 - reject_ratio)
+
+    output: np.array
+    '''
+    x2 = out * out
+    gain = avg**2 - x2
+    gain *= gain
+    x2 *= (2*bandwidth)**2
+    x2 += gain
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gain /= x2
+    np.sqrt(gain, out=gain)
+    gain *= reject_ratio
+    gain += 1 - reject_ratio
+    out *= gain
+    return out
+
+_filters = {
+    "clip": _clip,
+    "band_reject": _band_reject
+}
+
+def _round(out):
+    return np.round(out, out=out)
+
+def _wiener_op(policy, mysize=5):
+    '''
+    Wiener filter operator, whose noise power is the mean local variance of
+    its whole input like scipy.signal.wiener.
+
+    output: ops.Stencil
+    '''
+    return ops.Stencil(lambda win, noise: _wiener(win, mysize, policy, noise),
+        mysize // 2, statistic=lambda win: _local_stats(win, mysize, policy)[1],
+        name="wiener")
+
+def pipeline(method="clip", precision=None):
+    '''
+    Operator chain of a processing method, applied to a composite: round,
+    normalize by the maximum, Wiener filter, clip or band reject filter and
+    Wiener filter. New methods only need a filter in _filters.
+    param: method                                 type:string ("clip" or "band_reject")
+    param: precision                              type:string ("float64", "float32" or "uint8", see the precision module)
+
+    output: ops.Pipeline
+    '''
+    if method not in _filters:
+        raise ValueError("Unknown method %s" % method)
+    policy = get_policy(precision)
+    return ops.Pipeline([
+        ops.Map(_round, "round"),
+        ops.Normalize(255.0),
+        _wiener_op(policy),
+        ops.Map(_filters[method], method),
+        _wiener_op(policy)], policy.accum, policy.cast_output)
+
+def _get_composite(start_date, num_days, end_date, statistic, missing, q, trim, policy, sea="smooth", **kwargs):
+    '''
+    Composite the raw images of a date range. For sea="smooth" the land mask is
+    applied once to the composite instead of to every day.
+
+    output: np.array
+    '''
+    with instrument.span("improcess_fetch"):
+        l = getimage.get_image_date_range(start_date, num_days, end_date,
+            sea=None if sea == "smooth" else sea, copy=False, **kwargs)
+    with instrument.span("improcess_composite", statistic=statistic):
+        arr, _ = composite.composite(l, statistic, missing=missing, q=q, trim=trim,
+            dtype=policy.accum)
+    if sea == "smooth":
+        tile = dict((k, kwargs[k]) for k in ("tileMatrix", "tileCol", "tileRow") if k in kwargs)
+        arr = getimage.apply_mask(arr, precision=policy, **tile)
+    return arr
+
+def get_composite(start_date="2017-10-01", num_days=31, end_date=None, statistic="mean", missing=None, q=50, trim=0.1, precision=None, **kwargs):
+    '''
+    Composite of the raw images of a date range, before any processing, e.g. to
+    downsample composites before normalizing them
     param: start date                             type:string
     param: num_days                               type:int
     param: end_date                               type:string
+    param: statistic                              type:string ("mean", "median", "trimmed_mean" or "percentile")
+    param: missing                                type:float (pixel value of missing days, e.g. 0)
+    param: q                                      type:float (percentile for "percentile")
+    param: trim                                   type:float (fraction cut from each end for "trimmed_mean")
+    param: precision                              type:string ("float64", "float32" or "uint8", see the precision module)
 
     output: np.array
+    '''
+    return _get_composite(start_date, num_days, end_date, statistic, missing, q, trim, get_policy(precision), **kwargs)
 
+def process_composite(arr, method="clip", precision=None):
     '''
-    l = getimage.get_image_date_range(start_date, num_days, end_date, **kwargs)
-    w,h=l[0].shape
-    arr=zeros((h,w),float)
-    N=len(l)
-    for im in l:
-        imarr=array(im,dtype=float)
-        arr=arr+imarr/N
-    out = matrix.round(arr)
-    out *= 255.0/out.max()
-    out = signal.wiener(out,5)
-    avg=60
+    Run the pipeline of a processing method on a composite in blocks
+    param: arr                                    type:np.array (composite, see get_composite)
+    param: method                                 type:string ("clip" or "band_reject")
+    param: precision                              type:string ("float64", "float32" or "uint8", see the precision module)
 
-    out[(out >= 0.9*avg) & (out <= 1.7*avg)] *= 0.5
+    output: np.array
+    '''
+    with instrument.span("improcess_pipeline", method=method):
+        return pipeline(method, precision).run(arr, block=_block)
 
-    filtered = signal.wiener(out,5)
-    return filtered
+def _processed_image(method, start_date, num_days, end_date, statistic, missing, q, trim, precision, **kwargs):
+    '''
+    Composite a date range and run the pipeline of a processing method on it
+    in blocks, one tile at a time.
 
-def get_processed_image_band_reject(start_date="2017-10-01", num_days=31, end_date=None,**kwargs):
+    output: np.array
+    '''
+    policy = get_policy(precision)
+    arr = _get_composite(start_date, num_days, end_date, statistic, missing, q, trim, policy, **kwargs)
+    return process_composite(arr, method, policy)
+
+def get_processed_image_clip(start_date="2017-10-01", num_days=31, end_date=None, statistic="mean", missing=None, q=50, trim=0.1, precision=None, **kwargs):
     '''
     Intake a date range of photo records and then generate the enhanced resulted single image
     param: start date                             type:string
     param: num_days                               type:int
     param: end_date                               type:string
+    param: statistic                              type:string ("mean", "median", "trimmed_mean" or "percentile")
+    param: missing                                type:float (pixel value of missing days, e.g. 0)
+    param: q                                      type:float (percentile for "percentile")
+    param: trim                                   type:float (fraction cut from each end for "trimmed_mean")
+    param: precision                              type:string ("float64", "float32" or "uint8", see the precision module)
 
     output: np.array
 
     '''
-    l = getimage.get_image_date_range(start_date, num_days, end_date, **kwargs)
-    w,h=l[0].shape
-    arr=zeros((h,w),float)
-    N=len(l)
-    for im in l:
-        imarr=array(im,dtype=float)
-        arr=arr+imarr/N
-    out = matrix.round(arr)
-    out *= 255.0/out.max()
-    out = signal.wiener(out,5)
+    return _processed_image("clip", start_date, num_days, end_date, statistic, missing, q, trim, precision, **kwargs)
 
-    avg=60.0
-    bandwidth = 40
-    reject_ratio = 0.4
+def get_processed_image_band_reject(start_date="2017-10-01", num_days=31, end_date=None, statistic="mean", missing=None, q=50, trim=0.1, precision=None, **kwargs):
+    '''
+    Intake a date range of photo records and then generate the enhanced resulted single image
+    param: start date                             type:string
+    param: num_days                               type:int
+    param: end_date                               type:string
+    param: statistic                              type:string ("mean", "median", "trimmed_mean" or "percentile")
+    param: missing                                type:float (pixel value of missing days, e.g. 0)
+    param: q                                      type:float (percentile for "percentile")
+    param: trim                                   type:float (fraction cut from each end for "trimmed_mean")
+    param: precision                              type:string ("float64", "float32" or "uint8", see the precision module)
 
-    myFunc = np.vectorize(lambda x:
-        x * (((avg**2 - x**2)**2/((2*bandwidth)**2 * x**2 + (avg**2 - x**2)**2))**0.5*reject_ratio + (1 - reject_ratio)))
-    out = myFunc(out)
+    output: np.array
 
-    filtered = signal.wiener(out,5)
-    return filtered
+    '''
+    return _processed_image("band_reject", start_date, num_days, end_date, statistic, missing, q, trim, precision, **kwargs)
 
-def get_california_image(tileMatrix=6, tileCol=12, tileRow=10, start_date="2017-10-01", num_days=31, improcess_select=None):
+def get_california_image(tileMatrix=6, tileCol=12, tileRow=10, start_date="2017-10-01", num_days=31, improcess_select=None, precision=None):
     """
     To obtain the whole california light pollution map and the mask for the land for given start date.
     
@@ -78,21 +222,25 @@ def get_california_image(tileMatrix=6, tileCol=12, tileRow=10, start_date="2017-
         start_date (str, optional): The starting date.
         num_days (int, optional): The number of days used for image processing.
         improcess_select (str, optional): To select from the clip and band reject image processing method('band_reject').
+        precision (str, optional): The precision policy ("float64", "float32" or "uint8").
     Returns:
         im (np.ndarray): The processed california light pollution map.
         mask (np.ndarray): The mask for the land (ocean = 0, land = 1).
     """
+    # In "region" mode the tiles of every day are fetched with one request
+    getimage.prefetch_region(tileMatrix, tileCol, tileRow, 3, 3,
+        start_date=start_date, num_days=num_days, end_date=None)
     im = []
     mask = []
     for i in range(3):
         if improcess_select == 'band_reject':
-            im1 = get_processed_image_band_reject(tileMatrix=tileMatrix, tileCol=tileCol, tileRow=tileRow+i, start_date=start_date)
-            im2 = get_processed_image_band_reject(tileMatrix=tileMatrix, tileCol=tileCol+1, tileRow=tileRow+i, start_date=start_date)
-            im3 = get_processed_image_band_reject(tileMatrix=tileMatrix, tileCol=tileCol+2, tileRow=tileRow+i, start_date=start_date)
+            im1 = get_processed_image_band_reject(tileMatrix=tileMatrix, tileCol=tileCol, tileRow=tileRow+i, start_date=start_date, num_days=num_days, precision=precision)
+            im2 = get_processed_image_band_reject(tileMatrix=tileMatrix, tileCol=tileCol+1, tileRow=tileRow+i, start_date=start_date, num_days=num_days, precision=precision)
+            im3 = get_processed_image_band_reject(tileMatrix=tileMatrix, tileCol=tileCol+2, tileRow=tileRow+i, start_date=start_date, num_days=num_days, precision=precision)
         else:
-            im1 = get_processed_image_clip(tileMatrix=tileMatrix, tileCol=tileCol, tileRow=tileRow+i, start_date=start_date)
-            im2 = get_processed_image_clip(tileMatrix=tileMatrix, tileCol=tileCol+1, tileRow=tileRow+i, start_date=start_date)
-            im3 = get_processed_image_clip(tileMatrix=tileMatrix, tileCol=tileCol+2, tileRow=tileRow+i, start_date=start_date)
+            im1 = get_processed_image_clip(tileMatrix=tileMatrix, tileCol=tileCol, tileRow=tileRow+i, start_date=start_date, num_days=num_days, precision=precision)
+            im2 = get_processed_image_clip(tileMatrix=tileMatrix, tileCol=tileCol+1, tileRow=tileRow+i, start_date=start_date, num_days=num_days, precision=precision)
+            im3 = get_processed_image_clip(tileMatrix=tileMatrix, tileCol=tileCol+2, tileRow=tileRow+i, start_date=start_date, num_days=num_days, precision=precision)
         im.append(np.concatenate((im1, im2, im3), axis=1))
         mask1 = getimage.get_mask(tileMatrix=tileMatrix, tileCol=tileCol, tileRow=tileRow+i)
         mask2 = getimage.get_mask(tileMatrix=tileMatrix, tileCol=tileCol+1, tileRow=tileRow+i)
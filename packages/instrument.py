@@ -0,0 +1,243 @@
+"""Lightweight timing spans and counters for the processing stages
+
+Instrumentation is disabled by default and then costs a single flag check
+per call. Enable it with enable() or by setting the NIGHTFLARE_INSTRUMENT
+environment variable. Collected metrics can be read with snapshot(), dumped
+in the Prometheus text format with to_prometheus(), and every finished span
+can be written as a JSON line to a stream set with set_log().
+
+Usage:
+    with instrument.span("improcess_wiener"):
+        out = signal.wiener(out, 5)
+    instrument.count("getimage_bytes_fetched", len(data))
+"""
+import json
+import os
+import threading
+import time
+
+_enabled = bool(os.environ.get("NIGHTFLARE_INSTRUMENT"))
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_log = None
+# Serializes writes to the log, so lines of concurrent spans never
+# interleave, without holding up the counters behind slow streams
+_log_lock = threading.Lock()
+
+def enable(flag=True):
+    """Turn instrumentation on or off
+
+    Args:
+        flag (bool, optional): True to collect metrics
+    """
+    global _enabled
+    _enabled = flag
+
+def enabled():
+    """Whether metrics are being collected
+
+    Returns:
+        bool: True if instrumentation is on
+    """
+    return _enabled
+
+def set_log(stream):
+    """Write every finished span as a JSON line to a stream
+
+    Args:
+        stream (file): Writable text stream, or None to stop logging
+    """
+    global _log
+    _log = stream
+
+def reset():
+    """Forget all collected metrics
+    """
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def count(name, value=1, **labels):
+    """Add to a counter
+
+    Args:
+        name (str): Counter name
+        value (float, optional): Amount added
+        **labels: Labels of the counter, e.g. layer="OSM_Land_Mask"
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def record(name, seconds, **labels):
+    """Record the duration of one occurrence of a span
+
+    Args:
+        name (str): Span name
+        seconds (float): Duration
+        **labels: Labels of the span
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        timing = _timings.get(key)
+        if timing is None:
+            _timings[key] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    log = _log
+    if log is not None:
+        line = json.dumps({
+            "span": name,
+            "labels": labels,
+            "seconds": seconds,
+            "time": time.time()
+        }) + "\n"
+        with _log_lock:
+            log.write(line)
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null_span = _NullSpan()
+
+class _Span(object):
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.time() - self.start, **self.labels)
+        return False
+
+def span(name, **labels):
+    """Context manager timing the enclosed block
+
+    Args:
+        name (str): Span name
+        **labels: Labels of the span
+
+    Returns:
+        A context manager
+    """
+    if not _enabled:
+        return _null_span
+    return _Span(name, labels)
+
+class _Acquire(object):
+
+    def __init__(self, lock, name, labels):
+        self.lock = lock
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        start = time.time()
+        self.lock.acquire()
+        record(self.name, time.time() - start, **self.labels)
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+        return False
+
+def acquire(lock, name, **labels):
+    """Context manager holding a lock or semaphore, timing the wait for it
+
+    Args:
+        lock: Lock or semaphore
+        name (str): Span name of the wait
+        **labels: Labels of the span
+
+    Returns:
+        A context manager
+    """
+    if not _enabled:
+        return lock
+    return _Acquire(lock, name, labels)
+
+def snapshot():
+    """Copy of the collected metrics
+
+    Hit ratios are derived for every pair of counters named <prefix>_hits
+    and <prefix>_misses with the same labels.
+
+    Returns:
+        dict: "counters", "timings" and "ratios", each a list of dicts
+    """
+    with _lock:
+        counters = dict(_counters)
+        timings = dict((k, list(v)) for k, v in _timings.items())
+
+    ratios = []
+    for (name, labels), hits in sorted(counters.items()):
+        if not name.endswith("_hits"):
+            continue
+        prefix = name[:-len("_hits")]
+        misses = counters.get((prefix + "_misses", labels), 0)
+        if hits + misses:
+            ratios.append({"name": prefix + "_hit_ratio",
+                "labels": dict(labels), "value": float(hits) / (hits + misses)})
+
+    return {
+        "counters": [{"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(counters.items())],
+        "timings": [{"name": name, "labels": dict(labels), "count": c,
+                "seconds": total, "max_seconds": longest}
+            for (name, labels), (c, total, longest) in sorted(timings.items())],
+        "ratios": ratios
+    }
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+        for k, v in sorted(labels.items()))
+
+def to_prometheus(prefix="nightflare_"):
+    """Collected metrics in the Prometheus text exposition format
+
+    Counters become <name>_total, spans become <name>_seconds_count,
+    <name>_seconds_sum and <name>_seconds_max.
+
+    Args:
+        prefix (str, optional): Prefix of every metric name
+
+    Returns:
+        str: The metrics
+    """
+    snap = snapshot()
+    lines = []
+    for c in snap["counters"]:
+        lines.append("%s%s_total%s %r" % (prefix, c["name"],
+            _prometheus_labels(c["labels"]), c["value"]))
+    for t in snap["timings"]:
+        labels = _prometheus_labels(t["labels"])
+        lines.append("%s%s_seconds_count%s %d" % (prefix, t["name"], labels, t["count"]))
+        lines.append("%s%s_seconds_sum%s %r" % (prefix, t["name"], labels, t["seconds"]))
+        lines.append("%s%s_seconds_max%s %r" % (prefix, t["name"], labels, t["max_seconds"]))
+    for r in snap["ratios"]:
+        lines.append("%s%s%s %r" % (prefix, r["name"],
+            _prometheus_labels(r["labels"]), r["value"]))
+    return "\n".join(lines) + "\n"
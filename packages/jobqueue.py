@@ -0,0 +1,657 @@
+"""Distribution of tile jobs over worker processes and machines
+
+The monthly statistics of a region are split into one job per (tile, month),
+which composites the tile and computes the partial statistics of the major
+cities within it, and one job per month merging the partial statistics of
+all tiles. Jobs are kept in a queue that any number of stateless workers
+claim jobs from. Results go to the shared tile store of the batch pipeline,
+so a worker can die at any time: its job is handed to another worker once
+its lease expires, and failed jobs are retried a few times before they are
+given up. Workers renew the lease of their job while it runs, and a worker
+whose lease was lost can no longer complete or fail the job. Queuing a job
+which was given up again puts it back in the queue.
+
+Workers do not append the monthly mosaics to the datacube of the region,
+since a cube only serializes the writes of one process. Once the jobs are
+done, batch.run appends the missing months from the composites the workers
+left in the shared tile store, without computing them again.
+
+Two queue backends are available:
+
+- SQLiteQueue, a SQLite database, for workers on one machine
+- FileQueue, a directory with one file per job, moved between state
+  directories with atomic renames, for workers on one or several machines
+  sharing a file system
+
+Usage:
+    queue = jobqueue.open_queue("jobs.db")
+    jobqueue.enqueue(queue, region="CA", start_month="2017-01", end_month="2017-12")
+    jobqueue.work(queue)    # in every worker process
+"""
+from __future__ import print_function
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+import batch
+
+try: # Python 3
+    from urllib.parse import quote, unquote
+except ImportError: # Python 2
+    from urllib import quote, unquote
+
+_states = ("pending", "running", "done", "failed")
+
+class Job(object):
+
+    """A job claimed from a queue
+
+    Jobs of a group are run stage by stage: a job is only claimed once all
+    jobs of its group with a lower stage are done.
+
+    Attributes:
+        attempts (int): Number of times the job was claimed, this time
+            included
+        group (str): Group of the job
+        key (str): Unique name of the job
+        payload (dict): Parameters of the job
+        stage (int): Stage of the job within its group
+        token (str): Token of the lease of this claim
+    """
+
+    def __init__(self, key, group, stage, payload, attempts, token=None):
+        self.key = key
+        self.group = group
+        self.stage = stage
+        self.payload = payload
+        self.attempts = attempts
+        self.token = token
+
+    def __repr__(self):
+        return "Job(%r)" % self.key
+
+class SQLiteQueue(object):
+
+    """Job queue stored in a SQLite database
+
+    Attributes:
+        lease (float): Seconds after which a claimed job which is neither
+            completed nor failed is handed to another worker
+        max_attempts (int): Number of times a job is tried before it is
+            given up
+        path (str): File name of the database
+    """
+
+    def __init__(self, path, lease=900, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._execute("""CREATE TABLE IF NOT EXISTS jobs (
+            key TEXT PRIMARY KEY,
+            grp TEXT,
+            stage INTEGER,
+            payload TEXT,
+            state TEXT,
+            attempts INTEGER DEFAULT 0,
+            worker TEXT,
+            expires REAL,
+            error TEXT,
+            token TEXT)""")
+        try:
+            # Queues created before leases had tokens
+            self._execute("ALTER TABLE jobs ADD COLUMN token TEXT")
+        except sqlite3.OperationalError:
+            pass
+        self._execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, stage, key)")
+
+    def _connection(self):
+        # Connections can not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql, *args):
+        return self._connection().execute(sql, args)
+
+    def put(self, key, payload, group=None, stage=0, replace=False):
+        """Add a job to the queue
+
+        Args:
+            key (str): Unique name of the job
+            payload (dict): Parameters of the job, serializable as json
+            group (str, optional): Group of the job. Defaults to the key.
+            stage (int, optional): Stage of the job within its group
+            replace (bool, optional): Reset the job if it is already queued.
+                Otherwise it is left as it is, unless it was given up.
+        """
+        self._execute("INSERT OR %s INTO jobs (key, grp, stage, payload, state) "
+            "VALUES (?, ?, ?, ?, 'pending')" % ("REPLACE" if replace else "IGNORE"),
+            key, group or key, stage, json.dumps(payload))
+        # A job given up would hold back the later stages of its group forever
+        self._execute("UPDATE jobs SET state = 'pending', grp = ?, stage = ?, "
+            "payload = ?, attempts = 0, worker = NULL, token = NULL, error = NULL "
+            "WHERE key = ? AND state = 'failed'",
+            group or key, stage, json.dumps(payload), key)
+
+    def claim(self, worker):
+        """Claim the next job ready to run
+
+        Jobs whose lease expired are put back in the queue first.
+
+        Args:
+            worker (str): Name of the worker
+
+        Returns:
+            Job: The job, or None if no job is ready
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE jobs SET state = CASE WHEN attempts < ? "
+                "THEN 'pending' ELSE 'failed' END, worker = NULL, token = NULL, "
+                "error = 'lease expired' WHERE state = 'running' AND expires < ?",
+                (self.max_attempts, now))
+            row = conn.execute("SELECT key, grp, stage, payload, attempts "
+                "FROM jobs AS j WHERE state = 'pending' AND NOT EXISTS ("
+                "SELECT 1 FROM jobs AS d WHERE d.grp = j.grp "
+                "AND d.stage < j.stage AND d.state != 'done') "
+                "ORDER BY stage, key LIMIT 1").fetchone()
+            token = uuid.uuid4().hex
+            if row is not None:
+                conn.execute("UPDATE jobs SET state = 'running', worker = ?, "
+                    "token = ?, expires = ?, attempts = attempts + 1 WHERE key = ?",
+                    (worker, token, now + self.lease, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        key, group, stage, payload, attempts = row
+        return Job(key, group, stage, json.loads(payload), attempts + 1, token)
+
+    def _update_owned(self, job, assignments, *args):
+        # Only the holder of the lease may change a running job
+        return self._execute("UPDATE jobs SET %s WHERE key = ? AND "
+            "state = 'running' AND token = ?" % assignments,
+            *(args + (job.key, job.token))).rowcount == 1
+
+    def renew(self, job):
+        """Extend the lease of a claimed job by lease seconds
+
+        Args:
+            job (Job): The job
+
+        Returns:
+            bool: False if the lease was lost
+        """
+        return self._update_owned(job, "expires = ?", time.time() + self.lease)
+
+    def complete(self, job):
+        """Mark a claimed job as done
+
+        Args:
+            job (Job): The job
+
+        Returns:
+            bool: False if the lease was lost, and the job left as it is
+        """
+        return self._update_owned(job, "state = 'done', token = NULL, error = NULL")
+
+    def fail(self, job, error=None):
+        """Put a claimed job back in the queue, or give it up after
+        max_attempts attempts
+
+        Args:
+            job (Job): The job
+            error (str, optional): Description of the failure
+
+        Returns:
+            bool: False if the lease was lost, and the job left as it is
+        """
+        return self._update_owned(job, "state = ?, worker = NULL, token = NULL, "
+            "error = ?", "pending" if job.attempts < self.max_attempts
+            else "failed", error)
+
+    def counts(self):
+        """Number of jobs in every state
+
+        Returns:
+            dict: "pending", "running", "done" and "failed" job counts
+        """
+        counts = dict((state, 0) for state in _states)
+        counts.update(self._execute(
+            "SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return counts
+
+    def failures(self):
+        """Jobs which were given up
+
+        Returns:
+            list: Key and last error of every failed job
+        """
+        return self._execute("SELECT key, error FROM jobs "
+            "WHERE state = 'failed' ORDER BY key").fetchall()
+
+class FileQueue(object):
+
+    """Job queue stored as one json file per job
+
+    The directory has one subdirectory per job state. Claiming a job renames
+    its file from pending to running, which only one worker can do. The
+    modification time of a running file is the start of its lease, and its
+    record holds the token of the lease.
+
+    Attributes:
+        lease (float): Seconds after which a claimed job which is neither
+            completed nor failed is handed to another worker
+        max_attempts (int): Number of times a job is tried before it is
+            given up
+        path (str): Directory of the queue
+    """
+
+    def __init__(self, path, lease=900, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for state in _states:
+            try:
+                os.makedirs(os.path.join(path, state))
+            except OSError:
+                if not os.path.isdir(os.path.join(path, state)):
+                    raise
+
+    def _fname(self, state, name):
+        return os.path.join(self.path, state, name)
+
+    @staticmethod
+    def _name(key, group, stage):
+        # Stage first so listings sort by stage. Quoting leaves no "+" in
+        # the parts.
+        return "%06d+%s+%s.json" % (stage, quote(group, safe=""), quote(key, safe=""))
+
+    @staticmethod
+    def _parse(name):
+        stage, group, key = name[:-len(".json")].split("+")
+        return unquote(key), unquote(group), int(stage)
+
+    def _list(self, state):
+        return sorted(n for n in os.listdir(os.path.join(self.path, state))
+            if n.endswith(".json"))
+
+    def _read(self, fname):
+        with open(fname) as f:
+            return json.load(f)
+
+    def _write(self, fname, record):
+        tmp_fname = "%s.%s.%d.%d.tmp" % (fname, socket.gethostname(),
+            os.getpid(), threading.current_thread().ident)
+        with open(tmp_fname, "w") as f:
+            json.dump(record, f)
+        os.rename(tmp_fname, fname)
+
+    def _move(self, name, src, dst):
+        """Rename a job file between states
+
+        Returns:
+            bool: False if another worker moved it first
+        """
+        try:
+            os.rename(self._fname(src, name), self._fname(dst, name))
+        except OSError:
+            return False
+        return True
+
+    def put(self, key, payload, group=None, stage=0, replace=False):
+        """Add a job to the queue
+
+        Args:
+            key (str): Unique name of the job
+            payload (dict): Parameters of the job, serializable as json
+            group (str, optional): Group of the job. Defaults to the key.
+            stage (int, optional): Stage of the job within its group
+            replace (bool, optional): Reset the job if it is already queued.
+                Otherwise it is left as it is, unless it was given up.
+        """
+        name = self._name(key, group or key, stage)
+        queued = [state for state in _states
+            if os.path.exists(self._fname(state, name))]
+        # A job given up would hold back the later stages of its group forever
+        if not replace and any(state != "failed" for state in queued):
+            return
+        self._write(self._fname("pending", name),
+            {"payload": payload, "attempts": 0, "error": None})
+        for state in queued:
+            if state != "pending":
+                os.remove(self._fname(state, name))
+
+    def _expire(self, now):
+        """Put back running jobs whose lease expired"""
+        for name in self._list("running"):
+            fname = self._fname("running", name)
+            try:
+                if os.path.getmtime(fname) + self.lease >= now:
+                    continue
+                record = self._read(fname)
+            except (OSError, IOError, ValueError):
+                continue
+            state = "pending" if record["attempts"] < self.max_attempts else "failed"
+            if self._move(name, "running", state):
+                record["error"] = "lease expired"
+                record["token"] = None
+                self._write(self._fname(state, name), record)
+
+    def claim(self, worker):
+        """Claim the next job ready to run
+
+        Jobs whose lease expired are put back in the queue first.
+
+        Args:
+            worker (str): Name of the worker
+
+        Returns:
+            Job: The job, or None if no job is ready
+        """
+        self._expire(time.time())
+
+        # Lowest stage of every group with jobs which are not done
+        lowest = {}
+        pending = self._list("pending")
+        for state in ("pending", "running", "failed"):
+            for name in pending if state == "pending" else self._list(state):
+                _, group, stage = self._parse(name)
+                lowest[group] = min(stage, lowest.get(group, stage))
+
+        for name in pending:
+            key, group, stage = self._parse(name)
+            if lowest[group] < stage:
+                continue
+            fname = self._fname("pending", name)
+            try:
+                # Renewing the time first starts the lease on the rename
+                os.utime(fname, None)
+            except OSError:
+                continue
+            if not self._move(name, "pending", "running"):
+                continue
+            fname = self._fname("running", name)
+            record = self._read(fname)
+            record["attempts"] += 1
+            record["worker"] = worker
+            record["token"] = uuid.uuid4().hex
+            self._write(fname, record)
+            return Job(key, group, stage, record["payload"], record["attempts"],
+                record["token"])
+        return None
+
+    def _owned(self, job):
+        """Name and record of a running job, if the job still holds its lease
+
+        Returns:
+            tuple: Name and record, or None if the lease was lost
+        """
+        name = self._name(job.key, job.group, job.stage)
+        try:
+            record = self._read(self._fname("running", name))
+        except (OSError, IOError, ValueError):
+            return None
+        if record.get("token") != job.token:
+            return None
+        return name, record
+
+    def renew(self, job):
+        """Extend the lease of a claimed job by lease seconds
+
+        Args:
+            job (Job): The job
+
+        Returns:
+            bool: False if the lease was lost
+        """
+        owned = self._owned(job)
+        if owned is None:
+            return False
+        try:
+            os.utime(self._fname("running", owned[0]), None)
+        except OSError:
+            return False
+        return True
+
+    def complete(self, job):
+        """Mark a claimed job as done
+
+        Args:
+            job (Job): The job
+
+        Returns:
+            bool: False if the lease was lost, and the job left as it is
+        """
+        owned = self._owned(job)
+        return owned is not None and self._move(owned[0], "running", "done")
+
+    def fail(self, job, error=None):
+        """Put a claimed job back in the queue, or give it up after
+        max_attempts attempts
+
+        Args:
+            job (Job): The job
+            error (str, optional): Description of the failure
+
+        Returns:
+            bool: False if the lease was lost, and the job left as it is
+        """
+        owned = self._owned(job)
+        if owned is None:
+            return False
+        name, record = owned
+        record["error"] = error
+        record["token"] = None
+        self._write(self._fname("running", name), record)
+        return self._move(name, "running",
+            "pending" if job.attempts < self.max_attempts else "failed")
+
+    def counts(self):
+        """Number of jobs in every state
+
+        Returns:
+            dict: "pending", "running", "done" and "failed" job counts
+        """
+        return dict((state, len(self._list(state))) for state in _states)
+
+    def failures(self):
+        """Jobs which were given up
+
+        Returns:
+            list: Key and last error of every failed job
+        """
+        failures = []
+        for name in self._list("failed"):
+            try:
+                error = self._read(self._fname("failed", name)).get("error")
+            except (OSError, IOError, ValueError):
+                error = None
+            failures.append((self._parse(name)[0], error))
+        return failures
+
+def open_queue(path, **kwargs):
+    """Open a queue, creating it if needed
+
+    Args:
+        path (str): File name of a SQLite queue, ending with .db or .sqlite,
+            or directory of a file queue
+        **kwargs: lease and max_attempts of the queue
+
+    Returns:
+        SQLiteQueue or FileQueue: The queue
+    """
+    if path.endswith((".db", ".sqlite")):
+        return SQLiteQueue(path, **kwargs)
+    return FileQueue(path, **kwargs)
+
+def enqueue(
+        queue,
+        region="CA",
+        start_month="2017-01",
+        end_month="2018-01",
+        method="clip",
+        num_days=31,
+        output_dir=None,
+        output_format="csv",
+        force=False):
+    """Queue the jobs of the monthly statistics of a region
+
+    Every month gets one job per tile and one job merging the tiles. Months
+    whose csv file exists with the same method and number of days, and
+    tiles whose partial statistics exist, are left out. Jobs do not append
+    to the datacube of the region, see the module documentation.
+
+    Args:
+        queue (SQLiteQueue or FileQueue): The queue
+        region (str, optional): Name of the region in batch.REGIONS
+        start_month (str, optional): First month, "YYYY-MM"
+        end_month (str, optional): Last month, "YYYY-MM", inclusive
+        method (str, optional): Image processing method, "clip" or
+            "band_reject"
+        num_days (int, optional): Number of days of each composite
+        output_dir (str, optional): Directory of the csv files. Defaults to
+            the data directory of the repository.
+        output_format (str, optional): "csv" or "parquet", see
+            batch.build_graph
+        force (bool, optional): Recompute outputs which already exist
+
+    Returns:
+        int: Number of jobs queued
+    """
+    if region not in batch.REGIONS:
+        raise ValueError("Unknown region %s" % region)
+    if method not in batch.METHODS:
+        raise ValueError("Unknown method %s" % method)
+    if output_format not in batch.OUTPUT_FORMATS:
+        raise ValueError("Unknown output format %s" % output_format)
+
+    r = batch.REGIONS[region]
+    output_dir = os.path.abspath(output_dir or batch.DATA_PATH)
+    queued = 0
+    for start_date in batch.month_range(start_month, end_month):
+        if not force and batch.is_up_to_date(batch.output_path(
+                start_date, output_dir, region, output_format), method, num_days):
+            continue
+
+        group = "%s_%s_%s_%s" % (region, method, num_days, start_date)
+        params = {"region": region, "method": method,
+            "start_date": start_date, "num_days": num_days}
+        for j in range(r["num_rows"]):
+            for i in range(r["num_cols"]):
+                tile = (r["tileMatrix"], r["tileCol"] + i, r["tileRow"] + j)
+                if not force and os.path.isfile(batch.zonal_path(
+                        region, method, start_date, num_days, *tile)):
+                    continue
+                queue.put("%s_%s_%s_%s" % ((group,) + tile),
+                    dict(params, kind="tile", tile=tile, force=force),
+                    group=group, stage=0, replace=force)
+                queued += 1
+        queue.put(group + "_merge", dict(params, kind="merge",
+                output_dir=output_dir, output_format=output_format),
+            group=group, stage=1, replace=force)
+        queued += 1
+    return queued
+
+def run_job(payload):
+    """Run a job
+
+    Tile jobs composite their tile unless the composite is cached, then
+    compute the partial statistics of the tile. Merge jobs write the monthly
+    csv file.
+
+    Args:
+        payload (dict): Parameters of the job
+    """
+    region = payload["region"]
+    method = payload["method"]
+    start_date = payload["start_date"]
+    num_days = payload["num_days"]
+    if payload["kind"] == "tile":
+        tile = tuple(payload["tile"])
+        fname = batch.composite_path(region, method, start_date, num_days, *tile)
+        if payload.get("force") or not os.path.isfile(fname):
+            batch.fetch_tile(*tile, start_date=start_date, num_days=num_days)
+            batch.composite_tile(fname, method, *tile,
+                start_date=start_date, num_days=num_days)
+        batch.zonal_tile(batch.zonal_path(region, method, start_date, num_days, *tile),
+            region, method, start_date, num_days, *tile)
+    elif payload["kind"] == "merge":
+        batch.merge_zonal(batch.output_path(start_date, payload["output_dir"],
+                region, payload.get("output_format", "csv")),
+            region, method, start_date, num_days)
+    else:
+        raise ValueError("Unknown job kind %s" % payload["kind"])
+
+def _heartbeat(queue, job, stop):
+    """Renew the lease of a job every third of the lease until stop is set
+    or the lease is lost
+    """
+    while not stop.wait(queue.lease / 3.0):
+        if not queue.renew(job):
+            return
+
+def work(queue, worker=None, poll=5, wait=False, verbose=True):
+    """Claim and run jobs until the queue is drained
+
+    The lease of the running job is renewed in the background, so jobs may
+    run longer than the lease of the queue as long as their worker lives.
+
+    Args:
+        queue (SQLiteQueue or FileQueue): The queue
+        worker (str, optional): Name of the worker. Defaults to the host
+            name and process id.
+        poll (float, optional): Seconds to wait before looking again when no
+            job is ready
+        wait (bool, optional): Keep waiting for new jobs once the queue is
+            drained
+        verbose (bool, optional): Print a line when a job finishes
+
+    Returns:
+        int: Number of jobs done by this worker
+    """
+    worker = worker or "%s:%d" % (socket.gethostname(), os.getpid())
+    done = 0
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            # Jobs running elsewhere may still fail or unlock later stages
+            if wait or queue.counts()["running"]:
+                time.sleep(poll)
+                continue
+            return done
+
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(queue, job, stop))
+        beat.daemon = True
+        beat.start()
+        try:
+            run_job(job.payload)
+        except Exception:
+            error = traceback.format_exc()
+            stop.set()
+            beat.join()
+            owned = queue.fail(job, error)
+            if verbose:
+                print("%s Failed (attempt %d)." % (job.key, job.attempts))
+        else:
+            stop.set()
+            beat.join()
+            owned = queue.complete(job)
+            if owned:
+                done += 1
+                if verbose:
+                    print("%s Finished." % job.key)
+        if not owned and verbose:
+            print("%s Lease lost to another worker." % job.key)
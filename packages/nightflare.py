@@ -0,0 +1,257 @@
+"""Command line interface of the night-flare pipelines
+
+Usage:
+    python -m nightflare run --region CA --from 2017-01 --to 2018-01
+
+    python -m nightflare enqueue --queue jobs.db --region CA --from 2017-01 --to 2018-01
+    python -m nightflare worker --queue jobs.db     # in as many processes as wanted
+    python -m nightflare status --queue jobs.db
+
+    python -m nightflare backfill --manifest ca.json --region CA --from 2017-01-01 --to 2018-01-31
+    python -m nightflare backfill --region CA --warm 1     # daily, before the jobs
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import backfill
+import batch
+import getimage
+import instrument
+import jobqueue
+
+def _instrumented(func):
+    """Wrap a command so it writes the metrics and trace files it is given
+    """
+    def command(args):
+        if args.metrics or args.trace:
+            instrument.enable()
+        trace = open(args.trace, "w") if args.trace else None
+        instrument.set_log(trace)
+        try:
+            return func(args)
+        finally:
+            instrument.set_log(None)
+            if trace:
+                trace.close()
+            if args.metrics:
+                with open(args.metrics, "w") as f:
+                    f.write(instrument.to_prometheus())
+    return command
+
+def _configure_cache(args):
+    if args.cache_dir is not None:
+        getimage.set_cache_dir(args.cache_dir)
+    if args.cache_budget is not None:
+        getimage.set_cache_budget(args.cache_budget)
+    if args.revalidate is not None:
+        getimage.set_revalidate(args.revalidate)
+    if args.fetch_mode is not None:
+        getimage.set_fetch_mode(args.fetch_mode)
+
+def _run_batch(args):
+    _configure_cache(args)
+    batch.run(
+        region=args.region,
+        start_month=args.start_month,
+        end_month=args.end_month,
+        method=args.method,
+        num_days=args.num_days,
+        output_dir=args.output_dir,
+        output_format=args.output_format,
+        force=args.force,
+        jobs=args.jobs)
+
+def _queue(args):
+    return jobqueue.open_queue(args.queue, lease=args.lease,
+        max_attempts=args.max_attempts)
+
+def _enqueue(args):
+    queued = jobqueue.enqueue(_queue(args),
+        region=args.region,
+        start_month=args.start_month,
+        end_month=args.end_month,
+        method=args.method,
+        num_days=args.num_days,
+        output_dir=args.output_dir,
+        output_format=args.output_format,
+        force=args.force)
+    print("%d jobs queued." % queued)
+
+def _worker(args):
+    # Load the geocoder before the first job needs it
+    import reverse_geocoder
+    reverse_geocoder.preload(verbose=False)
+    _configure_cache(args)
+    jobqueue.work(_queue(args), worker=args.name, poll=args.poll, wait=args.wait)
+
+def _status(args):
+    queue = _queue(args)
+    counts = queue.counts()
+    print(" ".join("%s=%d" % (state, counts[state])
+        for state in ("pending", "running", "done", "failed")))
+    for key, error in queue.failures():
+        print("%s failed: %s" % (key, (error or "").strip().split("\n")[-1]))
+    return 1 if counts["failed"] else 0
+
+def _zooms(value):
+    """Parse zoom levels like "6", "6-8" or "6,8"
+    """
+    zooms = []
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        zooms.extend(range(int(first), int(last or first) + 1))
+    return zooms
+
+def _backfill(args):
+    _configure_cache(args)
+    if args.warm is not None:
+        result = backfill.warm(region=args.region, zooms=args.zooms,
+            days=args.warm, masks=not args.no_masks, jobs=args.jobs,
+            rate=args.rate)
+    else:
+        if not args.manifest:
+            print("backfill needs --manifest or --warm", file=sys.stderr)
+            return 2
+        if args.replan or not os.path.exists(args.manifest):
+            if not (args.start_date and args.end_date):
+                print("a new manifest needs --from and --to", file=sys.stderr)
+                return 2
+            count = backfill.plan(args.manifest, region=args.region,
+                zooms=args.zooms, start_date=args.start_date,
+                end_date=args.end_date, masks=not args.no_masks)
+            print("%d tiles to fetch." % count)
+        result = backfill.run(args.manifest, jobs=args.jobs, rate=args.rate,
+            limit=args.limit)
+    for tile, error in result["errors"][:10]:
+        print("%s failed: %s" % (" ".join(str(x) for x in tile), error))
+    return 1 if result["failed"] else 0
+
+def _add_region_arguments(parser):
+    parser.add_argument("--region", default="CA",
+        choices=sorted(batch.REGIONS))
+    parser.add_argument("--from", dest="start_month", required=True,
+        help="first month, YYYY-MM")
+    parser.add_argument("--to", dest="end_month", required=True,
+        help="last month, YYYY-MM, inclusive")
+    parser.add_argument("--method", default="clip",
+        choices=["clip", "band_reject"])
+    parser.add_argument("--num-days", type=int, default=31)
+    parser.add_argument("--output-dir", default=None,
+        help="directory of the csv files, defaults to the data directory")
+    parser.add_argument("--output-format", default="csv",
+        choices=batch.OUTPUT_FORMATS, help="one csv file per month, or a "
+        "Parquet dataset partitioned by month and region")
+    parser.add_argument("--force", action="store_true",
+        help="recompute outputs which already exist")
+
+def _add_queue_arguments(parser):
+    parser.add_argument("--queue", required=True,
+        help="SQLite queue file ending with .db, or file queue directory")
+    parser.add_argument("--lease", type=float, default=900,
+        help="seconds after which a job of an unresponsive worker is retried")
+    parser.add_argument("--max-attempts", type=int, default=3,
+        help="number of times a failing job is tried")
+
+def _add_cache_arguments(parser):
+    parser.add_argument("--cache-dir", default=None,
+        help="directory of the tile cache")
+    parser.add_argument("--cache-budget", default=None,
+        help="size the tile cache is kept under, e.g. 500M or 20G; the "
+        "tiles read least recently are evicted first")
+    parser.add_argument("--revalidate", type=float, default=None,
+        metavar="MAX_AGE", help="check cached tiles older than this many "
+        "seconds with the server, 0 checks every tile")
+    parser.add_argument("--fetch-mode", default=None, choices=["tile", "region"],
+        help="fetch every tile on its own, or whole regions with one WMS "
+        "request per day")
+
+def _add_instrument_arguments(parser):
+    parser.add_argument("--metrics", default=None,
+        help="write timings and counters to this file in Prometheus format")
+    parser.add_argument("--trace", default=None,
+        help="write every timing span to this file as a JSON line")
+
+def main(argv=None):
+    """Parse the command line and run the selected command
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv.
+
+    Returns:
+        int: Exit status of the command
+    """
+    parser = argparse.ArgumentParser(prog="nightflare")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run",
+        help="compute monthly statistics of major cities of a region")
+    _add_region_arguments(run_parser)
+    run_parser.add_argument("--jobs", type=int, default=4,
+        help="number of tasks running at the same time")
+    _add_cache_arguments(run_parser)
+    _add_instrument_arguments(run_parser)
+    run_parser.set_defaults(func=_instrumented(_run_batch))
+
+    enqueue_parser = subparsers.add_parser("enqueue",
+        help="queue the tile jobs of the monthly statistics of a region")
+    _add_region_arguments(enqueue_parser)
+    _add_queue_arguments(enqueue_parser)
+    enqueue_parser.set_defaults(func=_enqueue)
+
+    worker_parser = subparsers.add_parser("worker",
+        help="run queued jobs until the queue is drained")
+    _add_queue_arguments(worker_parser)
+    worker_parser.add_argument("--name", default=None,
+        help="name of the worker, defaults to host name and process id")
+    worker_parser.add_argument("--poll", type=float, default=5,
+        help="seconds between looks at the queue when no job is ready")
+    worker_parser.add_argument("--wait", action="store_true",
+        help="keep waiting for new jobs once the queue is drained")
+    _add_cache_arguments(worker_parser)
+    _add_instrument_arguments(worker_parser)
+    worker_parser.set_defaults(func=_instrumented(_worker))
+
+    status_parser = subparsers.add_parser("status",
+        help="count the jobs of a queue in every state and list failed jobs")
+    _add_queue_arguments(status_parser)
+    status_parser.set_defaults(func=_status)
+
+    backfill_parser = subparsers.add_parser("backfill",
+        help="fetch the tiles of a region and date range into the tile cache, "
+        "resuming from a manifest, or warm the cache with the last days")
+    backfill_parser.add_argument("--region", default="CA",
+        choices=sorted(batch.REGIONS))
+    backfill_parser.add_argument("--zooms", type=_zooms, default=None,
+        help="zoom levels, e.g. 6-8 or 6,8; defaults to the zoom level of "
+        "the region")
+    backfill_parser.add_argument("--from", dest="start_date", default=None,
+        help="first date, YYYY-MM-DD")
+    backfill_parser.add_argument("--to", dest="end_date", default=None,
+        help="last date, YYYY-MM-DD, inclusive")
+    backfill_parser.add_argument("--manifest", default=None,
+        help="manifest of the tiles to fetch, written if it does not exist; "
+        "progress is kept next to it so an interrupted backfill resumes")
+    backfill_parser.add_argument("--replan", action="store_true",
+        help="write the manifest again even if it exists")
+    backfill_parser.add_argument("--warm", type=int, default=None,
+        metavar="DAYS", help="fetch the tiles of the last DAYS days up to "
+        "yesterday instead of a manifest")
+    backfill_parser.add_argument("--no-masks", action="store_true",
+        help="do not fetch the land masks")
+    backfill_parser.add_argument("--jobs", type=int, default=8,
+        help="number of tiles fetched at the same time")
+    backfill_parser.add_argument("--rate", type=float, default=None,
+        help="most requests per second")
+    backfill_parser.add_argument("--limit", type=int, default=None,
+        help="stop after this many tiles")
+    _add_cache_arguments(backfill_parser)
+    _add_instrument_arguments(backfill_parser)
+    backfill_parser.set_defaults(func=_instrumented(_backfill))
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
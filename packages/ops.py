@@ -0,0 +1,317 @@
+"""Lazy operator pipelines processing images block by block
+
+A processing method is declared as a chain of operators, e.g.
+
+    pipeline = ops.Pipeline([
+        ops.Map(np.round),
+        ops.Normalize(255.0),
+        ops.Stencil(wiener, halo=2, statistic=local_variance),
+        ops.Map(clip),
+        ops.Stencil(wiener, halo=2, statistic=local_variance)])
+    image = pipeline.run(composite)
+
+Nothing is computed when the chain is built. run() executes it block by
+block: every block is read with a halo as wide as the stencils of the chain
+reach, and consecutive Map operators are applied one after the other to the
+same block buffer while it is in cache, instead of each making a full-size
+temporary and a pass over memory. The pixels outside the image are zero for
+every stencil, so the result matches running every operator on the whole
+image.
+
+Operators needing a statistic of their whole input, like the maximum of
+Normalize or the noise power of a Wiener filter, split the chain into
+passes. The statistic is accumulated in a pass of its own, or while the
+input is written to a scratch buffer when computing it again would repeat a
+stencil. Peak memory then depends on the block size and on the scratch
+buffers, which can be memory mapped files for images larger than memory.
+"""
+import numpy as np
+import instrument
+
+def _zero_outside(buf, y0, y1, x0, x1, shape):
+    """Zero the part of a window which is outside the image
+    """
+    buf[:max(-y0, 0)] = 0
+    buf[buf.shape[0] - max(y1 - shape[0], 0):] = 0
+    buf[:, :max(-x0, 0)] = 0
+    buf[:, buf.shape[1] - max(x1 - shape[1], 0):] = 0
+    return buf
+
+def blocks(height, width, block=512):
+    """Split an image into blocks
+
+    Args:
+        height (int): Height of the image
+        width (int): Width of the image
+        block (int, optional): Height and width of the blocks
+
+    Yields:
+        tuple: First and last row, first and last column of every block
+    """
+    for y0 in range(0, height, block):
+        for x0 in range(0, width, block):
+            yield y0, min(y0 + block, height), x0, min(x0 + block, width)
+
+def read_window(arr, y0, y1, x0, x1, dtype=None):
+    """Copy of a window of an image, with zeros outside the image
+
+    Args:
+        arr (np.ndarray): Image, usually memory mapped
+        y0, y1 (int): First and last row of the window, may be out of bounds
+        x0, x1 (int): First and last column of the window, may be out of
+            bounds
+        dtype (np.dtype, optional): Data type of the window
+
+    Returns:
+        np.ndarray: The window
+    """
+    out = np.zeros((y1 - y0, x1 - x0), dtype or arr.dtype)
+    h, w = arr.shape
+    sy0, sy1 = max(y0, 0), min(y1, h)
+    sx0, sx1 = max(x0, 0), min(x1, w)
+    if sy0 < sy1 and sx0 < sx1:
+        out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = arr[sy0:sy1, sx0:sx1]
+    return out
+
+class Map(object):
+
+    """Elementwise operator
+
+    Attributes:
+        func (callable): Function of a block buffer returning the result,
+            preferably computed in place
+        name (str): Name of the operator in timing spans
+    """
+
+    halo = 0
+
+    def __init__(self, func, name=None):
+        self.func = func
+        self.name = name or getattr(func, "__name__", "map")
+
+    def needs_statistic(self):
+        return False
+
+class Normalize(Map):
+
+    """Elementwise scaling of an image so that its maximum becomes peak
+
+    Attributes:
+        peak (float): Maximum of the result
+    """
+
+    stat_halo = 0
+
+    def __init__(self, peak=255.0):
+        self.peak = peak
+        self.name = "normalize"
+        self.func = None
+
+    def needs_statistic(self):
+        return True
+
+    def partial(self, block):
+        return block.max()
+
+    def combine(self, a, b):
+        return max(a, b)
+
+    def finalize(self, total, num_pixels):
+        return self.peak / total
+
+    def bind(self, scale):
+        """Map multiplying by the scale computed by finalize
+        """
+        def func(buf):
+            buf *= scale
+            return buf
+        return Map(func, self.name)
+
+class Stencil(object):
+
+    """Neighbourhood operator, e.g. a filter with a 5x5 window
+
+    The result of a pixel depends on the pixels at most halo rows and columns
+    away. The statistic, if any, is averaged over the whole input image and
+    passed to the function, e.g. the noise power of a Wiener filter.
+
+    Attributes:
+        func (callable): Function of a window and the averaged statistic (or
+            None) returning the filtered window, of the same shape
+        halo (int): Reach of the operator
+        name (str): Name of the operator in timing spans
+        statistic (callable): Function of a window returning a per-pixel
+            statistic, of the same shape. The pixels outside the image are
+            zero in the window.
+    """
+
+    def __init__(self, func, halo, statistic=None, name=None):
+        self.func = func
+        self.halo = halo
+        self.statistic = statistic
+        self.stat_halo = halo
+        self.name = name or getattr(func, "__name__", "stencil")
+
+    def needs_statistic(self):
+        return self.statistic is not None
+
+    def partial(self, window):
+        h = self.stat_halo
+        stat = self.statistic(window)
+        return float(stat[h:stat.shape[0] - h, h:stat.shape[1] - h].sum(dtype=np.float64))
+
+    def combine(self, a, b):
+        return a + b
+
+    def finalize(self, total, num_pixels):
+        return total / num_pixels
+
+    def bind(self, value):
+        """Stencil applying the function with the averaged statistic
+        """
+        return Stencil(lambda win: self.func(win, value), self.halo, name=self.name)
+
+class _Array(object):
+
+    """Windows of an array, with zeros outside of it
+    """
+
+    has_stencil = False
+
+    def __init__(self, arr, dtype):
+        self.arr = arr
+        self.dtype = np.dtype(dtype)
+        self.shape = arr.shape
+
+    def window(self, y0, y1, x0, x1):
+        return read_window(self.arr, y0, y1, x0, x1, self.dtype)
+
+class _Fused(object):
+
+    """Windows of a source with Map operators applied to them in one go
+    """
+
+    def __init__(self, source, maps):
+        if isinstance(source, _Fused):
+            source, maps = source.source, source.maps + maps
+        self.source = source
+        self.maps = maps
+        self.shape = source.shape
+        self.dtype = source.dtype
+        self.has_stencil = source.has_stencil
+
+    def window(self, y0, y1, x0, x1):
+        buf = self.source.window(y0, y1, x0, x1)
+        for op in self.maps:
+            buf = op.func(buf)
+        return _zero_outside(np.asarray(buf, self.dtype), y0, y1, x0, x1, self.shape)
+
+class _Stenciled(object):
+
+    """Windows of a source filtered by a stencil
+    """
+
+    has_stencil = True
+
+    def __init__(self, source, op):
+        self.source = source
+        self.op = op
+        self.shape = source.shape
+        self.dtype = source.dtype
+
+    def window(self, y0, y1, x0, x1):
+        h = self.op.halo
+        win = self.source.window(y0 - h, y1 + h, x0 - h, x1 + h)
+        out = np.asarray(self.op.func(win), self.dtype)[h:h + y1 - y0, h:h + x1 - x0]
+        return _zero_outside(out, y0, y1, x0, x1, self.shape)
+
+class Pipeline(object):
+
+    """Chain of operators run block by block
+
+    Attributes:
+        cast (callable): Function converting every output block, e.g.
+            Policy.cast_output
+        dtype (np.dtype): Data type of the block buffers
+        ops (list): The operators, Map, Normalize or Stencil
+    """
+
+    def __init__(self, ops, dtype=np.float64, cast=None):
+        self.ops = list(ops)
+        self.dtype = np.dtype(dtype)
+        self.cast = cast
+
+    def then(self, *ops):
+        """Pipeline running more operators after these ones
+
+        Returns:
+            Pipeline: The new pipeline
+        """
+        return Pipeline(self.ops + list(ops), self.dtype, self.cast)
+
+    def _statistic(self, source, op, block, scratch):
+        """Average statistic of an operator over its input, and the source
+        to read the input from afterwards
+        """
+        shape = source.shape
+        h = op.stat_halo
+        total = None
+        out = None
+        if source.has_stencil:
+            # Computing the input again in the next pass would repeat its
+            # stencils, so it is written to a scratch buffer meanwhile
+            out = scratch(shape, self.dtype)
+        with instrument.span("ops_pass", op=op.name):
+            for y0, y1, x0, x1 in blocks(shape[0], shape[1], block):
+                win = source.window(y0 - h, y1 + h, x0 - h, x1 + h)
+                if out is not None:
+                    out[y0:y1, x0:x1] = win[h:h + y1 - y0, h:h + x1 - x0]
+                part = op.partial(win)
+                total = part if total is None else op.combine(total, part)
+        if out is not None:
+            if hasattr(out, "flush"):
+                out.flush()
+            source = _Array(out, self.dtype)
+        return op.finalize(total, shape[0] * shape[1]), source
+
+    def run(self, image, out=None, block=256, scratch=None):
+        """Run the chain on an image
+
+        Args:
+            image (np.ndarray): Input image, may be memory mapped
+            out (np.ndarray, optional): Output array of the shape of the
+                image. A new array by default.
+            block (int, optional): Height and width of the blocks
+            scratch (callable, optional): Function of a shape and data type
+                returning a scratch buffer. np.empty by default.
+
+        Returns:
+            np.ndarray: The output
+        """
+        scratch = scratch or np.empty
+        source = _Array(image, self.dtype)
+        maps = []
+        for op in self.ops:
+            if op.needs_statistic():
+                if maps:
+                    source, maps = _Fused(source, maps), []
+                value, source = self._statistic(source, op, block, scratch)
+                op = op.bind(value)
+            if isinstance(op, Map):
+                maps.append(op)
+            else:
+                if maps:
+                    source, maps = _Fused(source, maps), []
+                source = _Stenciled(source, op)
+        if maps:
+            source = _Fused(source, maps)
+
+        with instrument.span("ops_pass", op="output"):
+            for y0, y1, x0, x1 in blocks(image.shape[0], image.shape[1], block):
+                result = source.window(y0, y1, x0, x1)
+                if self.cast:
+                    result = self.cast(result)
+                if out is None:
+                    out = np.empty(image.shape, result.dtype)
+                out[y0:y1, x0:x1] = result
+        return out
@@ -0,0 +1,96 @@
+"""Precision policies of the processing pipeline
+
+A policy names the data type of accumulators and intermediate images and
+the data type of processed outputs. Raw tiles always stay uint8 until they
+are accumulated.
+
+- "float64": float64 accumulators and outputs (default, historical results)
+- "float32": float32 accumulators and outputs, half the memory traffic
+- "uint8": float32 accumulators, outputs rounded to uint8
+
+Against float64, float32 outputs differ by at most 0.01 and uint8 outputs
+by at most 0.51 on the 0-255 scale, except for the clip method: a pixel
+within rounding of the edges of its band may be halved in one run and not
+in another, even between float64 runs with other block sizes, which moves
+it and its Wiener neighbours by up to about 50. Such pixels are rare, about
+two in 100000 on a map of California.
+
+The default policy can be set with set_policy() or the NIGHTFLARE_PRECISION
+environment variable. Functions taking a precision argument use the default
+policy when it is None.
+"""
+import os
+import numpy as np
+
+class Policy(object):
+
+    """Data types used by a precision policy
+
+    Attributes:
+        accum (np.dtype): Data type of accumulators and intermediate images
+        name (str): Name of the policy
+        output (np.dtype): Data type of processed images
+    """
+
+    def __init__(self, name, accum, output):
+        self.name = name
+        self.accum = np.dtype(accum)
+        self.output = np.dtype(output)
+
+    def cast_output(self, image):
+        """Convert a processed image to the output data type
+
+        Integer outputs are rounded and clipped to their range.
+
+        Args:
+            image (np.ndarray): Processed image
+
+        Returns:
+            np.ndarray: The image in the output data type
+        """
+        if self.output.kind in "ui":
+            info = np.iinfo(self.output)
+            image = np.clip(np.round(image), info.min, info.max)
+        return np.asarray(image).astype(self.output, copy=False)
+
+    def __repr__(self):
+        return "Policy(%r)" % self.name
+
+POLICIES = {
+    "float64": Policy("float64", np.float64, np.float64),
+    "float32": Policy("float32", np.float32, np.float32),
+    "uint8": Policy("uint8", np.float32, np.uint8)
+}
+
+_policy = POLICIES[os.environ.get("NIGHTFLARE_PRECISION", "float64")]
+
+def set_policy(name):
+    """Set the default precision policy
+
+    Args:
+        name (str): "float64", "float32" or "uint8"
+    """
+    global _policy
+    _policy = get_policy(name)
+
+def get_policy(name=None):
+    """Look up a precision policy
+
+    Args:
+        name (str or Policy, optional): Name of the policy. None gives the
+            default policy.
+
+    Returns:
+        Policy: The policy
+
+    Raises:
+        ValueError: Unknown policy
+    """
+    if name is None:
+        return _policy
+    if isinstance(name, Policy):
+        return name
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError("Unknown precision policy %s" % name)
@@ -0,0 +1,236 @@
+"""Multi-resolution overview pyramid of processed images
+
+Composites of the raw images are computed once at a base zoom level. Coarser
+levels are derived from the composites of the four child tiles of the next
+finer level by 2x2 block averaging, so every level is consistent with the
+base level. A tile is then processed once from the composite of its level,
+so it is normalized by its own maximum rather than mixing children
+normalized on different scales. Composites and processed tiles are cached on
+disk as one tile per file.
+
+On a cold cache, tiles more than max_depth levels above the base zoom are
+composited from raw images of their own zoom level, unless the composites of
+their children are cached, instead of fetching every base tile below them.
+build() computes the levels bottom up, so they all derive from the base.
+"""
+import math
+import os
+import threading
+import numpy as np
+import improcess
+
+_pyramid_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    "pyramid.cache")
+
+_methods = ["clip", "band_reject"]
+
+# Number of levels above the base zoom derived from base tiles on a cold cache
+_max_depth = 2
+
+def set_cache_dir(path):
+    """Set the directory of the composites and processed tiles,
+    pyramid.cache next to this module by default
+
+    Args:
+        path (str): Cache directory, created on the first write
+    """
+    global _pyramid_path
+    _pyramid_path = path
+
+def grid_shape(tileMatrix):
+    """Number of tiles of a zoom level in the EPSG4326 tile matrix set
+
+    Args:
+        tileMatrix (int): Zoom in level
+
+    Returns:
+        rows (int): Number of tile rows
+        cols (int): Number of tile columns
+    """
+    rows = int(math.ceil(0.625 * (2 ** tileMatrix)))
+    cols = int(math.ceil(1.25 * (2 ** tileMatrix)))
+    return rows, cols
+
+def downsample(image):
+    """Halve the resolution of an image by 2x2 block averaging
+
+    Args:
+        image (np.ndarray): Image with even height and width
+
+    Returns:
+        np.ndarray: Image with half the height and width
+    """
+    h, w = image.shape
+    return image.reshape(h // 2, 2, w // 2, 2).mean(axis=(1, 3))
+
+def _tile_path(tileMatrix, tileCol, tileRow, base_zoom, method, start_date, num_days):
+    key = "%s_%s_%s_%s_%s_%s_%s" % (
+        method, start_date, num_days, base_zoom, tileMatrix, tileCol, tileRow)
+    return os.path.join(_pyramid_path, "%s.npy" % key)
+
+def _save(fname, image):
+    try:
+        os.mkdir(_pyramid_path)
+    except OSError:
+        if not os.path.isdir(_pyramid_path):
+            raise
+
+    # Write to a temporary file first so a crash never leaves a partial tile
+    tmp_fname = "%s.%d.%d.tmp" % (fname, os.getpid(),
+        threading.current_thread().ident)
+    with open(tmp_fname, "wb") as f:
+        np.save(f, image)
+    os.rename(tmp_fname, fname)
+
+def _load(fname):
+    try:
+        return np.load(fname)
+    except (OSError, IOError, ValueError):
+        return None
+
+def get_composite(
+        tileMatrix=5,
+        tileCol=6,
+        tileRow=5,
+        base_zoom=5,
+        start_date="2017-10-01",
+        num_days=31,
+        max_depth=None):
+    """Get the composite of the raw images of a tile. Result is cached.
+
+    Tiles at or above base_zoom are composited from raw images. Tiles below
+    base_zoom are block averaged from the composites of their four children,
+    unless they are more than max_depth levels above base_zoom and their
+    children are not all cached, in which case they are composited from raw
+    images of their own zoom level. Children outside the tile matrix are
+    treated as dark.
+
+    Args:
+        tileMatrix (int, optional): Zoom in level
+        tileCol (int, optional): Column
+        tileRow (int, optional): Row
+        base_zoom (int, optional): Zoom in level composites are made at
+        start_date (str, optional): Start date of the composite
+        num_days (int, optional): Number of days of the composite
+        max_depth (int, optional): Number of levels above base_zoom derived
+            from base tiles on a cold cache. Defaults to _max_depth.
+
+    Returns:
+        np.ndarray: 512x512 float32 composite
+    """
+    max_depth = _max_depth if max_depth is None else max_depth
+    fname = _tile_path(tileMatrix, tileCol, tileRow, base_zoom, "composite",
+        start_date, num_days)
+    image = _load(fname)
+    if image is not None:
+        return image
+
+    rows, cols = grid_shape(tileMatrix)
+    if not (0 <= tileRow < rows and 0 <= tileCol < cols):
+        return np.zeros((512, 512), np.float32)
+
+    children = [(tileMatrix + 1, 2 * tileCol + i, 2 * tileRow + j)
+        for j in range(2) for i in range(2)]
+    derive = tileMatrix < base_zoom and (base_zoom - tileMatrix <= max_depth
+        or all(os.path.exists(_tile_path(z, c, r, base_zoom, "composite",
+            start_date, num_days)) for z, c, r in children))
+    if derive:
+        tiles = [get_composite(z, c, r, base_zoom, start_date, num_days,
+            max_depth) for z, c, r in children]
+        image = downsample(np.block([tiles[:2], tiles[2:]]))
+    else:
+        image = improcess.get_composite(
+            tileMatrix=tileMatrix,
+            tileCol=tileCol,
+            tileRow=tileRow,
+            start_date=start_date,
+            num_days=num_days)
+
+    image = np.asarray(image, dtype=np.float32)
+    _save(fname, image)
+    return image
+
+def get_tile(
+        tileMatrix=5,
+        tileCol=6,
+        tileRow=5,
+        base_zoom=5,
+        method="band_reject",
+        start_date="2017-10-01",
+        num_days=31,
+        max_depth=None):
+    """Get a processed tile from the pyramid. Result is cached.
+
+    The composite of the tile, see get_composite, is processed with the
+    method, so every level is normalized once by its own maximum.
+
+    Args:
+        tileMatrix (int, optional): Zoom in level
+        tileCol (int, optional): Column
+        tileRow (int, optional): Row
+        base_zoom (int, optional): Zoom in level composites are made at
+        method (str, optional): Image processing method, "clip" or
+            "band_reject"
+        start_date (str, optional): Start date of the composite
+        num_days (int, optional): Number of days of the composite
+        max_depth (int, optional): See get_composite
+
+    Returns:
+        np.ndarray: 512x512 float32 processed image
+    """
+    if method not in _methods:
+        raise ValueError("Unknown method %s" % method)
+    fname = _tile_path(tileMatrix, tileCol, tileRow, base_zoom, method,
+        start_date, num_days)
+    image = _load(fname)
+    if image is not None:
+        return image
+
+    rows, cols = grid_shape(tileMatrix)
+    if not (0 <= tileRow < rows and 0 <= tileCol < cols):
+        return np.zeros((512, 512), np.float32)
+
+    arr = get_composite(tileMatrix, tileCol, tileRow, base_zoom, start_date,
+        num_days, max_depth)
+    image = np.asarray(improcess.process_composite(arr, method),
+        dtype=np.float32)
+    _save(fname, image)
+    return image
+
+def build(
+        tileMatrix=6,
+        tileCol=12,
+        tileRow=10,
+        num_cols=3,
+        num_rows=3,
+        min_zoom=1,
+        **kwargs):
+    """Build all overview levels of a region from base zoom composites
+
+    The region is given in tiles at the base zoom level. Every tile of every
+    level from tileMatrix down to min_zoom that overlaps the region is
+    computed and cached, finest level first, so every level is derived from
+    the base composites.
+
+    Args:
+        tileMatrix (int, optional): Base zoom in level
+        tileCol (int, optional): Column of the top left tile
+        tileRow (int, optional): Row of the top left tile
+        num_cols (int, optional): Width of the region in tiles
+        num_rows (int, optional): Height of the region in tiles
+        min_zoom (int, optional): Coarsest zoom in level to build
+        **kwargs: Extra parameters passed to get_tile
+    """
+    kwargs.setdefault("max_depth", tileMatrix - min_zoom)
+    col0, row0 = tileCol, tileRow
+    col1, row1 = tileCol + num_cols - 1, tileRow + num_rows - 1
+    for zoom in range(tileMatrix, min_zoom - 1, -1):
+        shift = tileMatrix - zoom
+        for row in range(row0 >> shift, (row1 >> shift) + 1):
+            for col in range(col0 >> shift, (col1 >> shift) + 1):
+                get_tile(
+                    tileMatrix=zoom,
+                    tileCol=col,
+                    tileRow=row,
+                    base_zoom=tileMatrix,
+                    **kwargs)
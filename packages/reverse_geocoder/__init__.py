@@ -6,9 +6,12 @@ called reverse_geocode developed by Richard Penman.
 from __future__ import print_function
 
 __author__ = 'Ajay Thampi'
+import json
 import os
+import shutil
 import sys
 import csv
+import threading
 if sys.platform == 'win32':
     # Windows C long is 32 bits, and the Python int is too large to fit inside.
     # Use the limit appropriate for a 32-bit integer as the max file size
@@ -16,7 +19,6 @@ if sys.platform == 'win32':
 else:
     csv.field_size_limit(sys.maxsize)
 import zipfile
-from scipy.spatial import cKDTree as KDTree
 from reverse_geocoder import cKDTree_MP as KDTree_MP
 import numpy as np
 
@@ -69,6 +71,17 @@ RG_COLUMNS = [
 # Name of cities file created by this library
 RG_FILE = 'rg_cities1000.csv'
 
+# Name of the directory of the memory mapped index of RG_FILE
+RG_INDEX = 'rg_cities1000.index'
+
+# Space filling curve ('hilbert' or 'morton') along which large batches of
+# coordinates are queried. It pays off for trees much larger than the cities
+# file only, so it is off by default.
+RG_ORDER = None
+
+# Number of coordinates from which a batch is queried along RG_ORDER
+RG_ORDER_MIN = 100000
+
 # WGS-84 major axis in kms
 A = 6378.137
 
@@ -80,52 +93,276 @@ def singleton(cls):
     Function to get single instance of the RGeocoder class
     """
     instances = {}
-    def getinstance(**kwargs):
+    lock = threading.Lock()
+    def getinstance(rebuild=None, **kwargs):
         """
-        Creates a new RGeocoder instance if not created already
+        Creates a new RGeocoder instance if not created already. Threads asking
+        for it at the same time wait for the first one to build it.
+        Args:
+        rebuild (callable): Function of the instance telling whether to
+                            replace it with a new one built from kwargs
         """
-        if cls not in instances:
-            instances[cls] = cls(**kwargs)
+        with lock:
+            if cls not in instances or (rebuild and rebuild(instances[cls])):
+                instances[cls] = cls(**kwargs)
         return instances[cls]
     return getinstance
 
+def _encode(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+def _decode(value):
+    return value if str is bytes else value.decode('utf-8')
+
+class Locations(object):
+    """
+    Columnar store of the locations of the geocoder
+
+    Every column of RG_COLUMNS is dictionary encoded: one integer code per
+    location into a table of distinct values, kept as one buffer of utf-8 bytes
+    and the offsets of the values in it. The store is then a handful of numpy
+    arrays, which forked processes share without copying and which can be
+    memory mapped from disk, instead of one Python dict per location.
+    """
+    def __init__(self, coordinates, columns):
+        """ Class Instantiation
+        Args:
+        coordinates (np.ndarray): Latitude and longitude of every location
+        columns (dict): Codes, offsets and data arrays of every column
+        """
+        self.coordinates = coordinates
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Function that encodes locations read from a cities file
+        Args:
+        rows (list): One dict per location with the columns of RG_COLUMNS
+        """
+        columns = {}
+        for name in RG_COLUMNS:
+            table = {}
+            codes = np.empty(len(rows), np.int32)
+            for k, row in enumerate(rows):
+                codes[k] = table.setdefault(row[name], len(table))
+            values = [_encode(v) for v in sorted(table, key=table.get)]
+            offsets = np.zeros(len(values) + 1, np.int64)
+            offsets[1:] = np.cumsum([len(v) for v in values])
+            data = np.frombuffer(b''.join(values), np.uint8) if values else np.zeros(0, np.uint8)
+            columns[name] = (codes, offsets, data)
+        coordinates = np.array([(row['lat'], row['lon']) for row in rows], dtype=float)
+        return cls(coordinates.reshape(-1, 2), columns)
+
+    def save(self, path, stamp=None):
+        """
+        Function that writes the store as numpy files, replacing a previous one
+        Args:
+        path (str): Directory of the store
+        stamp (list): Version of the data source, see _stamp
+        """
+        suffix = '%d.%d' % (os.getpid(), threading.current_thread().ident)
+        tmp_path = '%s.%s.tmp' % (path, suffix)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'coordinates.npy'), self.coordinates)
+        for name, arrays in self.columns.items():
+            for part, arr in zip(('codes', 'offsets', 'data'), arrays):
+                np.save(os.path.join(tmp_path, '%s.%s.npy' % (name, part)), arr)
+        with open(os.path.join(tmp_path, 'stamp.json'), 'w') as f:
+            json.dump(stamp, f)
+
+        # The previous store is moved aside before it is deleted, so the
+        # path never holds a partly deleted store, and readers still mapping
+        # its files keep them
+        old_path = '%s.%s.old' % (path, suffix)
+        try:
+            os.rename(path, old_path)
+        except OSError:
+            old_path = None
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process saved the store in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Function that memory maps a store written by save
+        Args:
+        path (str): Directory of the store
+        """
+        coordinates = np.load(os.path.join(path, 'coordinates.npy'), mmap_mode='r')
+        columns = {}
+        for name in RG_COLUMNS:
+            columns[name] = tuple(
+                np.load(os.path.join(path, '%s.%s.npy' % (name, part)), mmap_mode='r')
+                for part in ('codes', 'offsets', 'data'))
+        return cls(coordinates, columns)
+
+    @property
+    def nbytes(self):
+        """
+        Size of the arrays of the store in bytes
+        """
+        return self.coordinates.nbytes + sum(
+            arr.nbytes for arrays in self.columns.values() for arr in arrays)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def value(self, name, index):
+        """
+        Function that decodes the value of a column for one location
+        Args:
+        name (str): Column of RG_COLUMNS
+        index (int): Location
+        """
+        codes, offsets, data = self.columns[name]
+        code = codes[index]
+        return _decode(data[offsets[code]:offsets[code + 1]].tobytes())
+
+    def take(self, name, indices):
+        """
+        Function that decodes the values of a column for many locations
+        Args:
+        name (str): Column of RG_COLUMNS
+        indices (np.ndarray): Locations
+        """
+        codes, offsets, data = self.columns[name]
+        codes = np.asarray(codes)[indices]
+        # Decode every distinct value once
+        unique, inverse = np.unique(codes, return_inverse=True)
+        values = [_decode(data[offsets[c]:offsets[c + 1]].tobytes()) for c in unique]
+        return [values[k] for k in inverse.ravel()]
+
+    def rows(self, indices):
+        """
+        Function that decodes many locations as dicts like rows of the cities file.
+        Queries of the same location share one dict.
+        Args:
+        indices (np.ndarray): Locations
+        """
+        # Decode every distinct location once
+        unique, inverse = np.unique(np.asarray(indices), return_inverse=True)
+        columns = [(name, self.take(name, unique)) for name in RG_COLUMNS]
+        rows = [dict((name, values[k]) for name, values in columns)
+                for k in range(len(unique))]
+        return [rows[k] for k in inverse.ravel()]
+
+    def __getitem__(self, index):
+        """
+        Function that decodes a location as a dict like a row of the cities file
+        """
+        return dict((name, self.value(name, index)) for name in RG_COLUMNS)
+
 @singleton
 class RGeocoder(object):
     """
     The main reverse geocoder class
     """
-    def __init__(self, mode=2, verbose=True, stream=None):
+    def __init__(self, mode=2, verbose=True, stream=None, index=None):
         """ Class Instantiation
         Args:
         mode (int): Library supports the following two modes:
                     - 1 = Single-threaded K-D Tree
                     - 2 = Multi-threaded K-D Tree (Default)
+                    It is the default mode of queries, which can pick either.
         verbose (bool): For verbose output, set to True
         stream (io.StringIO): An in-memory stream of a custom data source
+        index (str): Directory of the memory mapped locations. It is written
+                     from the data source if it does not exist. Defaults to
+                     RG_INDEX next to RG_FILE when there is no stream.
         """
         self.mode = mode
         self.verbose = verbose
-        if stream:
-            coordinates, self.locations = self.load(stream)
-        else:
-            coordinates, self.locations = self.extract(rel_path(RG_FILE))
+        if index is None and not stream:
+            index = rel_path(RG_INDEX)
+        self.stream = stream
+        self.index = index
+
+        self.locations = None
+        if index and not stream:
+            self.locations = self.load_index(index, rel_path(RG_FILE))
+        if self.locations is None:
+            if stream:
+                _, rows = self.load(stream)
+            else:
+                _, rows = self.extract(rel_path(RG_FILE))
+            self.locations = Locations.from_rows(list(rows))
+            if index:
+                self.save_index(index, None if stream else rel_path(RG_FILE))
+
+        # The tree keeps its points in shared memory and supports both modes
+        self.tree = KDTree_MP.cKDTree_MP(self.locations.coordinates)
+
+    def load_index(self, index, source):
+        """
+        Function that memory maps the locations saved in an index directory
+        Args:
+        index (str): Directory of the index
+        source (str): Cities file the index was written from. The index is
+                      ignored if the file changed since.
+        """
+        try:
+            with open(os.path.join(index, 'stamp.json')) as f:
+                stamp = json.load(f)
+            if source and os.path.exists(source) and stamp != _stamp(source):
+                return None
+            if self.verbose:
+                print('Loading geocoder index...')
+            return Locations.load(index)
+        except (OSError, IOError, ValueError):
+            return None
 
-        if mode == 1: # Single-process
-            self.tree = KDTree(coordinates)
-        else: # Multi-process
-            self.tree = KDTree_MP.cKDTree_MP(coordinates)
+    def save_index(self, index, source):
+        """
+        Function that saves the locations to an index directory
+        Args:
+        index (str): Directory of the index
+        source (str): Cities file the locations were read from
+        """
+        if self.verbose:
+            print('Saving geocoder index...')
+        self.locations.save(index, _stamp(source) if source else None)
 
-    def query(self, coordinates):
+    def query_indices(self, coordinates, mode=None):
         """
-        Function to query the K-D tree to find the nearest city
+        Function to query the K-D tree for the index of the nearest city
         Args:
         coordinates (list): List of tuple coordinates, i.e. [(latitude, longitude)]
+        mode (int): 1 for a single process query, 2 for a multi-process query.
+                    Defaults to the mode of the geocoder.
         """
-        if self.mode == 1:
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        perm = None
+        if RG_ORDER and len(coordinates) >= RG_ORDER_MIN:
+            # Neighbouring queries walk the same branches of the tree
+            perm = KDTree_MP.spatial_order(coordinates, RG_ORDER)
+            coordinates = coordinates[perm]
+        if (mode or self.mode) == 1:
             _, indices = self.tree.query(coordinates, k=1)
         else:
             _, indices = self.tree.pquery(coordinates, k=1)
-        return [self.locations[index] for index in indices]
+        indices = np.asarray(indices).ravel()
+        if perm is not None:
+            ordered, indices = indices, np.empty_like(indices)
+            indices[perm] = ordered
+        return indices
+
+    def query(self, coordinates, mode=None):
+        """
+        Function to query the K-D tree to find the nearest city
+        Args:
+        coordinates (list): List of tuple coordinates, i.e. [(latitude, longitude)]
+        mode (int): 1 for a single process query, 2 for a multi-process query.
+                    Defaults to the mode of the geocoder.
+        """
+        return self.locations.rows(self.query_indices(coordinates, mode))
 
     def load(self, stream):
         """
@@ -249,6 +486,13 @@ class RGeocoder(object):
             locations.append(row)
         return geo_coords, locations
 
+def _stamp(fname):
+    """
+    Function that identifies a version of a file by its size and modification time
+    """
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime]
+
 def geodetic_in_ecef(geo_coords):
     geo_coords = np.asarray(geo_coords).astype(np.float)
     lat = geo_coords[:, 0]
@@ -270,27 +514,64 @@ def rel_path(filename):
     """
     return os.path.join(os.getcwd(), os.path.dirname(__file__), filename)
 
-def get(geo_coord, mode=2, verbose=True):
+def get(geo_coord, mode=None, verbose=True):
     """
     Function to query for a single coordinate
+    Args:
+    geo_coord (tuple): Latitude and longitude
+    mode (int): 1 for a single process query, 2 for a multi-process query.
+                Defaults to the mode the geocoder was built with, 2 unless it
+                was preloaded with another.
+    verbose (bool): For verbose output, set to True
     """
     if not isinstance(geo_coord, tuple) or not isinstance(geo_coord[0], float):
         raise TypeError('Expecting a tuple')
 
-    _rg = RGeocoder(mode=mode, verbose=verbose)
-    return _rg.query([geo_coord])[0]
+    _rg = RGeocoder(mode=mode or 2, verbose=verbose)
+    return _rg.query([geo_coord], mode=mode)[0]
 
-def search(geo_coords, mode=2, verbose=True):
+def search(geo_coords, mode=None, verbose=True):
     """
     Function to query for a list of coordinates
+    Args:
+    geo_coords (list): List of tuple coordinates, i.e. [(latitude, longitude)]
+    mode (int): 1 for a single process query, 2 for a multi-process query.
+                Defaults to the mode the geocoder was built with, 2 unless it
+                was preloaded with another.
+    verbose (bool): For verbose output, set to True
     """
     if not isinstance(geo_coords, tuple) and not isinstance(geo_coords, list):
         raise TypeError('Expecting a tuple or a tuple/list of tuples')
     elif not isinstance(geo_coords[0], tuple):
         geo_coords = [geo_coords]
 
-    _rg = RGeocoder(mode=mode, verbose=verbose)
-    return _rg.query(geo_coords)
+    _rg = RGeocoder(mode=mode or 2, verbose=verbose)
+    return _rg.query(geo_coords, mode=mode)
+
+def preload(mode=2, verbose=True, stream=None, index=None):
+    """
+    Function to build the geocoder now instead of on the first query
+
+    Call it in a parent process before starting a pool of workers: forked
+    workers then share the locations and the points of the tree with the
+    parent instead of each loading their own copy on their first query.
+    Workers which are not forked memory map the index directory, which the
+    operating system shares between processes, and only rebuild the tree.
+    A geocoder built from another stream or index is built again, while the
+    mode and verbosity of a geocoder built already are changed in place.
+    Args:
+    mode (int): Default mode of queries, see RGeocoder
+    verbose (bool): For verbose output, set to True
+    stream (io.StringIO): An in-memory stream of a custom data source
+    index (str): Directory of the memory mapped locations, see RGeocoder
+    """
+    if index is None and not stream:
+        index = rel_path(RG_INDEX)
+    _rg = RGeocoder(mode=mode, verbose=verbose, stream=stream, index=index,
+        rebuild=lambda built: built.stream is not stream or built.index != index)
+    _rg.mode = mode
+    _rg.verbose = verbose
+    return _rg
 
 if __name__ == '__main__':
     print('Testing single coordinate through get...')
@@ -14,7 +14,7 @@ def shmem_as_nparray(shmem_array):
     """
     return np.frombuffer(shmem_array.get_obj())
 
-def _pquery(scheduler, data, ndata, ndim, leafsize,
+def _pquery(scheduler, worker, data, ndata, ndim, leafsize,
             x, nx, d, i, k, eps, p, dub, ierr):
     """
     Function that parallelly queries the K-D tree based on chunks of data returned by the scheduler
@@ -27,14 +27,81 @@ def _pquery(scheduler, data, ndata, ndim, leafsize,
 
         kdtree = cKDTree(_data, leafsize=leafsize)
 
-        for s in scheduler:
+        for s in scheduler.chunks(worker):
             d_out, i_out = kdtree.query(_x[s, :], k=k, eps=eps, p=p, distance_upper_bound=dub)
             m_d = d_out.shape[0]
             m_i = i_out.shape[0]
-            _d[s, :], _i[s, :] = d_out.reshape(m_d, 1), i_out.reshape(m_i, 1)
+            _d[s, :], _i[s, :] = d_out.reshape(m_d, k), i_out.reshape(m_i, k)
     except:
         ierr.value += 1
 
+def _part1by1(v):
+    """
+    Function that spreads the 16 low bits of integers to the even bits
+    """
+    v = v & 0x0000ffff
+    v = (v | (v << 8)) & 0x00ff00ff
+    v = (v | (v << 4)) & 0x0f0f0f0f
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+def _grid(x, bits):
+    """
+    Function that quantizes the first two coordinates of points to a 2**bits grid over their bounding box
+    """
+    lo = x[:, :2].min(axis=0)
+    span = x[:, :2].max(axis=0) - lo
+    span[span == 0] = 1
+    g = ((x[:, :2] - lo) / span * ((1 << bits) - 1)).astype(np.int64)
+    return g[:, 0], g[:, 1]
+
+def morton_codes(x, bits=16):
+    """
+    Function that computes the Morton (Z-order) code of every point
+    """
+    gx, gy = _grid(x, bits)
+    return _part1by1(gx) | (_part1by1(gy) << 1)
+
+def hilbert_codes(x, bits=16):
+    """
+    Function that computes the distance of every point along a Hilbert curve
+    """
+    gx, gy = _grid(x, bits)
+    n = 1 << bits
+    d = np.zeros(len(gx), np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (gx & s) > 0
+        ry = (gy & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous: mirror with an
+        # xor of n - 1 and swap with an xor of the difference
+        mirror = -(rx & ~ry).astype(np.int64) & (n - 1)
+        gx ^= mirror
+        gy ^= mirror
+        swap = (gx ^ gy) & -(~ry).astype(np.int64)
+        gx ^= swap
+        gy ^= swap
+        s >>= 1
+    return d
+
+def spatial_order(x, curve='hilbert'):
+    """
+    Function that returns the permutation sorting points along a space filling curve,
+    so that points close in the order are close in space
+    Args:
+    x (np.ndarray): Points, one per row
+    curve (str): 'hilbert' or 'morton'
+    """
+    if curve == 'hilbert':
+        codes = hilbert_codes(x)
+    elif curve == 'morton':
+        codes = morton_codes(x)
+    else:
+        raise ValueError('Unknown curve %s' % curve)
+    return np.argsort(codes, kind='mergesort')
+
 def num_cpus():
     """
     Function to get the number of CPUs / cores. This is used to determine the number of processes to spawn.
@@ -64,12 +131,25 @@ class cKDTree_MP(cKDTree):
         super(cKDTree_MP, self).__init__(_data, leafsize=leafsize)
 
     def pquery(self, x_list, k=1, eps=0, p=2,
-               distance_upper_bound=np.inf):
+               distance_upper_bound=np.inf, order=None, chunk=None):
         """
         Function to parallelly query the K-D Tree
+
+        Points are queried in chunks which idle workers steal from busy ones.
+        Additional arguments:
+        order (str): Query points sorted along a 'hilbert' or 'morton' curve, so
+                     neighbouring queries walk the same branches of the tree.
+                     Results are returned in the order of x_list.
+        chunk (int): Number of points queried at once. Defaults to a size giving
+                     every process many chunks.
         """
-        x = np.array(x_list)
+        x = np.array(x_list, dtype=np.float64)
         nx, mx = x.shape
+        perm = None
+        if order and nx > 1:
+            perm = spatial_order(x, order)
+            x = x[perm]
+
         shmem_x = mp.Array(ctypes.c_double, nx*mx)
         shmem_d = mp.Array(ctypes.c_double, nx*k)
         shmem_i = mp.Array(ctypes.c_double, nx*k)
@@ -83,78 +163,77 @@ class cKDTree_MP(cKDTree):
 
         _x[:, :] = x
 
-        nprocs = num_cpus()
-        scheduler = Scheduler(nx, nprocs)
+        chunk = chunk or Scheduler.default_chunk(nx, num_cpus())
+        nprocs = max(1, min(num_cpus(), -(-nx // chunk)))
+        scheduler = Scheduler(nx, nprocs, chunk)
 
         ierr = mp.Value(ctypes.c_int, 0)
 
-        query_args = (scheduler,
+        pool = [mp.Process(target=_pquery, args=(scheduler, worker,
                       self.shmem_data, self.n, self.m, self.leafsize,
                       shmem_x, nx, shmem_d, shmem_i,
                       k, eps, p, distance_upper_bound,
-                      ierr)
-        pool = [mp.Process(target=_pquery, args=query_args) for _ in range(nprocs)]
-        for p in pool: p.start()
-        for p in pool: p.join()
+                      ierr)) for worker in range(nprocs)]
+        for proc in pool: proc.start()
+        for proc in pool: proc.join()
         if ierr.value != 0:
             raise RuntimeError('%d errors in worker processes' % (ierr.value))
 
-        return _d.copy(), _i.astype(int).copy()
+        d_out, i_out = _d.copy(), _i.astype(int)
+        if perm is not None:
+            # Inverse permutation back to the order of the query points
+            d_out[perm], i_out[perm] = d_out.copy(), i_out.copy()
+        return d_out, i_out
 
 class Scheduler:
     """
-    Scheduler that returns chunks of data to be queries on the K-D Tree.
-    The number of chunks is determined by the number of processes.
+    Scheduler that returns chunks of data to be queried on the K-D Tree.
+    Every process owns a contiguous range of the data and takes chunks from its
+    front. A process whose range is empty steals the back half of the largest
+    range left, so no process idles while another one has work, and every
+    process keeps working on neighbouring points.
     """
-    def __init__(self, ndata, nprocs):
-        self._ndata = mp.RawValue(ctypes.c_int, ndata)
-        self._start = mp.RawValue(ctypes.c_int, 0)
+    def __init__(self, ndata, nprocs, chunk=None):
+        self._nprocs = nprocs
+        self._chunk = max(1, chunk or self.default_chunk(ndata, nprocs))
+        bounds = [ndata * w // nprocs for w in range(nprocs + 1)]
+        self._start = mp.RawArray(ctypes.c_long, bounds[:-1])
+        self._end = mp.RawArray(ctypes.c_long, bounds[1:])
         self._lock = mp.Lock()
-        min_chunk = ndata // nprocs
-        min_chunk = ndata if min_chunk <= 2 else min_chunk
-        self._chunk = min_chunk
-
-    def __iter__(self):
-        return self
-
-    def next(self): # Python 2 support
-        self._lock.acquire()
-        ndata = self._ndata.value
-        start = self._start.value
-        chunk = self._chunk
-        if ndata:
-            if chunk > ndata:
-                _s0 = start
-                _s1 = start + ndata
-                self._ndata.value = 0
-            else:
-                _s0 = start
-                _s1 = start + chunk
-                self._ndata.value = ndata - chunk
-                self._start.value = start + chunk
-            self._lock.release()
-            return slice(_s0, _s1)
-        else:
-            self._lock.release()
-            raise StopIteration
-
-    def __next__(self): # Python 3 support
-        self._lock.acquire()
-        ndata = self._ndata.value
-        start = self._start.value
-        chunk = self._chunk
-        if ndata:
-            if chunk > ndata:
-                _s0 = start
-                _s1 = start + ndata
-                self._ndata.value = 0
-            else:
-                _s0 = start
-                _s1 = start + chunk
-                self._ndata.value = ndata - chunk
-                self._start.value = start + chunk
-            self._lock.release()
-            return slice(_s0, _s1)
-        else:
-            self._lock.release()
-            raise StopIteration
+        self.steals = mp.RawValue(ctypes.c_int, 0)
+
+    @staticmethod
+    def default_chunk(ndata, nprocs):
+        """
+        Function that returns a chunk size giving every process about 32 chunks,
+        large enough for the overhead of a query call not to matter
+        """
+        return max(256, ndata // (nprocs * 32))
+
+    def _next(self, worker):
+        with self._lock:
+            start, end = self._start[worker], self._end[worker]
+            if start >= end:
+                # Steal the back half of the largest range left
+                victim = max(range(self._nprocs),
+                             key=lambda w: self._end[w] - self._start[w])
+                left = self._end[victim] - self._start[victim]
+                if left <= 0:
+                    return None
+                split = self._end[victim] - (left + 1) // 2
+                start, end = split, self._end[victim]
+                self._end[victim] = split
+                self.steals.value += 1
+            stop = min(end, start + self._chunk)
+            self._start[worker], self._end[worker] = stop, end
+            return slice(start, stop)
+
+    def chunks(self, worker):
+        """
+        Function that yields the chunks processed by a worker
+        """
+        while True:
+            s = self._next(worker)
+            if s is None:
+                return
+            yield s
@@ -0,0 +1,124 @@
+"""Per-pixel temporal analytics over a stack of processed images
+
+Every function takes either a datacube.DataCube or a (time, y, x) numpy
+array and returns a raster with the shape of one image, so the results can
+be passed to conversion.geodecode_region like a processed image. Stacks are
+processed one spatial block at a time with vectorized reductions over the
+time axis, so memory stays bounded by the block size.
+"""
+import numpy as np
+
+def _blocks(height, width, block):
+    for y in range(0, height, block):
+        for x in range(0, width, block):
+            yield slice(y, min(y + block, height)), slice(x, min(x + block, width))
+
+def _time_index(source, time):
+    if not isinstance(time, (int, np.integer)):
+        return source.times.index(time)
+    return time if time >= 0 else source.shape[0] + time
+
+def slope(source, block=256):
+    """Least-squares slope of every pixel over time
+
+    Time steps are assumed to be evenly spaced, so the slope is the change
+    of light level per time step. Missing values, NaN, are left out of the
+    fit of their pixel. Pixels with less than two values get NaN.
+
+    Args:
+        source (DataCube or np.ndarray): (time, y, x) stack
+        block (int, optional): Side length of the spatial blocks
+
+    Returns:
+        np.ndarray: float32 raster of slopes
+    """
+    num_times, height, width = source.shape
+    if num_times < 2:
+        raise ValueError("at least two time steps are needed")
+
+    t = np.arange(num_times, dtype=np.float64)
+    t -= t.mean()
+    weights = t / np.dot(t, t)
+
+    out = np.empty((height, width), np.float32)
+    for ys, xs in _blocks(height, width, block):
+        values = np.asarray(source[:, ys, xs], np.float64)
+        valid = ~np.isnan(values)
+        if valid.all():
+            out[ys, xs] = np.tensordot(weights, values, axes=(0, 0))
+            continue
+
+        # Center time on the valid steps of every pixel
+        count = valid.sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tc = np.where(valid, t[:, None, None], 0)
+            tc = np.where(valid, tc - tc.sum(axis=0) / count, 0)
+            out[ys, xs] = ((tc * np.where(valid, values, 0)).sum(axis=0)
+                / (tc * tc).sum(axis=0))
+        out[ys, xs][count < 2] = np.nan
+    return out
+
+def change(source, time=-1, block=256):
+    """Change of every pixel from the previous time step
+
+    Args:
+        source (DataCube or np.ndarray): (time, y, x) stack
+        time (int or str, optional): Index, or label for a DataCube, of the
+            time step
+        block (int, optional): Side length of the spatial blocks
+
+    Returns:
+        np.ndarray: float32 raster of differences
+    """
+    t = _time_index(source, time)
+    if t < 1:
+        raise ValueError("the first time step has no previous time step")
+
+    _, height, width = source.shape
+    out = np.empty((height, width), np.float32)
+    for ys, xs in _blocks(height, width, block):
+        values = np.asarray(source[t - 1:t + 1, ys, xs], np.float32)
+        np.subtract(values[1], values[0], out=out[ys, xs])
+    return out
+
+def anomaly(source, time=-1, baseline=12, block=256):
+    """z-score of every pixel against its trailing baseline
+
+    The baseline of a time step is made of the time steps just before it.
+    Missing values, NaN, are left out of the baseline of their pixel.
+    Pixels whose baseline has no variance get a score of 0, and pixels
+    without any baseline value get NaN.
+
+    Args:
+        source (DataCube or np.ndarray): (time, y, x) stack
+        time (int or str, optional): Index, or label for a DataCube, of the
+            time step
+        baseline (int, optional): Maximum number of time steps of the
+            baseline
+        block (int, optional): Side length of the spatial blocks
+
+    Returns:
+        np.ndarray: float32 raster of z-scores
+    """
+    t = _time_index(source, time)
+    t0 = max(0, t - baseline)
+    if t - t0 < 2:
+        raise ValueError("at least two baseline time steps are needed")
+
+    _, height, width = source.shape
+    out = np.empty((height, width), np.float32)
+    for ys, xs in _blocks(height, width, block):
+        values = np.asarray(source[t0:t + 1, ys, xs], np.float32)
+        history = values[:-1]
+        valid = ~np.isnan(history)
+        count = valid.sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(valid, history, 0).sum(axis=0) / count
+            deviation = np.where(valid, history - mean, 0)
+            std = np.sqrt((deviation * deviation).sum(axis=0) / count)
+
+        score = values[-1] - mean
+        np.divide(score, std, out=score, where=std > 0)
+        score[(std == 0) & ~np.isnan(values[-1])] = 0
+        out[ys, xs] = score
+    return out
@@ -1,17 +1,12 @@
 """Summary
 """
 import numpy as np
-import matplotlib as matplot
-import matplotlib.pyplot as plt
-from ipywidgets import Button, VBox, HBox, IntSlider
-from IPython.display import display
-from PIL import Image
 import getimage
 import conversion
-import matplotlib.animation as animation
 import datetime
 import collections
 import improcess
+import pyramid
 
 class StaticPlot:
 
@@ -20,6 +15,7 @@ class StaticPlot:
     Attributes:
         ax (plt.Axes): Subplot
         ax_im (plt.axesImage): Image plot in "ax"
+        base_zoom (int): Zoom in level composites are processed at
         date (str): Date
         fig (plt.figure): Figure of plots
         slider (ipywidget.Slider): Slider widget
@@ -33,7 +29,8 @@ class StaticPlot:
             tileMatrix=5,
             tileCol=6,
             tileRow=5,
-            date="2017-10-31"):
+            date="2017-10-31",
+            base_zoom=None):
         """Implementing information of tiles
         
         Args:
@@ -41,6 +38,9 @@ class StaticPlot:
             tileCol (int, optional): Column
             tileRow (int, optional): Row
             date (str, optional): Date
+            base_zoom (int, optional): Zoom in level composites are processed
+                at. Coarser levels are read from the overview pyramid.
+                Defaults to tileMatrix.
         """
         self.fig = None
         self.ax = None
@@ -50,12 +50,14 @@ class StaticPlot:
         self.tileCol = tileCol
         self.tileRow =  tileRow
         self.date = date
+        self.base_zoom = tileMatrix if base_zoom is None else base_zoom
 
         self.slider = None
 
     def subplot(self):
         """Integrating functions and plotting.
         """
+        import matplotlib.pyplot as plt
         self.fig, self.ax = plt.subplots()
         self.create_imshow()
         self.create_buttons()
@@ -78,6 +80,8 @@ class StaticPlot:
         """Create buttons and set functions
         """
         # Create buttons
+        from ipywidgets import Button, VBox, HBox
+        from IPython.display import display
         button_left  = Button(description='Left')
         button_right = Button(description='Right')
         button_up    = Button(description='Up')
@@ -99,6 +103,8 @@ class StaticPlot:
         """Create slider and set function
         """
         # Create a slider
+        from ipywidgets import IntSlider
+        from IPython.display import display
         self.slider = IntSlider(
             value=5,
             min=1,
@@ -118,11 +124,14 @@ class StaticPlot:
     def render(self):
         """Rendering(Changing) image on the plot
         """
-        img_array = improcess.get_processed_image_band_reject(
+        img_array = pyramid.get_tile(
             tileMatrix = self.tileMatrix,
             tileCol = self.tileCol,
-            tileRow = self.tileRow)
+            tileRow = self.tileRow,
+            base_zoom = self.base_zoom)
 
+        import matplotlib.pyplot as plt
+        from PIL import Image
         img = Image.fromarray(img_array)
         self.ax_im.set_data(img)
 
@@ -273,6 +282,7 @@ class AnimatedPlot:
         Returns:
             plt.Animation: Function that has Animation
         """
+        import matplotlib.pyplot as plt
         self.fig, self.ax = plt.subplots()
         self.get_dates()
         self.load_image()
@@ -286,6 +296,7 @@ class AnimatedPlot:
         img_array = [improcess.get_processed_image_band_reject(
             start_date = i) for i in self.dates]
         #Make an array of image
+        from PIL import Image
         self.img = [Image.fromarray(i) for i in img_array]
 
     def create_imshow(self):
@@ -298,6 +309,7 @@ class AnimatedPlot:
             self.bot_right[0]
         )
         #Put initialized Image data in self.ax_im
+        import matplotlib.pyplot as plt
         self.ax_im = plt.imshow(np.zeros((512, 512)), extent=extent)
 
     def get_dates(self):
@@ -360,6 +372,7 @@ class AnimatedPlot:
             self.ax.set_title(self.dates[frame])
             return [self.ax_im]
 
+        import matplotlib.animation as animation
         return animation.FuncAnimation(
             self.fig, 
             update_fig, 
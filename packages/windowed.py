@@ -0,0 +1,268 @@
+"""Out-of-core processing of regions larger than memory
+
+get_california_image builds the mosaic of a region in memory and
+geodecode_region then needs all of it at once. Here a region of tiles is
+processed as one image in blocks instead. Tiles are composited one at a time
+into a disk backed array. Normalization, filters and zonal statistics then
+run block by block on windows extended by a halo as wide as the filters
+reach. The global maximum and the noise powers of the two Wiener filters are
+accumulated in passes of their own, so the result matches processing the
+whole mosaic in memory while peak memory depends on the block size only.
+
+Unlike get_california_image, which processes every tile on its own, the
+region is normalized once and the filters see across tile borders, so the
+mosaic has no seams.
+
+Usage:
+    image = windowed.process_region(7, 20, 16, num_cols=8, num_rows=6)
+    df = windowed.zonal_mean(image, 7, 20, 16, state="Colorado")
+"""
+import os
+import numpy as np
+import conversion
+import getimage
+import improcess
+from ops import blocks, read_window
+from precision import get_policy
+
+_windowed_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    "windowed.cache")
+
+_tile_size = 512
+
+def set_cache_dir(path):
+    """Set the directory of the processed regions, windowed.cache next to
+    this module by default
+
+    Args:
+        path (str): Cache directory, created on the first write
+    """
+    global _windowed_path
+    _windowed_path = path
+
+def _mask_window(tileMatrix, tileCol, tileRow, y0, y1, x0, x1):
+    """Land mask of a window of a region, assembled from the masks of the
+    tiles it overlaps
+    """
+    out = np.zeros((y1 - y0, x1 - x0), np.uint8)
+    for ty in range(y0 // _tile_size, (y1 - 1) // _tile_size + 1):
+        for tx in range(x0 // _tile_size, (x1 - 1) // _tile_size + 1):
+            mask = getimage.get_mask(tileMatrix=tileMatrix,
+                tileCol=tileCol + tx, tileRow=tileRow + ty)
+            oy, ox = ty * _tile_size, tx * _tile_size
+            sy0, sy1 = max(y0, oy), min(y1, oy + _tile_size)
+            sx0, sx1 = max(x0, ox), min(x1, ox + _tile_size)
+            out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = \
+                mask[sy0 - oy:sy1 - oy, sx0 - ox:sx1 - ox]
+    return out
+
+def _region_path(method, start_date, num_days, statistic, precision,
+        tileMatrix, tileCol, tileRow, num_cols, num_rows):
+    key = "%s_%s_%s_%s_%s_%s_%s_%s_%sx%s" % (method, start_date, num_days,
+        statistic, precision, tileMatrix, tileCol, tileRow, num_cols, num_rows)
+    return os.path.join(_windowed_path, "%s.npy" % key)
+
+def _open(fname, shape, dtype):
+    return np.lib.format.open_memmap(fname, mode="w+", dtype=dtype, shape=shape)
+
+def process_region(
+        tileMatrix=6,
+        tileCol=12,
+        tileRow=10,
+        num_cols=3,
+        num_rows=3,
+        start_date="2017-10-01",
+        num_days=31,
+        method="clip",
+        block=512,
+        statistic="mean",
+        precision=None,
+        output=None,
+        force=False,
+        **kwargs):
+    """Process a region of tiles as one image, block by block. Result is
+    cached.
+
+    Every tile is composited into a scratch array, which then goes through
+    the operator pipeline of improcess: normalization by the maximum, Wiener
+    filter, clip or band reject filter and Wiener filter. The pipeline runs
+    block by block in four passes:
+
+    1. Find the maximum
+    2. Accumulate the noise power of the first Wiener filter
+    3. Apply the first Wiener filter and the clip or band reject filter into
+       a scratch array, accumulating the noise power of the second Wiener
+       filter
+    4. Apply the second Wiener filter
+
+    Args:
+        tileMatrix (int, optional): Zoom in level
+        tileCol (int, optional): Column of the top left tile
+        tileRow (int, optional): Row of the top left tile
+        num_cols (int, optional): Number of tile columns
+        num_rows (int, optional): Number of tile rows
+        start_date (str, optional): Start date of the composite
+        num_days (int, optional): Number of days of the composite
+        method (str, optional): Image processing method, "clip" or
+            "band_reject"
+        block (int, optional): Height and width of the blocks processed at
+            once
+        statistic (str, optional): Composite statistic, see the composite
+            module
+        precision (str, optional): The precision policy ("float64", "float32"
+            or "uint8")
+        output (str, optional): File name of the processed image. Defaults to
+            a file in the windowed cache.
+        force (bool, optional): Process the region even if it is cached
+        **kwargs: Extra parameters passed to the composite, e.g. missing, q
+            and trim
+
+    Returns:
+        np.memmap: The processed image, read only
+    """
+    policy = get_policy(precision)
+    # Raises ValueError for unknown methods before anything is fetched
+    pipeline = improcess.pipeline(method, policy)
+    fname = output or _region_path(method, start_date, num_days, statistic,
+        policy.name, tileMatrix, tileCol, tileRow, num_cols, num_rows)
+    if not force:
+        try:
+            return np.load(fname, mmap_mode="r")
+        except (OSError, IOError, ValueError):
+            pass
+
+    directory = os.path.dirname(os.path.abspath(fname))
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+    shape = (num_rows * _tile_size, num_cols * _tile_size)
+    scratch = "%s.%d" % (fname, os.getpid())
+    output_fname = scratch + ".tmp"
+    tmp_fnames = [output_fname]
+
+    def scratch_array(shape, dtype):
+        tmp_fnames.append("%s.%d.scratch.tmp" % (scratch, len(tmp_fnames)))
+        return _open(tmp_fnames[-1], shape, dtype)
+
+    getimage.prefetch_region(tileMatrix, tileCol, tileRow, num_cols, num_rows,
+        start_date=start_date, num_days=num_days, end_date=None)
+    try:
+        composite = scratch_array(shape, policy.accum)
+        for j in range(num_rows):
+            for i in range(num_cols):
+                composite[j * _tile_size:(j + 1) * _tile_size,
+                    i * _tile_size:(i + 1) * _tile_size] = improcess.get_composite(
+                        start_date, num_days, statistic=statistic, precision=policy,
+                        tileMatrix=tileMatrix, tileCol=tileCol + i, tileRow=tileRow + j,
+                        **kwargs)
+        composite.flush()
+
+        image = _open(output_fname, shape, policy.output)
+        pipeline.run(composite, out=image, block=block, scratch=scratch_array)
+        image.flush()
+        del composite, image
+        os.rename(output_fname, fname)
+    finally:
+        for tmp_fname in tmp_fnames:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+    return np.load(fname, mmap_mode="r")
+
+def zonal_stats(image, tileMatrix=6, tileCol=12, tileRow=10, block=512, state=None, county=None, city=None):
+    """Sum and number of land pixels of every place of a processed region
+
+    Every block is geocoded on its own and the partial sums are merged, so
+    only one block of pixels and coordinates is held at a time.
+
+    Args:
+        image (np.ndarray): Processed image of the region, e.g. returned by
+            process_region
+        tileMatrix (int, optional): Zoom in level
+        tileCol (int, optional): Column of the top left tile
+        tileRow (int, optional): Row of the top left tile
+        block (int, optional): Height and width of the blocks geocoded at once
+        state (str, optional): Only keep places of this state
+        county (str, optional): Only keep places of this county
+        city (str, optional): Only keep these places
+
+    Returns:
+        pd.DataFrame: 'Region', 'County', 'State', 'Sum' and 'Count' of every
+            place
+    """
+    import pandas as pd
+    keys = ['Region', 'County', 'State']
+    total = None
+    for y0, y1, x0, x1 in blocks(image.shape[0], image.shape[1], block):
+        mask = _mask_window(tileMatrix, tileCol, tileRow, y0, y1, x0, x1)
+        if not mask.any():
+            continue
+        ty, tx = y0 // _tile_size, x0 // _tile_size
+        df = conversion.geodecode_region(tileMatrix, tileCol + tx, tileRow + ty,
+            np.asarray(image[y0:y1, x0:x1]), mask, state=state, county=county,
+            city=city, offset=(y0 - ty * _tile_size, x0 - tx * _tile_size))
+        partial = df.groupby(keys)['Light Pollution'].agg(['sum', 'count'])
+        total = partial if total is None else total.add(partial, fill_value=0)
+
+    if total is None:
+        return pd.DataFrame(columns=keys + ['Sum', 'Count'])
+    total.columns = ['Sum', 'Count']
+    total['Count'] = total['Count'].astype(np.int64)
+    return total.reset_index()
+
+def zonal_histogram(image, tileMatrix=6, tileCol=12, tileRow=10, block=512, by="County",
+        histogram=None, **kwargs):
+    """Histograms of the light pollution of every zone of a processed region
+
+    Blocks are geocoded and counted one at a time, like zonal_stats. Passing
+    the histogram of previous months accumulates them, e.g. for the
+    quantiles of a year.
+
+    Args:
+        image (np.ndarray): Processed image of the region
+        tileMatrix (int, optional): Zoom in level
+        tileCol (int, optional): Column of the top left tile
+        tileRow (int, optional): Row of the top left tile
+        block (int, optional): Height and width of the blocks geocoded at once
+        by (str, optional): Column of the zones, 'Region', 'County' or 'State'
+        histogram (conversion.ZoneHistogram, optional): Histogram to add to.
+            A new one with unit bins from 0 to 256 by default.
+        **kwargs: state, county or city, see zonal_stats
+
+    Returns:
+        conversion.ZoneHistogram: The histogram
+    """
+    if histogram is None:
+        histogram = conversion.ZoneHistogram()
+    for y0, y1, x0, x1 in blocks(image.shape[0], image.shape[1], block):
+        mask = _mask_window(tileMatrix, tileCol, tileRow, y0, y1, x0, x1)
+        if not mask.any():
+            continue
+        ty, tx = y0 // _tile_size, x0 // _tile_size
+        df = conversion.geodecode_region(tileMatrix, tileCol + tx, tileRow + ty,
+            np.asarray(image[y0:y1, x0:x1]), mask,
+            offset=(y0 - ty * _tile_size, x0 - tx * _tile_size), **kwargs)
+        histogram.add_frame(df, by)
+    return histogram
+
+def zonal_mean(image, tileMatrix=6, tileCol=12, tileRow=10, block=512, **kwargs):
+    """Mean light pollution of every place of a processed region
+
+    Args:
+        image (np.ndarray): Processed image of the region
+        tileMatrix (int, optional): Zoom in level
+        tileCol (int, optional): Column of the top left tile
+        tileRow (int, optional): Row of the top left tile
+        block (int, optional): Height and width of the blocks geocoded at once
+        **kwargs: state, county or city, see zonal_stats
+
+    Returns:
+        pd.DataFrame: 'Region' and mean 'Light Pollution' of every place, like
+            the monthly csv files of the batch pipeline
+    """
+    df = zonal_stats(image, tileMatrix, tileCol, tileRow, block, **kwargs)
+    df = df.groupby(['Region'])[['Sum', 'Count']].sum()
+    df['Light Pollution'] = df['Sum'] / df['Count']
+    return df[['Light Pollution']].reset_index()
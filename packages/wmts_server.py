@@ -0,0 +1,597 @@
+"""Local stand-in for the GIBS WMTS and WMS endpoints
+
+Serves WMTS GetTile requests for the layers used by getimage, and WMS GetMap
+requests of regions aligned with the tile grid, from a thread on localhost,
+so fetching code can run without the network. Tiles come from a
+directory laid out like the getimage file cache, so a populated cache can be
+replayed, or are synthetic but deterministic: the same layer, tile and date
+always give the same PNG. A fraction of synthetic VIIRS tiles can be
+blank, like tiles over the ocean or days without data.
+
+Latency, server errors and throttling can be injected to measure
+concurrency, retries and caching under reproducible load.
+
+Maps are assembled from the same tiles, so a region fetched with GetMap is
+identical to its tiles fetched with GetTile. Maps larger than max_map_size
+are refused with a service exception, like a WMS server does.
+
+Tiles are served with ETag and Last-Modified validators and conditional
+requests are answered with 304 Not Modified. reprocess() replaces a tile
+with a new version, like GIBS reprocessing a day.
+
+Usage:
+    with wmts_server.WMTSServer(latency=0.05, error_rate=0.01) as server:
+        getimage.set_base_url(server.url)
+        getimage.set_wms_url(server.wms_url)
+        ...
+
+    python wmts_server.py --port 8080 --tile-dir getimage.cache
+"""
+from __future__ import print_function
+import argparse
+import email.utils
+import os
+import random
+import threading
+import time
+import zlib
+import numpy as np
+
+try: # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+except ImportError: # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+
+def synthetic_tile(layer, tileMatrix, tileCol, tileRow, date=None, size=512,
+        blank_rate=0, version=0):
+    """Deterministic fake tile of a layer
+
+    VIIRS tiles are single band uint8 images of scattered lights over a dark
+    background. OSM_Land_Mask tiles are RGBA images whose alpha channel is 0
+    over the sea, 255 over land and anti-aliased along the coast line.
+
+    Args:
+        layer (str): Layer name
+        tileMatrix (int): Zoom in level
+        tileCol (int): Column
+        tileRow (int): Row
+        date (str, optional): Date string in iso format
+        size (int, optional): Width and height of the tile
+        blank_rate (float, optional): Fraction of VIIRS tiles which are all
+            zero
+        version (int, optional): Version of the tile. Every version is a
+            different image.
+
+    Returns:
+        np.ndarray: The tile
+    """
+    name = "%s_%s_%s_%s_%s" % (layer, tileMatrix, tileCol, tileRow, date)
+    if version:
+        name += "_v%d" % version
+    seed = zlib.crc32(name.encode("utf-8"))
+    rng = np.random.RandomState(seed & 0xffffffff)
+
+    if layer == "OSM_Land_Mask":
+        # Coast line running diagonally through the tile
+        y, x = np.mgrid[0:size, 0:size]
+        coast = (x - y + (tileCol - tileRow) * size // 4) / 4.0
+        alpha = np.clip(coast * 255.0 + 128.0, 0, 255).astype(np.uint8)
+        image = np.zeros((size, size, 4), np.uint8)
+        image[..., 3] = alpha
+        return image
+
+    if blank_rate and rng.random_sample() < blank_rate:
+        return np.zeros((size, size), np.uint8)
+
+    image = rng.randint(0, 40, (size, size)).astype(np.uint8)
+    lights = rng.randint(0, size, (size // 8, 2))
+    image[lights[:, 0], lights[:, 1]] = rng.randint(60, 256, size // 8)
+    return image
+
+def encode_png(image):
+    """Encode an image as PNG
+
+    Args:
+        image (np.ndarray): uint8 image
+
+    Returns:
+        bytes: The PNG file
+    """
+    import imageio
+    return imageio.imwrite(imageio.RETURN_BYTES, image, format="png")
+
+def _not_modified(headers, etag, modified):
+    """Whether the conditional headers of a request match a tile
+
+    If-None-Match takes precedence over If-Modified-Since, whose resolution
+    is one second.
+
+    Args:
+        headers: Request headers
+        etag (str): ETag of the tile
+        modified (float): Modification time of the tile
+
+    Returns:
+        bool: The client copy is current
+    """
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or "W/" + etag in tags
+
+    since = headers.get("If-Modified-Since")
+    if since:
+        parsed = email.utils.parsedate_tz(since)
+        if parsed is not None:
+            return int(modified) <= email.utils.mktime_tz(parsed)
+    return False
+
+class _ServiceException(Exception):
+    pass
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # WMTS key-value parameter names are case insensitive
+        params = dict((k.lower(), v)
+            for k, v in parse_qsl(urlparse(self.path).query))
+
+        request = params.get("request", "").lower()
+        if request == "getmap":
+            try:
+                bbox = [float(v) for v in params["bbox"].split(",")]
+                if len(bbox) != 4:
+                    raise ValueError(bbox)
+                if params.get("version", "1.3.0") == "1.3.0":
+                    # EPSG:4326 axes are latitude first in WMS 1.3.0
+                    bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+                query = (
+                    params.get("layers", ""),
+                    bbox,
+                    int(params["width"]),
+                    int(params["height"]),
+                    params.get("time"))
+            except (KeyError, ValueError):
+                self.send_error(400, "Invalid map parameters")
+                return
+            self.server.wmts.handle_map(self, *query)
+            return
+
+        if request != "gettile":
+            self.send_error(400, "Only GetTile and GetMap are supported")
+            return
+
+        try:
+            tile = (
+                params.get("layer", ""),
+                int(params["tilematrix"]),
+                int(params["tilecol"]),
+                int(params["tilerow"]),
+                params.get("time"))
+        except (KeyError, ValueError):
+            self.send_error(400, "Invalid tile parameters")
+            return
+
+        self.server.wmts.handle(self, tile)
+
+class WMTSServer(object):
+
+    """WMTS server running in a background thread
+
+    Attributes:
+        max_map_size (int): Largest width and height of a map, or None
+        modified (float): Time tiles were last modified, unless reprocessed
+        stats (dict): Number of "requests", "served" tiles and maps, "maps"
+            served, "not_modified" answers, "exceptions", "errors",
+            "throttled" and "not_found" requests, "bytes" of tiles and maps
+            sent and the "max_in_flight" requests seen so far
+        url (str): Base url to pass to getimage.set_base_url
+        wms_url (str): Base url to pass to getimage.set_wms_url
+    """
+
+    def __init__(
+            self,
+            host="127.0.0.1",
+            port=0,
+            tile_dir=None,
+            synthetic=True,
+            blank_rate=0,
+            latency=0,
+            jitter=0,
+            error_rate=0,
+            error_codes=(500, 503),
+            max_rate=None,
+            max_in_flight=None,
+            max_map_size=None,
+            seed=0):
+        """Bind the server. It starts serving on start().
+
+        Args:
+            host (str, optional): Address to listen on
+            port (int, optional): Port to listen on. 0 picks a free port.
+            tile_dir (str, optional): Directory of tiles named
+                <layer>_<tileMatrix>_<tileCol>_<tileRow>_<date>.png, or a
+                getimage file cache
+            synthetic (bool, optional): Serve synthetic tiles missing from
+                tile_dir. Otherwise they are answered with 404.
+            blank_rate (float, optional): Fraction of synthetic VIIRS tiles
+                which are all zero
+            latency (float, optional): Seconds added to every response
+            jitter (float, optional): Random extra seconds, up to this value,
+                added to every response
+            error_rate (float, optional): Fraction of requests answered with
+                a server error
+            error_codes (tuple, optional): Status codes of injected errors
+            max_rate (float, optional): Requests per second above which
+                requests are answered with 429
+            max_in_flight (int, optional): Concurrent requests above which
+                requests are answered with 429
+            max_map_size (int, optional): Width or height above which maps
+                are refused
+            seed (int, optional): Seed of the injected randomness
+        """
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.wmts = self
+        self._thread = None
+        self._lock = threading.Lock()
+        self._tiles = {}
+        self._versions = {}
+        self._random = random.Random(seed)
+
+        self.tile_dir = tile_dir
+        self.synthetic = synthetic
+        self.blank_rate = blank_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.max_rate = max_rate
+        self.max_in_flight = max_in_flight
+        self.max_map_size = max_map_size
+        self.modified = time.time()
+
+        self._tokens = max_rate or 0
+        self._last_refill = time.time()
+        self._in_flight = 0
+
+        self.stats = {
+            "requests": 0,
+            "served": 0,
+            "maps": 0,
+            "not_modified": 0,
+            "exceptions": 0,
+            "errors": 0,
+            "throttled": 0,
+            "not_found": 0,
+            "bytes": 0,
+            "max_in_flight": 0
+        }
+
+        host, port = self._httpd.server_address[:2]
+        self.url = "http://%s:%d/wmts.cgi?" % (host, port)
+        self.wms_url = "http://%s:%d/wms.cgi?" % (host, port)
+
+    @property
+    def requests(self):
+        return self.stats["requests"]
+
+    def get_tile(self, layer, tileMatrix, tileCol, tileRow, date=None):
+        """Encoded PNG of a tile
+
+        Returns:
+            bytes: The PNG file, or None if the tile is not available
+        """
+        entry = self._entry((layer, tileMatrix, tileCol, tileRow, date))
+        return entry[0] if entry else None
+
+    def _entry(self, key):
+        """Encoded PNG, ETag and modification time of a tile, or None if the
+        tile is not available
+        """
+        with self._lock:
+            entry = self._tiles.get(key)
+            version, modified = self._versions.get(key, (0, self.modified))
+        if entry is not None:
+            return entry
+
+        body = None
+        if self.tile_dir and not version:
+            name = "%s_%s_%s_%s_%s" % key
+            try:
+                with open(os.path.join(self.tile_dir, name + ".png"), "rb") as f:
+                    body = f.read()
+            except (OSError, IOError):
+                body = self._read_cached(name)
+        if body is None and (self.synthetic or version):
+            body = encode_png(synthetic_tile(*key, blank_rate=self.blank_rate,
+                version=version))
+        if body is None:
+            return None
+
+        entry = (body, '"%08x-%x"' % (zlib.crc32(body) & 0xffffffff, len(body)),
+            modified)
+        with self._lock:
+            self._tiles[key] = entry
+        return entry
+
+    def _map(self, layer, bbox, width, height, date=None):
+        """Encoded PNG, ETag and modification time of a map assembled from
+        tiles
+
+        Args:
+            layer (str): Layer name
+            bbox (list): West, south, east and north bounds in degrees
+            width (int): Width of the map
+            height (int): Height of the map
+            date (str, optional): Date string in iso format
+
+        Raises:
+            _ServiceException: The map is too large or not aligned with the
+                tile grid
+        """
+        import imageio
+        if self.max_map_size and max(width, height) > self.max_map_size:
+            raise _ServiceException("Width and height are limited to %d"
+                % self.max_map_size)
+
+        west, south, east, north = bbox
+        size = 512
+        cols, rows = width // size, height // size
+        try:
+            tileMatrix = int(round(np.log2(288.0 * cols / (east - west))))
+        except (OverflowError, ValueError, ZeroDivisionError):
+            raise _ServiceException("Invalid BBOX")
+        degrees = 288.0 / 2 ** tileMatrix
+        tileCol = (west + 180.0) / degrees
+        tileRow = (90.0 - north) / degrees
+        if (cols * size != width or rows * size != height or cols < 1 or rows < 1
+                or abs(east - west - cols * degrees) > 1e-9
+                or abs(north - south - rows * degrees) > 1e-9
+                or abs(tileCol - round(tileCol)) > 1e-6
+                or abs(tileRow - round(tileRow)) > 1e-6):
+            raise _ServiceException("BBOX and size must align with the tile grid")
+        tileCol, tileRow = int(round(tileCol)), int(round(tileRow))
+
+        image_rows = []
+        modified = 0
+        for j in range(rows):
+            row = []
+            for i in range(cols):
+                entry = self._entry((layer, tileMatrix, tileCol + i,
+                    tileRow + j, date))
+                if entry is None:
+                    raise _ServiceException("Tile not found")
+                row.append(imageio.imread(entry[0]))
+                modified = max(modified, entry[2])
+            image_rows.append(np.concatenate(row, axis=1))
+        body = encode_png(np.concatenate(image_rows, axis=0))
+        return (body, '"%08x-%x"' % (zlib.crc32(body) & 0xffffffff, len(body)),
+            modified)
+
+    def reprocess(self, layer, tileMatrix, tileCol, tileRow, date=None):
+        """Replace a tile with a new synthetic version, modified now
+
+        Returns:
+            int: Version of the tile
+        """
+        key = (layer, tileMatrix, tileCol, tileRow, date)
+        with self._lock:
+            version = self._versions.get(key, (0, None))[0] + 1
+            self._versions[key] = (version, time.time())
+            self._tiles.pop(key, None)
+        return version
+
+    def reset(self):
+        """Forget the tiles encoded so far and the reprocessed versions, so
+        tiles are made again with the current settings, e.g. blank_rate
+        """
+        with self._lock:
+            self._tiles.clear()
+            self._versions.clear()
+
+    def _read_cached(self, name):
+        """Encoded PNG of a tile of a getimage file cache, which stores tiles
+        by content
+        """
+        import getimage
+        try:
+            image = getimage.read_cached_tile(name, self.tile_dir, copy=False)
+        except (OSError, IOError):
+            return None
+        return encode_png(np.ascontiguousarray(image))
+
+    def _admit(self):
+        """Decide how to answer a new request
+
+        Returns:
+            status (int): Status code of an injected failure, or None to
+                serve the tile
+            delay (float): Seconds to wait before serving the tile
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+
+            if self.max_rate:
+                now = time.time()
+                self._tokens = min(self.max_rate,
+                    self._tokens + (now - self._last_refill) * self.max_rate)
+                self._last_refill = now
+                if self._tokens < 1:
+                    self.stats["throttled"] += 1
+                    return 429, 0
+                self._tokens -= 1
+
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                self.stats["throttled"] += 1
+                return 429, 0
+
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return self._random.choice(self.error_codes), 0
+
+            self._in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"],
+                self._in_flight)
+            delay = self.latency + self._random.random() * self.jitter
+        return None, delay
+
+    def handle(self, handler, tile):
+        """Answer a GetTile request
+
+        Args:
+            handler (BaseHTTPRequestHandler): The request
+            tile (tuple): Layer, tileMatrix, tileCol, tileRow and date
+        """
+        self._serve(handler, lambda: self._entry(tile))
+
+    def handle_map(self, handler, layer, bbox, width, height, date=None):
+        """Answer a GetMap request
+
+        Args:
+            handler (BaseHTTPRequestHandler): The request
+            layer (str): Layer name
+            bbox (list): West, south, east and north bounds in degrees
+            width (int): Width of the map
+            height (int): Height of the map
+            date (str, optional): Date string in iso format
+        """
+        self._serve(handler, lambda: self._map(layer, bbox, width, height, date),
+            stat="maps")
+
+    def _serve(self, handler, get_entry, stat=None):
+        """Answer a request with the PNG of an entry, see _entry
+
+        Args:
+            handler (BaseHTTPRequestHandler): The request
+            get_entry (function): Function returning the entry
+            stat (str, optional): Statistic counting the entries served
+        """
+        status, delay = self._admit()
+        if status:
+            handler.send_response(status)
+            if status == 429:
+                handler.send_header("Retry-After", "1")
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        try:
+            if delay:
+                time.sleep(delay)
+            try:
+                entry = get_entry()
+            except _ServiceException as e:
+                body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<ServiceExceptionReport version="1.3.0">'
+                    '<ServiceException>%s</ServiceException>'
+                    '</ServiceExceptionReport>\n' % e).encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "application/vnd.ogc.se_xml")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+                with self._lock:
+                    self.stats["exceptions"] += 1
+                return
+            if entry is None:
+                with self._lock:
+                    self.stats["not_found"] += 1
+                handler.send_error(404, "Tile not found")
+                return
+
+            body, etag, modified = entry
+            if _not_modified(handler.headers, etag, modified):
+                handler.send_response(304)
+                handler.send_header("ETag", etag)
+                handler.send_header("Last-Modified",
+                    email.utils.formatdate(modified, usegmt=True))
+                handler.end_headers()
+                with self._lock:
+                    self.stats["not_modified"] += 1
+                return
+
+            handler.send_response(200)
+            handler.send_header("Content-Type", "image/png")
+            handler.send_header("Content-Length", str(len(body)))
+            handler.send_header("ETag", etag)
+            handler.send_header("Last-Modified",
+                email.utils.formatdate(modified, usegmt=True))
+            handler.end_headers()
+            handler.wfile.write(body)
+            with self._lock:
+                self.stats["served"] += 1
+                if stat:
+                    self.stats[stat] += 1
+                self.stats["bytes"] += len(body)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def start(self):
+        """Serve requests in a background thread
+
+        Returns:
+            WMTSServer: The server itself
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in WMTS server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tile-dir", default=None,
+        help="directory of tiles laid out like the getimage file cache")
+    parser.add_argument("--no-synthetic", dest="synthetic",
+        action="store_false", help="answer tiles missing from --tile-dir with 404")
+    parser.add_argument("--blank-rate", type=float, default=0,
+        help="fraction of synthetic VIIRS tiles which are all zero")
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--max-rate", type=float, default=None)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--max-map-size", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = WMTSServer(host=args.host, port=args.port, tile_dir=args.tile_dir,
+        synthetic=args.synthetic, blank_rate=args.blank_rate,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        max_rate=args.max_rate, max_in_flight=args.max_in_flight,
+        max_map_size=args.max_map_size, seed=args.seed)
+    print("Serving on %s and %s" % (server.url, server.wms_url))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Fixtures of the test suite
+
+Tests run against a local WMTS stand-in server of deterministic synthetic
+tiles, with every cache in a temporary directory, so they need no network
+and leave the caches of the repository alone.
+"""
+import io
+import os
+import sys
+import numpy as np
+import pytest
+
+_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(_root, "packages"))
+
+import batch
+import conversion
+import getimage
+import pyramid
+import windowed
+import wmts_server
+
+# Top left tile of the California region used by Data_Analysis.ipynb
+CA_TILE = (6, 12, 10)
+
+@pytest.fixture
+def server(tmp_path):
+    """Local tile server, with the caches of getimage, windowed, pyramid and
+    batch in a temporary directory
+    """
+    with wmts_server.WMTSServer() as server:
+        getimage.set_base_url(server.url)
+        getimage.set_wms_url(server.wms_url)
+        getimage.set_cache_dir(str(tmp_path / "getimage"))
+        windowed.set_cache_dir(str(tmp_path / "windowed"))
+        pyramid.set_cache_dir(str(tmp_path / "pyramid"))
+        batch.set_cache_dir(str(tmp_path / "batch"))
+        try:
+            yield server
+        finally:
+            getimage.set_cache_budget(None)
+            getimage.set_revalidate(None)
+            getimage.set_fetch_mode("tile")
+
+def synthetic_cities(n, seed=0):
+    """CSV stream of random places spread over the California region
+    """
+    import reverse_geocoder as rg
+    rng = np.random.RandomState(seed)
+    lat0, lon0 = conversion.get_coordinates(*CA_TILE)
+    lat1, lon1 = conversion.get_coordinates(CA_TILE[0], CA_TILE[1] + 3,
+        CA_TILE[2] + 3)
+    lines = [",".join(rg.RG_COLUMNS)]
+    for i in range(n):
+        lines.append("%.5f,%.5f,City %d,California,County %d,US" % (
+            rng.uniform(lat1, lat0), rng.uniform(lon0, lon1), i, i % 58))
+    return io.StringIO(u"\n".join(lines) + u"\n")
+
+@pytest.fixture
+def geocoder():
+    """The geocoder, built from synthetic places
+    """
+    import reverse_geocoder as rg
+    return rg.preload(mode=1, verbose=False, stream=synthetic_cities(2000))
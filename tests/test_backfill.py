@@ -0,0 +1,48 @@
+import datetime
+import os
+import time
+import pytest
+import backfill
+
+_dates = {"start_date": "2017-10-01", "end_date": "2017-10-02"}
+
+def test_interrupted_backfill_resumes(server, tmp_path):
+    manifest = str(tmp_path / "backfill.json")
+    tiles = backfill.plan(manifest, zooms=[6, 7], **_dates)
+    requests = server.requests
+
+    first = backfill.run(manifest, jobs=4, limit=tiles // 2, verbose=False)
+    assert first["failed"] == 0 and first["left"] == tiles - tiles // 2
+    second = backfill.run(manifest, jobs=4, verbose=False)
+    assert second["fetched"] == first["left"] and second["left"] == 0
+
+    # Every tile was fetched once, and none is missing afterwards
+    assert server.requests - requests == tiles
+    assert backfill.plan(manifest, zooms=[6, 7], **_dates) == 0
+
+def test_checkpoint_survives_a_torn_last_line(server, tmp_path):
+    manifest = str(tmp_path / "backfill.json")
+    tiles = backfill.plan(manifest, zooms=[6], **_dates)
+    backfill.run(manifest, jobs=2, limit=3, verbose=False)
+    with open(manifest + ".done", "a") as f:
+        f.write('["VIIRS')
+    _, _, done = backfill.load(manifest)
+    assert len(done) == 3
+    assert backfill.run(manifest, jobs=2, verbose=False)["left"] == 0
+    assert os.path.exists(manifest) and tiles > 3
+
+def test_rate_limit(server):
+    start = time.time()
+    backfill.fetch([("VIIRS_SNPP_DayNightBand_ENCC", 6, 12, 10, "2017-10-%02d" % d)
+        for d in range(1, 26)], jobs=8, rate=100, verbose=False)
+    assert 25 / (time.time() - start) <= 105
+
+def test_warm_fetches_the_last_days(server):
+    today = datetime.date(2017, 10, 5)
+    result = backfill.warm(days=2, lag=1, today=today, masks=False, verbose=False)
+    # The 3 x 3 tiles of the region on October 3 and 4
+    assert result["fetched"] == 18 and result["failed"] == 0
+    assert backfill.warm(days=2, lag=1, today=today, masks=False,
+        verbose=False)["fetched"] == 0
+    with pytest.raises(ValueError):
+        backfill.warm(days=0, today=today, verbose=False)
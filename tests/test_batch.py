@@ -0,0 +1,109 @@
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+import batch
+from conftest import CA_TILE
+
+@pytest.fixture
+def region(monkeypatch):
+    """Region of two tiles holding some of the synthetic cities
+    """
+    monkeypatch.setitem(batch.REGIONS, "T", {
+        "tileMatrix": CA_TILE[0],
+        "tileCol": CA_TILE[1],
+        "tileRow": CA_TILE[2],
+        "num_cols": 2,
+        "num_rows": 1,
+        "cities": ["City %d" % i for i in range(0, 2000, 10)]
+    })
+    return "T"
+
+def test_graph_runs_dependencies_first():
+    order = []
+    lock = threading.Lock()
+
+    def step(name):
+        with lock:
+            order.append(name)
+
+    graph = batch.Graph()
+    a = graph.add("a", lambda: step("a"))
+    b = graph.add("b", lambda: step("b"))
+    c = graph.add("c", lambda: step("c"), deps=[a, b])
+    graph.add("d", lambda: step("d"), deps=[c])
+    graph.run(jobs=3, verbose=False)
+    assert sorted(order[:2]) == ["a", "b"] and order[2:] == ["c", "d"]
+
+def test_graph_skips_dependents_of_failed_tasks():
+    ran = []
+
+    def fail():
+        raise ValueError("failed")
+
+    graph = batch.Graph()
+    a = graph.add("a", fail)
+    graph.add("b", lambda: ran.append("b"), deps=[a])
+    graph.add("c", lambda: ran.append("c"))
+    with pytest.raises(RuntimeError, match="2 tasks failed: a, b"):
+        graph.run(jobs=2, verbose=False)
+    assert ran == ["c"]
+
+def test_graph_raises_on_tasks_which_can_never_start():
+    ran = []
+    graph = batch.Graph()
+    graph.add("a", lambda: ran.append("a"), deps=[batch.Task("missing", None)])
+    with pytest.raises(RuntimeError, match="can never start: a"):
+        graph.run(verbose=False)
+
+    graph = batch.Graph()
+    b = graph.add("b", lambda: ran.append("b"))
+    c = graph.add("c", lambda: ran.append("c"), deps=[b])
+    b.deps.append(c)
+    with pytest.raises(RuntimeError, match="can never start: b, c"):
+        graph.run(verbose=False)
+    assert ran == []
+
+def test_build_graph_leaves_out_existing_outputs(server, geocoder, tmp_path, region):
+    kwargs = dict(region=region, start_month="2017-10", end_month="2017-11",
+        num_days=2, output_dir=str(tmp_path))
+    graph = batch.build_graph(**kwargs)
+    # Fetch and composite per tile, aggregate and store per month
+    assert len(graph.tasks) == 2 * (2 * 2 + 2)
+    graph.run(verbose=False)
+
+    assert batch.build_graph(**kwargs).tasks == []
+    assert batch.open_cube(region, "clip", 2).times == ["2017-10-01", "2017-11-01"]
+    fname = batch.output_path("2017-10-01", str(tmp_path), region)
+    assert batch.is_up_to_date(fname, "clip", 2)
+
+    # Statistics computed with other parameters, or whose parameter file
+    # is missing, are computed again from the cached composites
+    assert not batch.is_up_to_date(fname, "clip", 3)
+    assert not batch.is_up_to_date(fname, "band_reject", 2)
+    (tmp_path / "2017-11-01_major_cities.csv.params.json").unlink()
+    names = [task.name for task in batch.build_graph(**kwargs).tasks]
+    assert names == ["aggregate T 2017-11-01"]
+
+def test_zonal_statistics_match_aggregate(server, geocoder, tmp_path, region):
+    r = batch.REGIONS[region]
+    tiles = [(r["tileMatrix"], r["tileCol"] + i, r["tileRow"])
+        for i in range(r["num_cols"])]
+    for tile in tiles:
+        batch.composite_tile(batch.composite_path(region, "clip", "2017-10-01", 2, *tile),
+            "clip", *tile, start_date="2017-10-01", num_days=2)
+        batch.zonal_tile(batch.zonal_path(region, "clip", "2017-10-01", 2, *tile),
+            region, "clip", "2017-10-01", 2, *tile)
+
+    merged = str(tmp_path / "merged.csv")
+    batch.merge_zonal(merged, region, "clip", "2017-10-01", 2)
+    whole = str(tmp_path / "whole.csv")
+    batch.aggregate(whole, region, "clip", "2017-10-01", 2)
+
+    merged = pd.read_csv(merged, index_col=0).sort_values("Region")
+    whole = pd.read_csv(whole, index_col=0).sort_values("Region")
+    assert len(whole) > 1
+    assert list(merged["Region"]) == list(whole["Region"])
+    np.testing.assert_allclose(merged["Light Pollution"], whole["Light Pollution"],
+        rtol=1e-9)
+    assert batch.is_up_to_date(str(tmp_path / "merged.csv"), "clip", 2)
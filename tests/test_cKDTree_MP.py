@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+from reverse_geocoder import cKDTree_MP as KDTree_MP
+
+@pytest.mark.parametrize("order", [None, "morton", "hilbert"])
+def test_pquery_matches_query(order):
+    rng = np.random.RandomState(0)
+    tree = KDTree_MP.cKDTree_MP(rng.uniform(0, 1, (50000, 2)))
+    points = rng.uniform(0, 1, (20000, 2))
+    _, indices = tree.pquery(points, order=order)
+    _, expected = tree.query(points)
+    assert np.array_equal(np.asarray(indices).ravel(), np.asarray(expected).ravel())
+
+def test_spatial_order_is_a_permutation():
+    points = np.random.RandomState(1).uniform(0, 1, (1000, 2))
+    for curve in ("morton", "hilbert"):
+        perm = KDTree_MP.spatial_order(points, curve)
+        assert np.array_equal(np.sort(perm), np.arange(1000))
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+import columnar
+
+_months = ["2017-%02d" % m for m in range(1, 5)]
+
+def _frame(month, region, rows=200, seed=0):
+    rng = np.random.RandomState(seed)
+    counties = ["County %d" % i for i in range(5)]
+    return pd.DataFrame({
+        "Region": ["City %d" % i for i in rng.randint(0, 20, rows)],
+        "County": [counties[i] for i in rng.randint(0, 5, rows)],
+        "State": "California" if region == "CA" else "Nevada",
+        "Country": "US",
+        "Latitude": rng.uniform(32, 42, rows),
+        "Light Pollution": rng.rand(rows),
+        "Time": month
+    })
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = str(tmp_path / "pixels")
+    frames = {}
+    for i, month in enumerate(_months):
+        for j, region in enumerate(["CA", "NV"]):
+            frames[month, region] = _frame(month, region, seed=10 * i + j)
+            columnar.write(frames[month, region], root, month, region)
+    return root, frames
+
+def test_read_everything(dataset):
+    root, frames = dataset
+    df = columnar.read(root)
+    expected = pd.concat([frames[m, r] for m in _months for r in ("CA", "NV")],
+        ignore_index=True)
+    for name in ["Region", "County", "State", "Country", "month", "region"]:
+        assert isinstance(df[name].dtype, pd.CategoricalDtype)
+    for name in expected.columns:
+        np.testing.assert_array_equal(np.asarray(df[name], object)
+            if name in columnar.DICTIONARY_COLUMNS else df[name], expected[name])
+    assert list(df["month"].astype(str).unique()) == _months
+
+def test_read_columns_months_and_regions(dataset):
+    root, frames = dataset
+    df = columnar.read(root, columns=["County", "Light Pollution", "month"],
+        start_month="2017-02", end_month="2017-03-01", regions="NV")
+    assert list(df.columns) == ["County", "Light Pollution", "month"]
+    expected = pd.concat([frames[m, "NV"] for m in ("2017-02", "2017-03")],
+        ignore_index=True)
+    np.testing.assert_array_equal(df["Light Pollution"], expected["Light Pollution"])
+    np.testing.assert_array_equal(df["County"].astype(str), expected["County"])
+    assert list(df["month"].astype(str).unique()) == ["2017-02", "2017-03"]
+
+    assert len(columnar.read(root, regions=["CA", "NV"], start_month="2017-04")) == 400
+    empty = columnar.read(root, columns=["County"], start_month="2018-01")
+    assert list(empty.columns) == ["County"] and len(empty) == 0
+
+def test_bytes_to_read(dataset):
+    root, _ = dataset
+    everything = columnar.bytes_to_read(root)
+    one_column = columnar.bytes_to_read(root, columns=["Light Pollution"])
+    one_month = columnar.bytes_to_read(root, columns=["Light Pollution"],
+        start_month="2017-02", end_month="2017-02", regions=["CA"])
+    assert 0 < one_month < one_column < everything
+    # Partition columns are not stored in the files
+    assert columnar.bytes_to_read(root, columns=["Light Pollution", "month"]) \
+        == one_column
+    assert one_month * len(_months) * 2 == pytest.approx(one_column, rel=0.2)
+
+def test_write_replaces_a_part(dataset):
+    root, frames = dataset
+    columnar.write(frames["2017-01", "CA"].head(3), root, "2017-01", "CA")
+    assert len(columnar.read(root, start_month="2017-01", end_month="2017-01",
+        regions="CA")) == 3
+    assert len(columnar.files(root)) == 2 * len(_months)
@@ -0,0 +1,98 @@
+import warnings
+import numpy as np
+import pytest
+import composite
+
+def _days(num_days=7, shape=(10, 9), seed=0):
+    """Daily images with some missing pixels, and the same days with NaN at
+    the missing pixels
+    """
+    rng = np.random.RandomState(seed)
+    images = [rng.randint(1, 255, shape).astype("float32") for _ in range(num_days)]
+    for im in images:
+        im[rng.rand(*shape) < 0.3] = 0
+    # A day missing everywhere and a pixel missing on every day
+    images[2][:] = 0
+    for im in images:
+        im[0, 0] = 0
+    nan = np.stack(images).astype("float64")
+    nan[nan == 0] = np.nan
+    return images, nan
+
+def _trimmed_mean(nan, trim):
+    out = np.zeros(nan.shape[1:])
+    for y in range(nan.shape[1]):
+        for x in range(nan.shape[2]):
+            values = np.sort(nan[:, y, x][~np.isnan(nan[:, y, x])])
+            cut = int(trim * len(values))
+            if len(values):
+                out[y, x] = values[cut:len(values) - cut].mean()
+    return out
+
+def _expected(nan, statistic, q=50, trim=0.1):
+    if statistic == "trimmed_mean":
+        return _trimmed_mean(nan, trim)
+    # Pixels without valid days warn and read NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if statistic == "mean":
+            out = np.nanmean(nan, axis=0)
+        elif statistic == "median":
+            out = np.nanmedian(nan, axis=0)
+        else:
+            out = np.nanpercentile(nan, q, axis=0)
+    return np.nan_to_num(out)
+
+@pytest.mark.parametrize("statistic, q, trim", [("mean", 50, 0.1),
+    ("median", 50, 0.1), ("trimmed_mean", 50, 0.2), ("percentile", 90, 0.1),
+    ("percentile", 0, 0.1)])
+def test_statistics_match_numpy(statistic, q, trim):
+    images, nan = _days()
+    # Blocks smaller than the image, so rows come from several blocks
+    image, count = composite.composite(images, statistic, missing=0, q=q,
+        trim=trim, block=4, dtype="float64")
+    np.testing.assert_allclose(image, _expected(nan, statistic, q, trim),
+        rtol=1e-12)
+    np.testing.assert_array_equal(count, (~np.isnan(nan)).sum(axis=0))
+    assert count[0, 0] == 0 and image[0, 0] == 0
+
+def test_statistics_without_missing_days():
+    images, _ = _days()
+    stack = np.stack(images).astype("float64")
+    for statistic in ("mean", "median", "percentile"):
+        image, count = composite.composite(images, statistic, q=25,
+            dtype="float64")
+        np.testing.assert_allclose(image, _expected(stack, statistic, q=25),
+            rtol=1e-12)
+        assert (count == len(images)).all()
+
+def test_masks_match_missing_values():
+    images, _ = _days()
+    valid = [im != 0 for im in images]
+    masked = [np.ma.masked_equal(im, 0) for im in images]
+    expected, _ = composite.composite(images, "median", missing=0, dtype="float64")
+    for kwargs in ({"images": images, "valid": valid}, {"images": masked}):
+        image, _ = composite.composite(statistic="median", dtype="float64", **kwargs)
+        np.testing.assert_array_equal(image, expected)
+
+def test_constant_broadcast_days():
+    shape = (10, 9)
+    images, nan = _days(shape=shape)
+    constant = np.broadcast_to(np.float32(7), shape)
+    empty = np.broadcast_to(np.float32(0), shape)
+    image, count = composite.composite(images + [constant, empty], "mean",
+        missing=0, dtype="float64")
+    nan = np.concatenate([nan, np.full((1,) + shape, 7.0)])
+    np.testing.assert_allclose(image, _expected(nan, "mean"), rtol=1e-12)
+    np.testing.assert_array_equal(count, (~np.isnan(nan)).sum(axis=0))
+
+    # Only constant days, of which one is missing everywhere
+    for statistic in composite.STATISTICS:
+        image, count = composite.composite([constant, empty,
+            np.broadcast_to(np.float32(9), shape)], statistic, missing=0)
+        assert image.shape == shape and (count == 2).all()
+        assert (image == 8).all()
+
+def test_unknown_statistic():
+    with pytest.raises(ValueError):
+        composite.composite([np.zeros((2, 2))], "mode")
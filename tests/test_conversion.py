@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+import conversion
+
+def _pixel_blocks(num_pixels, block=50000):
+    counties = np.array(["County %d" % i for i in range(58)])
+    for start in range(0, num_pixels, block):
+        rng = np.random.RandomState(start)
+        yield (rng.randint(0, 256, block).astype(np.uint8),
+            counties[rng.randint(0, len(counties), block)])
+
+def test_histogram_matches_pandas():
+    values, zones = zip(*_pixel_blocks(200000))
+    df = pd.DataFrame({"Light Pollution": np.concatenate(values),
+        "County": np.concatenate(zones)})
+    thresh = df["Light Pollution"].quantile(0.9)
+    high = (df["Light Pollution"] > thresh).groupby(df["County"]).mean()
+
+    h = conversion.ZoneHistogram()
+    for v, z in _pixel_blocks(200000):
+        h.add(v, z)
+    assert h.exact
+    assert h.quantile(0.9) == thresh
+    fractions = h.fraction_above(thresh)
+    assert (fractions.sort_index() - high.sort_index()).abs().max() == 0.0
+    means = df.groupby("County")["Light Pollution"].mean()
+    assert np.allclose([h.mean(zone) for zone in means.index], means.values)
+    assert np.isclose(h.mean(), df["Light Pollution"].mean())
@@ -0,0 +1,88 @@
+import glob
+import os
+import numpy as np
+import pytest
+import datacube
+
+def _image(seed, shape=(5, 7)):
+    return np.random.RandomState(seed).rand(*shape).astype("float32")
+
+def _cube(tmp_path):
+    return datacube.DataCube.create(str(tmp_path / "cube"), 5, 7,
+        chunks=(2, 3, 4), fill_value=-1)
+
+def test_append_months(tmp_path):
+    cube = _cube(tmp_path)
+    months = ["2017-%02d-01" % m for m in range(1, 6)]
+    for i, month in enumerate(months):
+        cube.append(_image(i), month)
+
+    cube = datacube.DataCube(cube.path)
+    assert cube.times == months
+    expected = np.stack([_image(i) for i in range(5)])
+    np.testing.assert_array_equal(cube[:], expected)
+    np.testing.assert_array_equal(cube.timeseries(2, 3), expected[:, 2, 3])
+    np.testing.assert_array_equal(cube.image("2017-03-01"), expected[2])
+
+    # Storing a month again replaces it
+    cube.append(_image(9), months[1])
+    assert cube.times == months
+    np.testing.assert_array_equal(cube.image(1), _image(9))
+
+def test_insert_out_of_order(tmp_path):
+    cube = _cube(tmp_path)
+    order = [4, 1, 5, 2, 3]
+    for m in order:
+        cube.append(_image(m), "2017-%02d-01" % m)
+
+    cube = datacube.DataCube(cube.path)
+    assert cube.times == ["2017-%02d-01" % m for m in range(1, 6)]
+    np.testing.assert_array_equal(cube[:],
+        np.stack([_image(m) for m in range(1, 6)]))
+
+def test_read_across_generations(tmp_path):
+    cube = _cube(tmp_path)
+    for m in (1, 3, 4, 5, 6):
+        cube.append(_image(m), "2017-%02d-01" % m)
+    # Shifts the later time chunks, which are rewritten as a new generation
+    cube.append(_image(2), "2017-02-01")
+    assert cube._generations
+
+    cube = datacube.DataCube(cube.path)
+    expected = np.stack([_image(m) for m in range(1, 7)])
+    # Slices spanning rewritten and untouched time chunks and spatial chunks
+    np.testing.assert_array_equal(cube[1:5, 2:5, 1:6], expected[1:5, 2:5, 1:6])
+    np.testing.assert_array_equal(cube[::2, 4, ::3], expected[::2, 4, ::3])
+    # The files of the previous generations were removed
+    names = set(os.path.basename(f) for f in glob.glob(os.path.join(cube.path, "c.*")))
+    assert names == set(os.path.basename(cube._chunk_path(ti, yi, xi))
+        for ti in range(3) for yi, xi in cube._spatial_chunks())
+
+def test_unwritten_chunks_read_as_fill(tmp_path):
+    cube = datacube.DataCube.create(str(tmp_path / "cube"), 5, 7,
+        chunks=(2, 3, 4), fill_value=-1)
+    cube.append(_image(0), "2017-01-01")
+    os.remove(cube._chunk_path(0, 1, 1))
+    image = cube.image(0)
+    assert (image[3:, 4:] == -1).all()
+    np.testing.assert_array_equal(image[:3], _image(0)[:3])
+
+def test_truncated_chunk_raises_and_is_kept(tmp_path):
+    cube = _cube(tmp_path)
+    cube.append(_image(0), "2017-01-01")
+    fname = cube._chunk_path(0, 0, 0)
+    with open(fname, "rb") as f:
+        data = f.read()
+    with open(fname, "wb") as f:
+        f.write(data[:len(data) // 2])
+
+    with pytest.raises(IOError):
+        cube[0]
+    with pytest.raises(IOError):
+        cube.append(_image(1), "2017-02-01")
+    with pytest.raises(IOError):
+        cube.append(_image(1), "2016-12-01")
+    # The damaged file was not replaced with fill
+    with open(fname, "rb") as f:
+        assert f.read() == data[:len(data) // 2]
+    assert cube.times == ["2017-01-01"]
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import dimensions
+
+_data = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "data")
+_cache_dir = os.path.dirname(dimensions.cache_file())
+
+@pytest.fixture
+def dims(tmp_path):
+    dimensions.set_cache_dir(str(tmp_path))
+    yield dimensions.load()
+    dimensions.set_cache_dir(_cache_dir)
+
+def test_county_joins_match_the_csv_files(dims):
+    population = pd.read_csv(os.path.join(_data, "county_population.csv"),
+        encoding="utf-8-sig")
+    population["County"] = population["County"].str.strip() + " County"
+    df = pd.DataFrame({"County": list(population["County"]) + ["Nowhere County"],
+        "Sum": np.arange(len(population) + 1.0)})
+    joined = dims.join(df, "County", columns=["Population"])
+    assert len(joined) == len(population)
+    assert (joined["Population"].values == population["Population"].values).all()
+    assert dims.join(df, "County", how="left")["Population"].isna().sum() == 1
+
+def test_names_are_normalized(dims):
+    keys = dims.keys("county", ["ALAMEDA", "Alameda ", "Alameda County", "alameda county"])
+    assert (keys == keys[0]).all() and keys[0] >= 0
+    assert dims.keys("city", ["La Canada Flintridge"])[0] >= 0
+
+def test_every_county_has_an_economic_region(dims):
+    # "Yuba " of the Sacramento region has a trailing space
+    assert (dims.columns["county"]["Economic Region"] >= 0).all()
+    yuba = dims.keys("county", "Yuba")
+    region = dims.gather("county", "Economic Region", yuba)[0]
+    assert dims.names["region"][region] == "Sacramento"
+
+def test_rollup_sums_by_region(dims):
+    keys = dims.keys("county", ["Yolo", "Yuba", "Alameda"])
+    sums = dims.rollup("county", "Economic Region", keys, [1.0, 2.0, 4.0])
+    assert sums["Sacramento"] == 3.0 and sums["San Francisco Bay Area"] == 4.0
+
+def test_binary_cache_is_reused(dims, tmp_path):
+    assert os.listdir(str(tmp_path))
+    loaded = dimensions.Dimensions.load(dimensions.cache_file(_data),
+        dimensions._stamps(_data))
+    assert loaded is not None
+    assert loaded.names == dims.names
+    assert (loaded.columns["city"]["Population"] == dims.columns["city"]["Population"]).all()
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import getimage
+import wmts_server
+from conftest import CA_TILE
+
+_layer = "VIIRS_SNPP_DayNightBand_ENCC"
+
+def _expected(tileMatrix, tileCol, tileRow, date, **kwargs):
+    return wmts_server.synthetic_tile(_layer, tileMatrix, tileCol, tileRow,
+        date, **kwargs)
+
+def _days(start, num_days):
+    return getimage.get_image_date_range(start_date=start, num_days=num_days,
+        end_date=None, sea=None)
+
+def test_truncated_tile_is_fetched_again_once(server, tmp_path):
+    _days("2017-10-25", 6)
+    getimage.clear_memory_cache()
+    blob_dir = os.path.join(str(tmp_path / "getimage"), "blobs")
+    blob = os.path.join(blob_dir, sorted(os.listdir(blob_dir))[-1])
+    with open(blob, "r+b") as f:
+        f.truncate(100)
+
+    served = server.stats["served"]
+    images = _days("2017-10-25", 6)
+    refetched = server.stats["served"] - served
+    assert refetched >= 1
+    for day, image in zip(range(25, 32), images):
+        assert np.array_equal(image, _expected(5, 6, 5, "2017-10-%02d" % day))
+
+    getimage.clear_memory_cache()
+    _days("2017-10-25", 6)
+    assert server.stats["served"] - served == refetched
+
+def test_cache_stays_under_budget(server, tmp_path):
+    getimage.set_cache_budget("2M")
+    _days("2017-10-01", 31)
+    cache_dir = str(tmp_path / "getimage")
+    disk_bytes = sum(os.path.getsize(os.path.join(root, f))
+        for root, _, names in os.walk(cache_dir) for f in names)
+    assert disk_bytes <= 2 * 1024 * 1024
+
+def test_revalidation_transfers_headers_only(server):
+    _days("2017-01-01", 8)
+    getimage.clear_memory_cache()
+    getimage.set_revalidate(0)
+    sent = server.stats["bytes"]
+    _days("2017-01-01", 8)
+    assert server.stats["bytes"] == sent
+
+def test_reprocessed_tile_replaces_cached_one(server):
+    _days("2017-01-01", 3)
+    getimage.clear_memory_cache()
+    getimage.set_revalidate(0)
+    version = server.reprocess(_layer, 5, 6, 5, "2017-01-02")
+    refreshed = getimage.get_image(5, 6, 5, "2017-01-02", sea=None)
+    assert np.array_equal(refreshed, _expected(5, 6, 5, "2017-01-02", version=version))
+
+def test_region_fetch_matches_tiles(server):
+    tileMatrix, tileCol, tileRow = CA_TILE
+    server.max_map_size = 1024
+    getimage.set_fetch_mode("region")
+    getimage.prefetch_region(tileMatrix, tileCol, tileRow, 3, 3,
+        start_date="2017-10-01", num_days=2, end_date=None)
+    maps = server.stats["maps"]
+    assert maps > 0
+    for j in range(3):
+        for i in range(3):
+            image = getimage.get_image(tileMatrix, tileCol + i, tileRow + j,
+                "2017-10-02", sea=None)
+            assert np.array_equal(image,
+                _expected(tileMatrix, tileCol + i, tileRow + j, "2017-10-02"))
+
+def test_california_image_fetches_its_days_only(server):
+    import improcess
+    tileMatrix, tileCol, tileRow = CA_TILE
+    getimage.set_fetch_mode("region")
+    im, mask = improcess.get_california_image(*CA_TILE, start_date="2017-10-01",
+        num_days=2)
+    # One map per day, and no other day is fetched
+    maps = server.stats["maps"]
+    assert 0 < maps <= 2 * 9
+    tile = improcess.get_processed_image_clip(start_date="2017-10-01",
+        num_days=2, tileMatrix=tileMatrix, tileCol=tileCol + 1, tileRow=tileRow + 2)
+    assert np.array_equal(im[1024:, 512:1024], tile)
+    assert server.stats["maps"] == maps
+
+def test_limiter_grows_only_when_saturated():
+    limiter = getimage.AdaptiveLimiter(initial=20)
+    for _ in range(5000):
+        limiter.acquire()
+        limiter.release(latency=0.01)
+    assert limiter.status["limit"] == 20
+
+    # Every slot in use, with downloads waiting
+    for _ in range(25):
+        while limiter.in_flight < int(limiter.limit):
+            limiter.acquire()
+        limiter.release(latency=0.01)
+    assert limiter.status["limit"] == 21
+
+def test_limiter_halves_once_per_round_trip():
+    limiter = getimage.AdaptiveLimiter(initial=100)
+    limiter.acquire()
+    limiter.release(latency=60.0)
+    for _ in range(5):
+        limiter.acquire()
+    for _ in range(5):
+        limiter.release(overload=True)
+    assert limiter.status["limit"] == 50
+
+def test_public_reads_are_writable_copies(server, tmp_path):
+    image = getimage.get_image(5, 6, 5, "2017-10-02", sea=None)
+    image[:] = 0
+    assert np.array_equal(getimage.get_image(5, 6, 5, "2017-10-02", sea=None),
+        _expected(5, 6, 5, "2017-10-02"))
+
+    key = "%s_5_6_5_2017-10-02" % _layer
+    tile = getimage.read_cached_tile(key, str(tmp_path / "getimage"))
+    tile[:] = 0
+    shared = getimage.read_cached_tile(key, str(tmp_path / "getimage"), copy=False)
+    assert not shared.flags.writeable
+    assert np.array_equal(shared, _expected(5, 6, 5, "2017-10-02"))
+
+def test_corrupt_packed_mask_is_fetched_again(server, tmp_path):
+    mask = getimage.get_mask(5, 6, 5)
+    getimage.clear_memory_cache()
+    fname = getimage._packed_mask_path(5, 6, 5)
+    with open(fname, "wb") as f:
+        f.write(b"PK\x03\x04 torn")
+    assert np.array_equal(getimage.get_mask(5, 6, 5), mask)
+    # Packed again from the cached tile
+    assert np.array_equal(getimage.PackedMask.load(fname).unpack(), mask)
@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+_packages = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "packages")
+
+# Import time budget of every module, in seconds, and dependencies which
+# must only be imported by the functions needing them
+IMPORT_BUDGET = 0.25
+HEAVY_MODULES = ("IPython", "PIL", "dateutil", "imageio", "ipywidgets",
+    "matplotlib", "pandas", "pyarrow", "reverse_geocoder", "scipy")
+
+MODULES = ["backfill", "batch", "columnar", "composite", "conversion", "datacube",
+    "dimensions", "getimage", "improcess", "instrument", "jobqueue", "nightflare",
+    "ops", "precision", "pyramid", "trend", "visualization", "windowed", "wmts_server"]
+
+_script = """
+import json, sys, time
+start = time.time()
+import %s
+print(json.dumps({"seconds": time.time() - start,
+    "heavy": sorted(m for m in %r if m in sys.modules)}))
+"""
+
+@pytest.mark.parametrize("module", MODULES)
+def test_import_is_light(module):
+    # A fresh interpreter per import, so nothing is imported yet
+    out = subprocess.check_output([sys.executable, "-c",
+        _script % (module, HEAVY_MODULES)], cwd=_packages)
+    result = json.loads(out.decode("utf-8").strip().split("\n")[-1])
+    assert result["heavy"] == []
+    assert result["seconds"] <= IMPORT_BUDGET
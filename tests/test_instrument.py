@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+import pytest
+import instrument
+
+@pytest.fixture
+def metrics():
+    """Instrumentation turned on with no metrics, and turned back off after
+    the test
+    """
+    enabled = instrument.enabled()
+    instrument.reset()
+    instrument.enable()
+    try:
+        yield
+    finally:
+        instrument.enable(enabled)
+        instrument.set_log(None)
+        instrument.reset()
+
+def test_disabled_collects_nothing():
+    enabled = instrument.enabled()
+    instrument.enable(False)
+    try:
+        instrument.reset()
+        instrument.count("fetches")
+        with instrument.span("wiener"):
+            pass
+        snap = instrument.snapshot()
+        assert snap["counters"] == [] and snap["timings"] == []
+    finally:
+        instrument.enable(enabled)
+
+def test_counters_timings_and_ratios(metrics):
+    instrument.count("cache_hits", 3, layer="mask")
+    instrument.count("cache_misses", layer="mask")
+    instrument.count("cache_hits", 2, layer="mask")
+    instrument.record("fetch", 0.5)
+    instrument.record("fetch", 1.5)
+    with instrument.span("wiener", dtype="float32"):
+        time.sleep(0.01)
+
+    snap = instrument.snapshot()
+    assert snap["counters"] == [
+        {"name": "cache_hits", "labels": {"layer": "mask"}, "value": 5},
+        {"name": "cache_misses", "labels": {"layer": "mask"}, "value": 1}]
+    fetch, wiener = snap["timings"]
+    assert fetch == {"name": "fetch", "labels": {}, "count": 2,
+        "seconds": 2.0, "max_seconds": 1.5}
+    assert wiener["labels"] == {"dtype": "float32"} and wiener["seconds"] >= 0.01
+    assert snap["ratios"] == [{"name": "cache_hit_ratio",
+        "labels": {"layer": "mask"}, "value": 5.0 / 6}]
+
+    text = instrument.to_prometheus()
+    assert 'nightflare_cache_hits_total{layer="mask"} 5\n' in text
+    assert "nightflare_fetch_seconds_count 2\n" in text
+    assert "nightflare_fetch_seconds_max 1.5\n" in text
+
+def test_acquire_times_the_wait(metrics):
+    lock = threading.Lock()
+    lock.acquire()
+    threading.Timer(0.05, lock.release).start()
+    with instrument.acquire(lock, "lock_wait"):
+        assert lock.locked()
+    assert not lock.locked()
+    timing, = instrument.snapshot()["timings"]
+    assert timing["name"] == "lock_wait" and timing["seconds"] >= 0.04
+
+class _SlowStream(object):
+
+    """Stream writing one character at a time, so unserialized writes of
+    several threads interleave
+    """
+
+    def __init__(self):
+        self.chars = []
+
+    def write(self, text):
+        for c in text:
+            self.chars.append(c)
+            time.sleep(0)
+
+def test_log_lines_of_concurrent_spans(metrics):
+    stream = _SlowStream()
+    instrument.set_log(stream)
+
+    def spans(i):
+        for _ in range(20):
+            instrument.record("task", 0.25, worker=i)
+    threads = [threading.Thread(target=spans, args=(i,)) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    lines = "".join(stream.chars).splitlines()
+    assert len(lines) == 160
+    for line in lines:
+        entry = json.loads(line)
+        assert entry["span"] == "task" and entry["seconds"] == 0.25
+    assert sorted(json.loads(line)["labels"]["worker"] for line in lines) == \
+        sorted(list(range(8)) * 20)
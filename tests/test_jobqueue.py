@@ -0,0 +1,85 @@
+import multiprocessing
+import time
+import pytest
+import batch
+import jobqueue
+
+@pytest.mark.parametrize("backend", ["sqlite", "file"])
+def test_workers_drain_the_queue(server, geocoder, tmp_path, backend):
+    # Workers are forked, so they inherit the caches, server url and geocoder
+    fork = multiprocessing.get_context("fork")
+    queue = jobqueue.open_queue(str(tmp_path / ("jobs.db" if backend == "sqlite" else "jobs")))
+    jobs = jobqueue.enqueue(queue, region="CA", start_month="2017-10",
+        end_month="2017-10", num_days=2, output_dir=str(tmp_path))
+    procs = [fork.Process(target=jobqueue.work, args=(queue,),
+            kwargs={"poll": 0.1, "verbose": False})
+        for _ in range(2)]
+    for p in procs: p.start()
+    for p in procs: p.join()
+    assert queue.counts()["done"] == jobs
+    assert (tmp_path / "2017-10-01_major_cities.csv").exists()
+
+    # Workers leave the datacube to the batch pipeline, which only has to
+    # store the composites they cached
+    graph = batch.build_graph(region="CA", start_month="2017-10",
+        end_month="2017-10", num_days=2, output_dir=str(tmp_path))
+    assert [task.name for task in graph.tasks] == ["store CA 2017-10-01"]
+
+def _queue(tmp_path, backend, **kwargs):
+    return jobqueue.open_queue(str(tmp_path / ("jobs.db" if backend == "sqlite" else "jobs")),
+        **kwargs)
+
+@pytest.mark.parametrize("backend", ["sqlite", "file"])
+def test_lost_lease_can_not_complete(tmp_path, backend):
+    queue = _queue(tmp_path, backend, lease=0.05)
+    queue.put("a", {})
+    first = queue.claim("w1")
+    time.sleep(0.1)
+    second = queue.claim("w2")
+    assert second.key == "a" and second.attempts == 2
+    assert not queue.renew(first)
+    assert not queue.complete(first)
+    assert not queue.fail(first, "late")
+    assert queue.counts()["running"] == 1
+    assert queue.complete(second)
+    assert queue.counts()["done"] == 1
+
+@pytest.mark.parametrize("backend", ["sqlite", "file"])
+def test_renewed_lease_is_kept(tmp_path, backend):
+    queue = _queue(tmp_path, backend, lease=0.2)
+    queue.put("a", {})
+    job = queue.claim("w1")
+    for _ in range(4):
+        time.sleep(0.1)
+        assert queue.renew(job)
+    assert queue.claim("w2") is None
+    assert queue.complete(job)
+
+@pytest.mark.parametrize("backend", ["sqlite", "file"])
+def test_failed_jobs_are_queued_again(tmp_path, backend):
+    queue = _queue(tmp_path, backend, max_attempts=1)
+    queue.put("tile", {}, group="g", stage=0)
+    queue.put("merge", {}, group="g", stage=1)
+    assert queue.fail(queue.claim("w1"), "error")
+    assert queue.claim("w1") is None
+    assert queue.counts()["failed"] == 1
+
+    queue.put("tile", {}, group="g", stage=0)
+    queue.put("merge", {}, group="g", stage=1)
+    assert queue.counts()["pending"] == 2
+    assert queue.complete(queue.claim("w1"))
+    assert queue.claim("w1").key == "merge"
+
+def test_worker_renews_long_jobs(tmp_path, monkeypatch):
+    queue = _queue(tmp_path, "sqlite", lease=0.3)
+    queue.put("a", {})
+    claims = []
+
+    def run_job(payload):
+        # Another worker looks for jobs well after the lease would expire
+        time.sleep(1.0)
+        claims.append(queue.claim("w2"))
+    monkeypatch.setattr(jobqueue, "run_job", run_job)
+    assert jobqueue.work(queue, poll=0.1, verbose=False) == 1
+    assert claims == [None]
+    assert queue.counts()["done"] == 1
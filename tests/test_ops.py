@@ -0,0 +1,28 @@
+import numpy as np
+import improcess
+import ops
+
+def test_pipeline_matches_whole_image_operators():
+    policy = improcess.get_policy("float64")
+    image = np.random.RandomState(0).gamma(2.0, 30.0, (700, 600))
+    for method in ("clip", "band_reject"):
+        # Every operator on the whole image, one after the other
+        out = np.round(image)
+        out = improcess._wiener(out * (255.0 / out.max()), 5, policy)
+        out = improcess._wiener(improcess._filters[method](out), 5, policy)
+        for block in (128, 256, 1024):
+            result = improcess.pipeline(method, policy).run(image, block=block)
+            assert np.abs(result - out).max() <= 1e-6
+
+def test_blocks_cover_the_image_once():
+    seen = np.zeros((300, 500), int)
+    for y0, y1, x0, x1 in ops.blocks(300, 500, 128):
+        seen[y0:y1, x0:x1] += 1
+    assert (seen == 1).all()
+
+def test_read_window_pads_with_zeros():
+    arr = np.arange(12.0).reshape(3, 4)
+    win = ops.read_window(arr, -1, 2, 2, 6)
+    assert win.shape == (3, 4)
+    assert (win[0] == 0).all() and (win[:, 2:] == 0).all()
+    assert np.array_equal(win[1:, :2], arr[:2, 2:])
@@ -0,0 +1,66 @@
+import os
+import warnings
+import imageio
+import numpy as np
+import pytest
+from scipy import ndimage
+import improcess
+import ops
+
+# Largest absolute difference from float64 results allowed per policy, on
+# the 0-255 scale of processed images
+DRIFT_BOUNDS = {"float32": 0.01, "uint8": 0.51}
+
+_image = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "images", "201804_pollution_mask_CA.png")
+
+@pytest.fixture(scope="module")
+def composite():
+    """Luminance of a real map of California, whose bright and flat areas
+    next to dark ones are the worst case of the local variance
+    """
+    rgb = imageio.imread(_image)[..., :3].astype(np.float64)
+    # Values a float32 composite can hold, so that rounding agrees
+    return rgb.mean(axis=2).astype(np.float32).astype(np.float64)
+
+def _run(method, precision, image, num_ops=None):
+    pipeline = improcess.pipeline(method, precision)
+    if num_ops is not None:
+        pipeline = ops.Pipeline(pipeline.ops[:num_ops], pipeline.dtype)
+    return pipeline.run(image).astype(np.float64)
+
+@pytest.mark.parametrize("precision", ["float32", "uint8"])
+def test_band_reject_drift(composite, precision):
+    drift = np.abs(_run("band_reject", precision, composite)
+        - _run("band_reject", "float64", composite))
+    assert drift.max() <= DRIFT_BOUNDS[precision]
+
+@pytest.mark.parametrize("precision", ["float32", "uint8"])
+def test_clip_drift_away_from_band_edges(composite, precision):
+    # Pixels within rounding of the edges of the clipped band may be halved
+    # by one run only, even between float64 runs in other blocks, which
+    # moves their Wiener neighbourhood
+    filtered = _run("clip", "float64", composite, 3)
+    edge = ((np.abs(filtered - 0.9 * 60) <= 1e-3) |
+        (np.abs(filtered - 1.7 * 60) <= 1e-3))
+    near = ndimage.binary_dilation(edge, np.ones((5, 5), bool))
+    drift = np.abs(_run("clip", precision, composite)
+        - _run("clip", "float64", composite))
+    assert edge.mean() <= 1e-3
+    assert drift[~near].max() <= DRIFT_BOUNDS[precision]
+
+def test_local_variance_of_bright_flat_areas():
+    image = np.full((64, 64), 250.0, np.float32)
+    image[::7, ::5] = 251.0
+    _, l_var = improcess._local_stats(image, 5, improcess.get_policy("float32"))
+    _, expected = improcess._local_stats(image.astype(np.float64), 5,
+        improcess.get_policy("float64"))
+    assert np.abs(l_var - expected)[2:-2, 2:-2].max() <= 1e-5
+
+def test_float64_wiener_of_flat_windows_does_not_warn():
+    image = np.zeros((32, 32))
+    image[8:12, 8:12] = 200.0
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        out = improcess._wiener(image, 5, improcess.get_policy("float64"))
+    assert np.isfinite(out).all() and np.abs(out[20:, 20:]).max() < 1e-9
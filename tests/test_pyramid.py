@@ -0,0 +1,33 @@
+import numpy as np
+import improcess
+import pyramid
+from conftest import CA_TILE
+
+def test_derived_zoom_matches_downsampled_base(server):
+    zoom, col, row = CA_TILE
+    pyramid.build(zoom, col, row, num_cols=2, num_rows=2, min_zoom=zoom - 1,
+        method="clip", num_days=2)
+
+    base = [pyramid.get_composite(zoom, col + i, row + j, zoom, num_days=2)
+        for j in range(2) for i in range(2)]
+    expected = pyramid.downsample(np.block([base[:2], base[2:]]))
+    parent = pyramid.get_composite(zoom - 1, col // 2, row // 2, zoom,
+        num_days=2)
+    np.testing.assert_allclose(parent, expected, rtol=1e-6)
+
+    tile = pyramid.get_tile(zoom - 1, col // 2, row // 2, zoom, "clip",
+        num_days=2)
+    np.testing.assert_allclose(tile,
+        improcess.process_composite(expected, "clip"), rtol=1e-5, atol=1e-6)
+
+def test_cached_tiles_do_not_fetch(server, monkeypatch):
+    zoom, col, row = CA_TILE
+    args = (zoom - 1, col // 2, row // 2, zoom, "band_reject")
+    tile = pyramid.get_tile(*args, num_days=2)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached tile was composited again")
+    monkeypatch.setattr(improcess, "get_composite", fail)
+    requests = server.stats["requests"]
+    np.testing.assert_array_equal(pyramid.get_tile(*args, num_days=2), tile)
+    assert server.stats["requests"] == requests
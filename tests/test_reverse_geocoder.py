@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pandas as pd
+import conversion
+import reverse_geocoder as rg
+from conftest import CA_TILE, synthetic_cities
+
+def _points(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return list(zip(rng.uniform(33, 37, n).tolist(), rng.uniform(-121, -116, n).tolist()))
+
+def test_search_decodes_nearest_locations(geocoder):
+    points = _points(2000)
+    results = rg.search(points, mode=1, verbose=False)
+    indices = geocoder.query_indices(points, mode=1)
+    assert results == [geocoder.locations[k] for k in indices]
+
+def test_preload_rebuilds_for_another_source():
+    stream = synthetic_cities(100)
+    first = rg.preload(mode=1, verbose=False, stream=stream)
+    assert len(first.locations) == 100
+    # The same source only changes the mode
+    assert rg.preload(mode=2, verbose=False, stream=stream) is first
+    assert first.mode == 2
+    second = rg.preload(mode=1, verbose=False, stream=synthetic_cities(200, seed=1))
+    assert second is not first and len(second.locations) == 200
+    assert rg.search(_points(10), verbose=False) == second.query(_points(10))
+
+def test_geodecode_region_filters_by_county(geocoder):
+    rng = np.random.RandomState(0)
+    region = rng.gamma(2.0, 30.0, (64, 64)).astype(np.float32)
+    mask = (rng.uniform(size=region.shape) > 0.2).astype(np.uint8)
+    df = conversion.geodecode_region(*CA_TILE, region=region, mask=mask, win_size=64)
+    assert len(df) == mask.sum() and df["Light Pollution"].dtype == np.float32
+    # Pixels in row order, with the location nearest to every pixel
+    rows, cols = np.nonzero(mask)
+    assert np.array_equal(df["Light Pollution"].values, region[rows, cols])
+    nearest = rg.search(list(zip(df["Latitude"], df["Longtitude"])), verbose=False)
+    assert list(df["County"]) == [r["admin2"] for r in nearest]
+
+    county = conversion.geodecode_region(*CA_TILE, region=region, mask=mask,
+        win_size=64, county="County 3")
+    pd.testing.assert_frame_equal(county.reset_index(drop=True),
+        df[[c in "County 3" for c in df["County"]]].reset_index(drop=True))
+
+def test_saving_a_store_replaces_the_previous_one(geocoder, tmp_path):
+    path = str(tmp_path / "store")
+    first = geocoder.locations
+    first.save(path, ["first"])
+    mapped = rg.Locations.load(path)
+    second = rg.Locations.from_rows([first[k] for k in range(10)])
+    second.save(path, ["second"])
+
+    assert len(rg.Locations.load(path)) == 10
+    assert sorted(os.listdir(str(tmp_path))) == ["store"]
+    # Stores mapped before keep their files
+    assert len(mapped) == len(first) and mapped[5] == first[5]
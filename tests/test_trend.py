@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import datacube
+import trend
+
+def _stack(seed=0, shape=(9, 6, 5)):
+    rng = np.random.RandomState(seed)
+    t = np.arange(shape[0])[:, None, None]
+    return (rng.rand(*shape[1:]) * t + rng.rand(*shape)).astype("float32")
+
+def _polyfit_slopes(stack):
+    t = np.arange(stack.shape[0])
+    out = np.full(stack.shape[1:], np.nan)
+    for y in range(stack.shape[1]):
+        for x in range(stack.shape[2]):
+            valid = ~np.isnan(stack[:, y, x])
+            if valid.sum() >= 2:
+                out[y, x] = np.polyfit(t[valid], stack[valid, y, x], 1)[0]
+    return out
+
+def test_slope_matches_polyfit():
+    stack = _stack()
+    # Blocks smaller than the image, so pixels come from several blocks
+    np.testing.assert_allclose(trend.slope(stack, block=4),
+        _polyfit_slopes(stack), rtol=1e-5, atol=1e-6)
+
+def test_slope_leaves_out_missing_months():
+    stack = _stack()
+    stack[[2, 5], 1, 1] = np.nan
+    stack[:, 0, 0] = np.nan
+    stack[1:, 3, 2] = np.nan
+    result = trend.slope(stack, block=4)
+    np.testing.assert_allclose(result, _polyfit_slopes(stack), rtol=1e-5, atol=1e-6)
+    assert np.isnan(result[0, 0]) and np.isnan(result[3, 2])
+
+def test_slope_of_a_cube(tmp_path):
+    stack = _stack()
+    cube = datacube.DataCube.create(str(tmp_path / "cube"), 6, 5, chunks=(4, 4, 4))
+    for t, image in enumerate(stack):
+        cube.append(image, "2017-%02d-01" % (t + 1))
+    np.testing.assert_allclose(trend.slope(cube, block=3), trend.slope(stack),
+        rtol=1e-6)
+
+def test_change():
+    stack = _stack()
+    stack[4, 0, 0] = np.nan
+    np.testing.assert_array_equal(trend.change(stack, block=4), stack[-1] - stack[-2])
+    result = trend.change(stack, time=5, block=4)
+    np.testing.assert_array_equal(result[1:], (stack[5] - stack[4])[1:])
+    assert np.isnan(result[0, 0])
+    with pytest.raises(ValueError):
+        trend.change(stack, time=0)
+
+def test_anomaly_by_hand():
+    stack = np.zeros((5, 1, 4), np.float32)
+    stack[:, 0, 0] = [1, 2, 3, 4, 10]
+    # Missing months are left out of the baseline
+    stack[:, 0, 1] = [2, np.nan, 4, np.nan, 6]
+    # Constant baseline
+    stack[:, 0, 2] = [5, 5, 5, 5, 7]
+    # No baseline value at all
+    stack[:, 0, 3] = [np.nan, np.nan, np.nan, np.nan, 1]
+
+    result = trend.anomaly(stack, baseline=4)
+    # Mean 2.5 and population standard deviation sqrt(1.25)
+    assert result[0, 0] == pytest.approx((10 - 2.5) / np.sqrt(1.25), rel=1e-6)
+    # Mean 3 and standard deviation 1
+    assert result[0, 1] == pytest.approx(3, rel=1e-6)
+    assert result[0, 2] == 0
+    assert np.isnan(result[0, 3])
+
+    # A baseline of two steps, 3 and 4: mean 3.5 and standard deviation 0.5
+    assert trend.anomaly(stack, baseline=2)[0, 0] == pytest.approx(13, rel=1e-6)
+    with pytest.raises(ValueError):
+        trend.anomaly(stack, time=1)
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+import improcess
+import windowed
+from conftest import CA_TILE
+
+def _in_memory_region(method, num_cols, num_rows, num_days):
+    """Mosaic of a region processed as one image in memory
+    """
+    arr = np.block([[improcess.get_composite("2017-10-01", num_days,
+            tileMatrix=CA_TILE[0], tileCol=CA_TILE[1] + i, tileRow=CA_TILE[2] + j)
+        for i in range(num_cols)] for j in range(num_rows)])
+    return improcess.process_composite(arr, method, "float64")
+
+def test_process_region_matches_in_memory(server):
+    for method in ("clip", "band_reject"):
+        image = windowed.process_region(*CA_TILE, num_cols=2, num_rows=1,
+            num_days=2, method=method, block=256, force=True)
+        assert np.abs(image - _in_memory_region(method, 2, 1, 2)).max() <= 1e-6
+
+def test_unknown_method_fetches_nothing(server):
+    with pytest.raises(ValueError):
+        windowed.process_region(*CA_TILE, num_days=2, method="median")
+    assert server.stats["requests"] == 0